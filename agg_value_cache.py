@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import contextlib
+
+
+"""
+Content-addressed cache of aggregated values. An entry is keyed by the
+identity of the tif file (path, size, mtime or checksum), the geometry, and
+the parameters that went into the aggregation (method, multiplier,
+aggregation, reference tif), and KEY_VERSION. Cache hits skip decompression and reading of
+the tif entirely.
+
+The store is a single SQLite file opened in WAL mode so that concurrent
+processes (e.g. several teams running generate_chirps_csv.py against the same
+cache) can read and write it safely. Entries are evicted in least-recently-used
+order once the total stored bytes exceed max_bytes.
+"""
+
+
+FILE_IDENTITY_STAT = 'stat'
+FILE_IDENTITY_CHECKSUM = 'checksum'
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024 # 1 GiB
+
+# part of every key, bumped whenever the values computed for the same inputs
+# change, so that the values stored by earlier versions are never served
+# 2: NODATA masked before the multiplier is applied
+KEY_VERSION = 2
+
+# sqlite has a limit on the number of host parameters per query
+_QUERY_BATCH_SIZE = 500
+
+
+def get_file_identity(
+    filepath:str,
+    file_identity:str = FILE_IDENTITY_STAT,
+):
+    abs_filepath = os.path.abspath(filepath)
+    if file_identity == FILE_IDENTITY_STAT:
+        stat = os.stat(abs_filepath)
+        return f'{abs_filepath}|{stat.st_size}|{stat.st_mtime_ns}'
+    elif file_identity == FILE_IDENTITY_CHECKSUM:
+        sha256 = hashlib.sha256()
+        with open(abs_filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        return f'{abs_filepath}|{sha256.hexdigest()}'
+    else:
+        raise ValueError(
+            f'Invalid file_identity={file_identity}. Valid options: '
+            f'{[FILE_IDENTITY_STAT, FILE_IDENTITY_CHECKSUM]}'
+        )
+
+
+def get_geometry_hash(shapes_gdf:gpd.GeoDataFrame):
+    sha256 = hashlib.sha256()
+    crs_str = shapes_gdf.crs.to_wkt() if shapes_gdf.crs is not None else ''
+    sha256.update(crs_str.encode())
+    for geom in shapes_gdf['geometry']:
+        sha256.update(geom.wkb)
+    return sha256.hexdigest()
+
+
+def make_key(
+    filepath:str,
+    geometry_hash:str,
+    method:str,
+    multiplier:float,
+    aggregation:str,
+    reference_tif_filepath:str = None,
+    file_identity:str = FILE_IDENTITY_STAT,
+):
+    reference_identity = ''
+    if reference_tif_filepath is not None:
+        reference_identity = get_file_identity(
+            filepath = reference_tif_filepath,
+            file_identity = file_identity,
+        )
+    key_str = '\n'.join([
+        f'v{KEY_VERSION}',
+        get_file_identity(filepath=filepath, file_identity=file_identity),
+        geometry_hash,
+        str(method),
+        repr(float(multiplier)),
+        str(aggregation),
+        reference_identity,
+    ])
+    return hashlib.sha256(key_str.encode()).hexdigest()
+
+
+class AggValueCache:
+    def __init__(
+        self,
+        cache_filepath:str,
+        max_bytes:int = DEFAULT_MAX_BYTES,
+        timeout:float = 60,
+    ):
+        cache_folderpath = os.path.split(cache_filepath)[0]
+        if cache_folderpath != '':
+            os.makedirs(cache_folderpath, exist_ok=True)
+        self.cache_filepath = cache_filepath
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, '
+                'value BLOB NOT NULL, '
+                'nbytes INTEGER NOT NULL, '
+                'last_accessed REAL NOT NULL)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_last_accessed '
+                'ON cache (last_accessed)'
+            )
+
+    def _connect(self):
+        # isolation_level=None so that transactions are controlled explicitly
+        # with BEGIN IMMEDIATE, which takes the write lock upfront and avoids
+        # deadlocks between concurrent writers.
+        return sqlite3.connect(
+            self.cache_filepath,
+            timeout = self.timeout,
+            isolation_level = None,
+        )
+
+    def get_many(self, keys:list[str]):
+        hits = {}
+        unique_keys = list(dict.fromkeys(keys))
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for i in range(0, len(unique_keys), _QUERY_BATCH_SIZE):
+                batch = unique_keys[i:i+_QUERY_BATCH_SIZE]
+                placeholders = ','.join('?' * len(batch))
+                rows = conn.execute(
+                    f'SELECT key, value FROM cache WHERE key IN ({placeholders})',
+                    batch,
+                ).fetchall()
+                for key, value in rows:
+                    hits[key] = pickle.loads(value)
+                conn.execute(
+                    f'UPDATE cache SET last_accessed = ? WHERE key IN ({placeholders})',
+                    [now] + batch,
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return hits
+
+    def put_many(self, key_value_dict:dict):
+        if len(key_value_dict) == 0:
+            return
+        now = time.time()
+        rows = []
+        for key, value in key_value_dict.items():
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((key, blob, len(key) + len(blob), now))
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(
+                'INSERT OR REPLACE INTO cache (key, value, nbytes, last_accessed) '
+                'VALUES (?, ?, ?, ?)',
+                rows,
+            )
+            self._evict(conn=conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _evict(self, conn:sqlite3.Connection):
+        total_bytes = conn.execute(
+            'SELECT COALESCE(SUM(nbytes), 0) FROM cache'
+        ).fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        excess_bytes = total_bytes - self.max_bytes
+        evict_keys = []
+        for key, nbytes in conn.execute(
+            'SELECT key, nbytes FROM cache ORDER BY last_accessed ASC'
+        ):
+            evict_keys.append(key)
+            excess_bytes -= nbytes
+            if excess_bytes <= 0:
+                break
+        conn.executemany(
+            'DELETE FROM cache WHERE key = ?',
+            [(key,) for key in evict_keys],
+        )
+
+    def get_total_bytes(self):
+        with contextlib.closing(self._connect()) as conn:
+            return conn.execute(
+                'SELECT COALESCE(SUM(nbytes), 0) FROM cache'
+            ).fetchone()[0]
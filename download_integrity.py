@@ -0,0 +1,271 @@
+from __future__ import annotations
+
+import os
+import time
+import gzip
+import zlib
+import warnings
+import functools
+import contextlib
+
+from lazy_imports import lazy_import
+
+pd = lazy_import('pandas')
+tqdm = lazy_import('tqdm')
+chcfetch = lazy_import('chcfetch.chcfetch')
+
+import fetch_missing_chirps_files as fmcf
+import worker_sizing as ws
+import executors as ex
+import progress_metrics as pm
+
+
+"""
+Verification of the CHIRPS files as part of the download, so that a broken
+or partial file never reaches the download folder and the catalogue built
+from it. chcfetch downloads the files into a staging folder next to the
+download folder (on the same filesystem, outside of the folder the
+catalogue is built from), one subfolder per process so that concurrent
+fetches (e.g. the shards of `launch N fetch`) never see each other's files.
+Each file is then checked:
+
+- the gzip stream is decompressed to the end, which catches truncated
+  downloads (no trailer), corrupted data (CRC-32) and a wrong size (the
+  uncompressed size recorded in the gzip trailer),
+- the decompressed stream has to start with a TIFF header,
+- the same GeoTIFF open and transform check as fmcf.check_if_corrupted.
+
+Files that pass are renamed into the download folder, the others are removed
+and downloaded again, up to max_retries times with exponential backoff.
+Files that still fail are left out of the returned catalogue, so that they
+show up as missing on the next fetch.
+"""
+
+
+CORRUPTED_MISSING = 'MISSING'
+CORRUPTED_TRUNCATED = 'TRUNCATED'
+CORRUPTED_BAD_GZIP = 'BAD_GZIP'
+CORRUPTED_NOT_TIFF = 'NOT_TIFF'
+
+STAGING_FOLDER_SUFFIX = '.incoming'
+
+_CHUNK_SIZE = 1024 * 1024
+# little endian, big endian, BigTIFF little endian, BigTIFF big endian
+_TIFF_MAGICS = [b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+']
+
+
+def get_staging_folderpath(download_folderpath:str):
+    """
+    Staging folder of the current process.
+    """
+    return os.path.join(
+        os.path.normpath(download_folderpath) + STAGING_FOLDER_SUFFIX,
+        str(os.getpid()),
+    )
+
+
+def check_gzip_stream(filepath:str):
+    """
+    Decompresses filepath in chunks without writing it anywhere. Returns
+    (is_corrupted, type_of_corruption).
+    """
+    try:
+        with gzip.open(filepath, 'rb') as f:
+            header = f.read(len(_TIFF_MAGICS[0]))
+            if header not in _TIFF_MAGICS:
+                return True, CORRUPTED_NOT_TIFF
+            # the CRC-32 and size in the trailer are checked by gzip at EOF
+            while len(f.read(_CHUNK_SIZE)) > 0:
+                pass
+    except EOFError:
+        return True, CORRUPTED_TRUNCATED
+    except (gzip.BadGzipFile, zlib.error, OSError, ValueError) as e:
+        if isinstance(e, FileNotFoundError):
+            return True, CORRUPTED_MISSING
+        return True, CORRUPTED_BAD_GZIP
+    return False, None
+
+
+def verify_downloaded_file(filepath:str):
+    """
+    Returns (is_corrupted, type_of_corruption) for a downloaded .tif.gz or
+    .tif file.
+    """
+    if not os.path.exists(filepath):
+        return True, CORRUPTED_MISSING
+    if filepath.endswith(fmcf.EXT_TIF_GZ):
+        is_corrupted, type_of_corruption = check_gzip_stream(filepath=filepath)
+        if is_corrupted:
+            return is_corrupted, type_of_corruption
+    return fmcf.check_if_corrupted(tif_filepath=filepath)
+
+
+def get_staged_df(
+    paths_df:pd.DataFrame,
+    staging_folderpath:str,
+    download_filepath_col:str = fmcf.COL_TIF_FILEPATH,
+    date_col:str = fmcf.COL_DATE,
+):
+    """
+    Rows of paths_df whose file is in staging_folderpath, with
+    download_filepath_col pointing to it. Rows are matched by date_col.
+    """
+    staged_catalogue_df = fmcf.generate_chc_chirps_catalogue_df(folderpath=staging_folderpath)
+    if staged_catalogue_df.shape[0] == 0:
+        return paths_df.iloc[0:0].assign(**{download_filepath_col: []})
+    staged_filepaths = dict(zip(
+        staged_catalogue_df[fmcf.COL_DATE],
+        staged_catalogue_df[fmcf.COL_TIF_FILEPATH],
+    ))
+    staged_df = paths_df[paths_df[date_col].isin(staged_filepaths.keys())].copy()
+    staged_df[download_filepath_col] = staged_df[date_col].map(staged_filepaths)
+    return staged_df
+
+
+def download_and_verify_files(
+    paths_df:pd.DataFrame,
+    download_folderpath:str,
+    download_filepath_col:str = fmcf.COL_TIF_FILEPATH,
+    date_col:str = fmcf.COL_DATE,
+    njobs:int = ws.DEFAULT_NJOBS,
+    max_retries:int = fmcf.DEFAULT_DOWNLOAD_MAX_RETRIES,
+    backoff_seconds:float = fmcf.DEFAULT_DOWNLOAD_BACKOFF_SECONDS,
+    metrics:pm.ProgressMetrics = None,
+):
+    """
+    Same as chcfetch.download_files_from_paths_df, but only returns the rows
+    whose file was downloaded and verified, with download_filepath_col
+    pointing to the file in download_folderpath. Rows are matched by
+    date_col, which needs to be unique.
+
+    If chcfetch raises, the files it staged before failing are verified and
+    kept, and only the remaining ones are downloaded again.
+
+    metrics (see progress_metrics.py) counts a file as done once verified,
+    and every failed attempt of a file as an error. While chcfetch downloads,
+    the files and bytes in the staging folder are reported as in progress.
+    """
+    staging_folderpath = get_staging_folderpath(download_folderpath=download_folderpath)
+    os.makedirs(staging_folderpath, exist_ok=True)
+
+    if metrics is not None:
+        metrics.add_expected(paths_df.shape[0])
+
+    verified_dfs = []
+    pending_df = paths_df
+    failures = {}
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            wait_seconds = backoff_seconds * 2 ** (attempt - 1)
+            print(
+                f'Retrying {pending_df.shape[0]} files in {wait_seconds:g} s '
+                f'(attempt {attempt + 1} / {max_retries + 1}).'
+            )
+            time.sleep(wait_seconds)
+
+        if metrics is not None:
+            # until the files are verified and moved out of the staging folder
+            metrics.in_progress_func = functools.partial(
+                pm.get_folder_files_bytes, staging_folderpath,
+            )
+        download_error = None
+        try:
+            # staged files are left over from failed attempts, always replaced
+            downloaded_df = chcfetch.download_files_from_paths_df(
+                paths_df = pending_df,
+                download_folderpath = staging_folderpath,
+                njobs = njobs,
+                download_filepath_col = download_filepath_col,
+                overwrite = True,
+            )
+        except Exception as e:
+            # the files chcfetch got to before failing are verified as usual,
+            # only the others are downloaded again
+            download_error = e
+            downloaded_df = get_staged_df(
+                paths_df = pending_df,
+                staging_folderpath = staging_folderpath,
+                download_filepath_col = download_filepath_col,
+                date_col = date_col,
+            )
+            print(f'Download failed: {e}. {downloaded_df.shape[0]} / {pending_df.shape[0]} files were staged.')
+
+        staged_filepaths = list(downloaded_df[download_filepath_col])
+        plan = ws.plan_workers(
+            n_tasks = len(staged_filepaths),
+            njobs = njobs,
+        )
+        with contextlib.ExitStack() as stack:
+            # decompression and reads release the GIL
+            verify_stats = list(tqdm.tqdm(
+                ex.backend_imap(
+                    stack = stack,
+                    backend = ex.ExecutorBackend.THREADS,
+                    plan = plan,
+                    func = verify_downloaded_file,
+                    iterable = staged_filepaths,
+                ),
+                total = len(staged_filepaths),
+            ))
+
+        verified_filepaths = {}
+        failures = {}
+        for date, staged_filepath, (is_corrupted, type_of_corruption) in zip(
+            downloaded_df[date_col], staged_filepaths, verify_stats,
+        ):
+            if is_corrupted:
+                failures[date] = type_of_corruption
+                if os.path.exists(staged_filepath):
+                    os.remove(staged_filepath)
+                continue
+            # same layout as chcfetch used in the staging folder
+            filepath = os.path.join(
+                download_folderpath,
+                os.path.relpath(staged_filepath, staging_folderpath),
+            )
+            os.makedirs(os.path.split(filepath)[0], exist_ok=True)
+            os.replace(staged_filepath, filepath)
+            verified_filepaths[date] = filepath
+            if metrics is not None:
+                metrics.add(source_bytes=os.path.getsize(filepath))
+
+        if metrics is not None:
+            metrics.in_progress_func = None
+
+        if len(verified_filepaths) > 0:
+            verified_df = downloaded_df[downloaded_df[date_col].isin(verified_filepaths.keys())].copy()
+            verified_df[download_filepath_col] = verified_df[date_col].map(verified_filepaths)
+            verified_dfs.append(verified_df)
+
+        print(f'Verified downloads: {len(verified_filepaths)} / {len(staged_filepaths)}')
+
+        # rows chcfetch did not return at all are retried as well
+        pending_df = pending_df[~pending_df[date_col].isin(verified_filepaths.keys())]
+        for date in pending_df[date_col]:
+            failures.setdefault(
+                date,
+                CORRUPTED_MISSING if download_error is None else f'download failed: {download_error}',
+            )
+        if metrics is not None:
+            metrics.add_errors(pending_df.shape[0])
+        if pending_df.shape[0] == 0:
+            break
+
+    if pending_df.shape[0] > 0:
+        warnings.warn(
+            f'{pending_df.shape[0]} files failed verification after {max_retries + 1} '
+            'attempts and were left out, they will be fetched again on the next run: '
+            + ', '.join(
+                f"{date.strftime('%Y-%m-%d')} ({failures.get(date)})"
+                for date in pending_df[date_col]
+            )
+        )
+
+    # only empty folders, the parent is shared with other running fetches
+    with contextlib.suppress(OSError):
+        os.rmdir(staging_folderpath)
+        os.rmdir(os.path.split(staging_folderpath)[0])
+
+    if len(verified_dfs) == 0:
+        return paths_df.iloc[0:0].assign(**{download_filepath_col: []})
+    return pd.concat(verified_dfs).sort_values(by=date_col).reset_index(drop=True)
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import collections
+import multiprocessing as mp
+import multiprocessing.pool
+
+import worker_sizing as ws
+
+
+"""
+Selectable executor backends for the per-file tasks.
+
+- processes: mp.Pool, the original behaviour. Every task is pickled to a
+  worker and each worker pays the imports once.
+- threads: ThreadPool in this process. GDAL reads and zlib decompression
+  release the GIL, so for small ROIs, where a task is mostly I/O, this avoids
+  the process start up and pickling costs.
+- hybrid: threads do the I/O (decompress, read, crop) and hand the loaded
+  arrays to a small process pool for the reductions, which hold the GIL.
+  Worth it when the reductions are heavy compared to the reads (large ROIs,
+  median, custom callables).
+
+scripts/benchmark_backends.py measures where the crossover between them is.
+"""
+
+
+class ExecutorBackend:
+    PROCESSES = 'processes'
+    THREADS = 'threads'
+    HYBRID = 'hybrid'
+
+
+VALID_BACKENDS = [
+    ExecutorBackend.PROCESSES,
+    ExecutorBackend.THREADS,
+    ExecutorBackend.HYBRID,
+]
+
+DEFAULT_BACKEND = ExecutorBackend.PROCESSES
+
+# reductions are fast compared to the reads, a few processes keep up with
+# many I/O threads
+MAX_REDUCE_WORKERS = 4
+
+
+def get_n_reduce_workers(n_workers:int):
+    return max(1, min(MAX_REDUCE_WORKERS, n_workers // 4))
+
+
+def hybrid_imap(
+    io_pool,
+    reduce_pool,
+    load_func,
+    reduce_func,
+    iterable,
+    plan:ws.WorkerPlan,
+    n_reduce_workers:int,
+):
+    """
+    Ordered reduce_func(load_func(arg)) for each arg of iterable, with
+    load_func run on io_pool and reduce_func on reduce_pool. The number of
+    loaded arrays waiting for a reduction is bounded by twice
+    n_reduce_workers, which also limits a larger reduce_pool to about
+    n_reduce_workers busy processes.
+    """
+    max_pending = 2 * n_reduce_workers
+    pending_results = collections.deque()
+    for loaded in ws.adaptive_imap(
+        pool = io_pool,
+        func = load_func,
+        iterable = iterable,
+        plan = plan,
+    ):
+        pending_results.append(reduce_pool.apply_async(reduce_func, (loaded,)))
+        while len(pending_results) > max_pending:
+            yield pending_results.popleft().get()
+    while len(pending_results) > 0:
+        yield pending_results.popleft().get()
+
+
+def backend_imap(
+    stack,
+    backend:str,
+    plan:ws.WorkerPlan,
+    func,
+    iterable,
+    pool = None,
+    load_func = None,
+    reduce_func = None,
+):
+    """
+    Ordered func(arg) for each arg of iterable using backend, with the pools
+    it needs entered on stack (a contextlib.ExitStack). pool is an existing
+    process pool used instead of a new one for processes, and for the
+    reductions of hybrid, which keep get_n_reduce_workers(plan.n_workers) of
+    its processes busy whatever its size. hybrid needs load_func and
+    reduce_func such that func(arg) == reduce_func(load_func(arg)), without
+    them it is the same as threads.
+    """
+    if backend not in VALID_BACKENDS:
+        raise ValueError(f'Invalid backend={backend}. Must be from {VALID_BACKENDS}.')
+
+    if backend == ExecutorBackend.PROCESSES:
+        p = pool if pool is not None else stack.enter_context(mp.Pool(plan.n_workers))
+        return ws.adaptive_imap(pool=p, func=func, iterable=iterable, plan=plan)
+
+    io_pool = stack.enter_context(mp.pool.ThreadPool(plan.n_workers))
+
+    if backend == ExecutorBackend.THREADS or load_func is None or reduce_func is None:
+        return ws.adaptive_imap(pool=io_pool, func=func, iterable=iterable, plan=plan)
+
+    n_reduce_workers = get_n_reduce_workers(n_workers=plan.n_workers)
+    reduce_pool = pool if pool is not None else stack.enter_context(
+        mp.Pool(n_reduce_workers)
+    )
+    return hybrid_imap(
+        io_pool = io_pool,
+        reduce_pool = reduce_pool,
+        load_func = load_func,
+        reduce_func = reduce_func,
+        iterable = iterable,
+        plan = plan,
+        n_reduce_workers = n_reduce_workers,
+    )
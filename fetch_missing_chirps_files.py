@@ -1,23 +1,34 @@
+from __future__ import annotations
+
 import os
-import pandas as pd
 import datetime
-import tqdm
-import affine
-import rasterio
-import multiprocessing as mp
+import warnings
+import contextlib
+
+from lazy_imports import lazy_import
+
+pd = lazy_import('pandas')
+gpd = lazy_import('geopandas')
+tqdm = lazy_import('tqdm')
+affine = lazy_import('affine')
+rasterio = lazy_import('rasterio')
 
-import chcfetch.chcfetch as chcfetch
-import rsutils.utils as utils
+import worker_sizing as ws
+import executors as ex
+import progress_metrics as pm
+
+chcfetch = lazy_import('chcfetch.chcfetch')
+# regional_archive and download_integrity import this module
+ra = lazy_import('regional_archive')
+di = lazy_import('download_integrity')
+chcfetch_constants = lazy_import('chcfetch.constants')
+utils = lazy_import('rsutils.utils')
 
 
 """
 Notes: CHIRPS prelim files for dates 2024-05-16 to 2024-05-20 are not available as of 2024-10-09
 """
 
-# https://stackoverflow.com/questions/18603270/progress-indicator-during-pandas-operations
-tqdm.tqdm.pandas()
-
-
 COL_TIF_FILEPATH = 'tif_filepath'
 COL_FILETYPE = 'filetype'
 COL_DATE = 'date'
@@ -27,6 +38,8 @@ COL_IS_CORRUPTED = 'is_corrupted'
 COL_TYPE_OF_CORRUPTION = 'type_of_corruption'
 COL_MULTIPLIER = 'multiplier'
 COL_SOURCE = 'source'
+COL_PRODUCT = 'product'
+COL_RECOMPUTE = 'recompute'
 
 EXT_TIF = '.tif'
 EXT_TIF_GZ = '.tif.gz'
@@ -34,6 +47,22 @@ EXT_TIF_GZ = '.tif.gz'
 SOURCE_CHC = 'chc'
 SOURCE_GEOGLAM = 'geoglam'
 
+# same as chcfetch.Products.CHIRPS.P05 and chcfetch.Products.CHIRPS.PRELIM,
+# kept here so that the scripts can build their argparse help without
+# importing chcfetch.
+PRODUCT_P05 = 'p05'
+PRODUCT_PRELIM = 'prelim'
+VALID_PRODUCTS = [PRODUCT_P05, PRODUCT_PRELIM]
+# catalogue of p05 files where available and prelim files for the remaining
+# dates, see merge_catalogues_by_priority
+PRODUCT_MERGED = 'merged'
+# earlier is preferred
+PRODUCT_PRIORITY = [PRODUCT_P05, PRODUCT_PRELIM]
+
+# see download_integrity.py
+DEFAULT_DOWNLOAD_MAX_RETRIES = 3
+DEFAULT_DOWNLOAD_BACKOFF_SECONDS = 10
+
 CHIRPS_P05_FIRST_DATE = datetime.datetime(1981, 1, 1)
 CHIRPS_PRELIM_FIRST_DATE = datetime.datetime(2015, 1, 1)
 
@@ -154,6 +183,125 @@ def generate_chc_chirps_catalogue_df(
     return catalogue_df
 
 
+def merge_catalogues_by_priority(
+    product_catalogue_dfs:dict[str,pd.DataFrame],
+    product_priority:list[str] = PRODUCT_PRIORITY,
+    date_col:str = COL_DATE,
+    product_col:str = COL_PRODUCT,
+):
+    """
+    Merges the catalogues of several products into one with a single row per
+    date, taken from the product that comes first in product_priority. The
+    product each row was taken from is recorded in product_col.
+    """
+    invalid_products = set(product_catalogue_dfs.keys()) - set(product_priority)
+    if len(invalid_products) > 0:
+        raise ValueError(f'Products {invalid_products} not in product_priority={product_priority}.')
+
+    catalogue_dfs = []
+    for product, catalogue_df in product_catalogue_dfs.items():
+        if catalogue_df.shape[0] == 0:
+            continue
+        catalogue_df = catalogue_df.copy()
+        catalogue_df[product_col] = product
+        catalogue_dfs.append(catalogue_df)
+
+    if len(catalogue_dfs) == 0:
+        return pd.DataFrame()
+
+    merged_catalogue_df = pd.concat(catalogue_dfs, ignore_index=True)
+    merged_catalogue_df[product_col] = pd.Categorical(
+        merged_catalogue_df[product_col],
+        categories = product_priority,
+        ordered = True,
+    )
+    merged_catalogue_df = merged_catalogue_df.sort_values(
+        by = [date_col, product_col],
+        kind = 'stable',
+    ).drop_duplicates(
+        subset = date_col,
+        keep = 'first',
+    ).reset_index(drop=True)
+    merged_catalogue_df[product_col] = merged_catalogue_df[product_col].astype(str)
+
+    return merged_catalogue_df
+
+
+def generate_merged_chc_chirps_catalogue_df(
+    p05_folderpath:str,
+    prelim_folderpath:str,
+    tif_filepath_col:str = COL_TIF_FILEPATH,
+    product_col:str = COL_PRODUCT,
+):
+    """
+    Catalogue with the p05 file for each date where one has been downloaded
+    and the prelim file otherwise, so that historical and recent dates can be
+    processed in one pass.
+    """
+    return merge_catalogues_by_priority(
+        product_catalogue_dfs = {
+            PRODUCT_P05: generate_chc_chirps_catalogue_df(
+                folderpath = p05_folderpath,
+                tif_filepath_col = tif_filepath_col,
+            ),
+            PRODUCT_PRELIM: generate_chc_chirps_catalogue_df(
+                folderpath = prelim_folderpath,
+                tif_filepath_col = tif_filepath_col,
+            ),
+        },
+        product_col = product_col,
+    )
+
+
+def add_recompute_col(
+    catalogue_df:pd.DataFrame,
+    previous_df:pd.DataFrame,
+    product_priority:list[str] = PRODUCT_PRIORITY,
+    date_col:str = COL_DATE,
+    product_col:str = COL_PRODUCT,
+    recompute_col:str = COL_RECOMPUTE,
+):
+    """
+    previous_df holds the dates and products of an earlier run (e.g. an
+    exported csv). Flags the dates of catalogue_df that were not in
+    previous_df, or whose file is now from a product with a higher priority
+    than the one used previously (e.g. a prelim date for which the p05 file
+    has since been downloaded).
+    """
+    priority_dict = {product: rank for rank, product in enumerate(product_priority)}
+
+    previous_rank = pd.Series(
+        data = previous_df[product_col].map(priority_dict).to_numpy(),
+        index = pd.to_datetime(previous_df[date_col]),
+    )
+    previous_rank = previous_rank[~previous_rank.index.duplicated(keep='last')]
+
+    current_rank = catalogue_df[product_col].map(priority_dict)
+    matched_previous_rank = previous_rank.reindex(
+        pd.to_datetime(catalogue_df[date_col])
+    ).to_numpy()
+
+    catalogue_df[recompute_col] = pd.isna(matched_previous_rank) \
+        | (current_rank.to_numpy() < matched_previous_rank)
+
+    return catalogue_df
+
+
+def get_gdal_filepath(filepath:str, filetype:str = None):
+    """
+    Path that rasterio can open directly. .tif.gz files are read through
+    GDAL's /vsigzip/ handler, without decompressing them to disk.
+    """
+    if filetype is None:
+        filetype = EXT_TIF_GZ if filepath.endswith(EXT_TIF_GZ) else EXT_TIF
+    if filetype == EXT_TIF:
+        return filepath
+    elif filetype == EXT_TIF_GZ:
+        return '/vsigzip/' + os.path.abspath(filepath)
+    else:
+        raise NotImplementedError(f'New filetype: {filetype}')
+
+
 def check_if_corrupted(tif_filepath):
     is_corrupted = False
     type_of_corruption = None
@@ -164,7 +312,7 @@ def check_if_corrupted(tif_filepath):
     INVALID_TRANSFORM = affine.Affine(1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
 
     try:
-        with rasterio.open(tif_filepath) as src:
+        with rasterio.open(get_gdal_filepath(filepath=tif_filepath)) as src:
             out_meta = src.meta.copy()
         if out_meta['transform'] == INVALID_TRANSFORM:
             is_corrupted = True
@@ -181,17 +329,53 @@ def add_tif_corruption_cols(
     tif_filepath_col:str = COL_TIF_FILEPATH,
     is_corrupted_col:str = COL_IS_CORRUPTED,
     type_of_corruption_col:str = COL_TYPE_OF_CORRUPTION,
-    njobs:int=mp.cpu_count() - 2,
+    njobs:int = ws.DEFAULT_NJOBS,
+    pool = None,
+    backend:str = ex.DEFAULT_BACKEND,
 ):
+    """
+    backend selects processes or threads (see executors.py), the check is
+    pure I/O so hybrid is the same as threads. pool is only used by
+    processes.
+    """
     if catalogue_df.shape[0] == 0:
         catalogue_df[is_corrupted_col] = []
         catalogue_df[type_of_corruption_col] = []
         return catalogue_df
 
-    with mp.Pool(njobs) as p:
-        list_corrupt_stats = list(tqdm.tqdm(
-            p.imap(check_if_corrupted, catalogue_df[tif_filepath_col]), 
-            total=catalogue_df.shape[0])
+    tif_filepaths = list(catalogue_df[tif_filepath_col])
+    njobs = ws.resolve_njobs(njobs)
+    task_bytes = None
+    # results of the first files computed by the memory probe
+    probed_stats = []
+    if njobs > 1 and len(tif_filepaths) > 1:
+        task_bytes = ws.get_measured_task_bytes(key=('check_if_corrupted',))
+        if task_bytes is None:
+            probed_stat, task_bytes = ws.probe_task(
+                func = check_if_corrupted,
+                arg = tif_filepaths[0],
+                key = ('check_if_corrupted',),
+                in_process = backend != ex.ExecutorBackend.PROCESSES,
+            )
+            probed_stats.append(probed_stat)
+    plan = ws.plan_workers(
+        n_tasks = len(tif_filepaths),
+        njobs = njobs,
+        task_bytes = task_bytes,
+        label = f'add_tif_corruption_cols ({backend})',
+    )
+
+    with contextlib.ExitStack() as stack:
+        list_corrupt_stats = probed_stats + list(tqdm.tqdm(
+            ex.backend_imap(
+                stack = stack,
+                backend = backend,
+                plan = plan,
+                func = check_if_corrupted,
+                iterable = tif_filepaths[len(probed_stats):],
+                pool = pool,
+            ),
+            total=catalogue_df.shape[0] - len(probed_stats))
         )
 
     is_corrupted_series, type_of_corruption_series = zip(*list_corrupt_stats)
@@ -244,15 +428,34 @@ def fetch_missing_chirps_files(
     years:list[int],
     product:str,
     chc_chirps_download_folderpath:str,
-    njobs:int = mp.cpu_count() - 2,
+    njobs:int = ws.DEFAULT_NJOBS,
     overwrite:bool = False,
     tif_filepath_col:str = COL_TIF_FILEPATH,
     before_date:datetime.datetime = None,
+    regional_archive_folderpath:str = None,
+    max_retries:int = DEFAULT_DOWNLOAD_MAX_RETRIES,
+    backoff_seconds:float = DEFAULT_DOWNLOAD_BACKOFF_SECONDS,
+    metrics:pm.ProgressMetrics = None,
 ):
-    VALID_PRODUCTS = [chcfetch.Products.CHIRPS.P05, chcfetch.Products.CHIRPS.PRELIM]
+    """
+    Downloaded files are verified before they are moved into
+    chc_chirps_download_folderpath, failed downloads are retried up to
+    max_retries times, see download_integrity.py. Dates that already have a
+    file in chc_chirps_download_folderpath are skipped, unless overwrite, in
+    which case every date of years is downloaded again. An existing file is
+    only replaced once its new download is verified, and is kept otherwise.
+
+    If regional_archive_folderpath is given, the regional archives of product
+    in it are brought up to date with the files of years, see
+    regional_archive.py.
+
+    metrics (see progress_metrics.py) follows the downloads.
+    """
     if product not in VALID_PRODUCTS:
         raise ValueError(f'Invalid product. Must be from {VALID_PRODUCTS}')
 
+    njobs = ws.resolve_njobs(njobs)
+
     print('Creating CHIRPS local catalogue.')
 
     chc_chirps_catalogue_df = generate_chc_chirps_catalogue_df(
@@ -260,7 +463,10 @@ def fetch_missing_chirps_files(
         tif_filepath_col = tif_filepath_col,
     )
 
-    catalogue_df = catalogue_df[catalogue_df[COL_YEAR].isin(years)]
+    if chc_chirps_catalogue_df.shape[0] > 0:
+        chc_chirps_catalogue_df = chc_chirps_catalogue_df[
+            chc_chirps_catalogue_df[COL_YEAR].isin(years)
+        ]
 
     valid_downloads_df = chc_chirps_catalogue_df
 
@@ -268,12 +474,12 @@ def fetch_missing_chirps_files(
         before_date = datetime.datetime.today()
 
     first_date = {
-        'p05': CHIRPS_P05_FIRST_DATE,
-        'prelim': CHIRPS_PRELIM_FIRST_DATE,
+        PRODUCT_P05: CHIRPS_P05_FIRST_DATE,
+        PRODUCT_PRELIM: CHIRPS_PRELIM_FIRST_DATE,
     }[product]
 
     missing_dates = get_missing_dates(
-        dates = valid_downloads_df[COL_DATE],
+        dates = valid_downloads_df[COL_DATE] if valid_downloads_df.shape[0] > 0 else [],
         years = years,
         first_date = first_date,
         before_date = before_date,
@@ -285,6 +491,14 @@ def fetch_missing_chirps_files(
         missing_years = list({date.year for date in missing_dates})
         missing_years.sort()
 
+    if overwrite:
+        missing_years = [
+            year for year in sorted(set(years))
+            if first_date.year <= year <= before_date.year
+        ]
+        if len(missing_years) == 0:
+            missing_years = None
+
     pending_downloads_df = None
     if missing_years is not None:
         print(f"Querying CHC for {product} CHIRPS files for missing years={missing_years}")
@@ -298,7 +512,7 @@ def fetch_missing_chirps_files(
         chc_fetch_paths_df[COL_SOURCE] = SOURCE_CHC
         chc_fetch_paths_df[COL_MULTIPLIER] = 1 # from source so no multiplier
 
-        if valid_downloads_df.shape[0] > 0:
+        if valid_downloads_df.shape[0] > 0 and not overwrite:
             pending_downloads_df = chc_fetch_paths_df[
                 ~chc_fetch_paths_df[COL_DATE].isin(valid_downloads_df[COL_DATE])
             ]
@@ -310,22 +524,101 @@ def fetch_missing_chirps_files(
     if pending_downloads_df is not None and pending_downloads_df.shape[0] > 0:
         print(f'Number of files that need to be downloaded: {pending_downloads_df.shape[0]}')
 
-        pending_downloads_df = chcfetch.download_files_from_paths_df(
+        pending_downloads_df = di.download_and_verify_files(
             paths_df = pending_downloads_df,
             download_folderpath = chc_chirps_download_folderpath,
             njobs = njobs,
             download_filepath_col = tif_filepath_col,
-            overwrite = overwrite,
+            max_retries = max_retries,
+            backoff_seconds = backoff_seconds,
+            metrics = metrics,
         )
         pending_downloads_df[COL_FILETYPE] = EXT_TIF_GZ
 
+        if valid_downloads_df.shape[0] > 0:
+            # with overwrite, the dates whose new download failed keep their file
+            valid_downloads_df = valid_downloads_df[
+                ~valid_downloads_df[COL_DATE].isin(pending_downloads_df[COL_DATE])
+            ]
+
         merged_catalogue_df = pd.concat([
             pending_downloads_df[keep_cols],
-            valid_downloads_df[keep_cols],
+            valid_downloads_df[keep_cols] if valid_downloads_df.shape[0] > 0 
+            else pd.DataFrame(columns=keep_cols),
         ]).sort_values(by=COL_DATE, ascending=True).reset_index(drop=True)
-    else:
+    elif valid_downloads_df.shape[0] > 0:
         merged_catalogue_df = valid_downloads_df[keep_cols]
+    else:
+        merged_catalogue_df = pd.DataFrame(columns=keep_cols)
 
     merged_catalogue_df = merged_catalogue_df[merged_catalogue_df[COL_DATE] <= before_date]
 
+    if regional_archive_folderpath is not None:
+        ra.update_regional_archives(
+            archive_folderpath = regional_archive_folderpath,
+            product = product,
+            catalogue_df = merged_catalogue_df,
+            tif_filepath_col = tif_filepath_col,
+            njobs = njobs,
+        )
+
     return merged_catalogue_df
+
+
+def filter_catalogue_by_date_range(
+    catalogue_df:pd.DataFrame,
+    start_date:datetime.datetime,
+    end_date:datetime.datetime,
+    if_missing_dates:str = 'raise',
+    date_col:str = COL_DATE,
+):
+    """
+    Keeps the rows with start_date <= date <= end_date. if_missing_dates
+    decides what happens if some dates in the range are missing: 'raise',
+    'warn' or 'ignore'. Raises an error if no files are present regardless.
+    """
+    VALID_IF_MISSING_DATES = ['raise', 'warn', 'ignore']
+    if if_missing_dates not in VALID_IF_MISSING_DATES:
+        raise ValueError(f'Invalid if_missing_dates={if_missing_dates}. Must be from {VALID_IF_MISSING_DATES}.')
+
+    if catalogue_df.shape[0] == 0:
+        raise ValueError('No files present in the catalogue.')
+
+    catalogue_df = catalogue_df[
+        (catalogue_df[date_col] >= start_date) &
+        (catalogue_df[date_col] <= end_date)
+    ]
+
+    if catalogue_df.shape[0] == 0:
+        raise ValueError(
+            f"No files present between {start_date.strftime('%Y-%m-%d')} "
+            f"and {end_date.strftime('%Y-%m-%d')}."
+        )
+
+    # start_date and end_date both are included
+    total_days_expected = (end_date - start_date).days + 1
+    missing_dates_count = total_days_expected - catalogue_df.shape[0]
+    if missing_dates_count > 0:
+        if if_missing_dates == 'raise':
+            raise ValueError(f'{missing_dates_count} dates missing.')
+        if if_missing_dates == 'warn':
+            warnings.warn(message = f'{missing_dates_count} dates missing.',
+                          category = RuntimeWarning)
+
+    return catalogue_df
+
+
+def check_if_any_geom_within_chirps_bounds(
+    shapes_gdf:gpd.GeoDataFrame
+):
+    chirps_bounds_gdf = gpd.read_file(
+        chcfetch_constants.CHIRPS_V2_P50_BOUNDS_GEOJSON_FILEPATH
+    )
+
+    chirps_bounds_epsg_4326 = chirps_bounds_gdf['geometry'].iloc[0]
+    
+    any_roi_within_chirps_bounds = shapes_gdf.to_crs(
+        chirps_bounds_gdf.crs
+    ).within(chirps_bounds_epsg_4326).any()
+
+    return any_roi_within_chirps_bounds
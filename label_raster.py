@@ -0,0 +1,251 @@
+from __future__ import annotations
+
+import os
+import math
+import hashlib
+import numpy as np
+
+from lazy_imports import lazy_import
+
+rasterio = lazy_import('rasterio', submodules=['features', 'windows'])
+
+
+"""
+Grouped reductions of a raster over many geometries at once.
+
+All geometries are rasterized once onto the raster grid, restricted to the
+window that covers all of them (the union window). The result is kept as a
+sparse label raster: a pair of arrays (pixel_index, label) where pixel_index
+is the flat index of a pixel inside the union window and label the index of
+the geometry it belongs to. A pixel covered by overlapping geometries simply
+appears once per geometry. For each date the reduction for every geometry is
+then one read of the union window plus a few numpy passes (np.bincount for
+mean / sum / count, a lexsort for median), independent of the number of
+geometries.
+
+Pixels are assigned to a geometry if their centre is inside the geometry,
+which is the rasterio.mask default used by rsutils.utils.crop_tif.
+"""
+
+
+KEY_WINDOW = 'window' # row_off, col_off, height, width
+KEY_PIXEL_INDEX = 'pixel_index'
+KEY_LABELS = 'labels'
+KEY_CENTRE_INDEX = 'centre_index'
+KEY_N_LABELS = 'n_labels'
+
+GROUPED_AGGREGATIONS = ['mean', 'median', 'centre', 'sum', 'count']
+
+# label pixels loaded by this process, by filepath, see load_label_pixels
+_loaded_label_pixels = {}
+
+
+def get_pixel_window(
+    bounds:tuple[float,float,float,float],
+    transform,
+):
+    """
+    Window (row_off, col_off, height, width) of the pixels touched by bounds,
+    unclipped. Same as what rasterio.mask.mask(crop=True) would crop to.
+    """
+    inv_transform = ~transform
+    minx, miny, maxx, maxy = bounds
+    cols, rows = zip(*[
+        inv_transform * (x, y)
+        for x, y in [(minx, miny), (minx, maxy), (maxx, miny), (maxx, maxy)]
+    ])
+    row_off = math.floor(min(rows))
+    col_off = math.floor(min(cols))
+    height = max(math.ceil(max(rows)) - row_off, 1)
+    width = max(math.ceil(max(cols)) - col_off, 1)
+    return row_off, col_off, height, width
+
+
+def _clip_window(window:tuple, raster_height:int, raster_width:int):
+    row_off, col_off, height, width = window
+    row_start, col_start = max(row_off, 0), max(col_off, 0)
+    row_stop = min(row_off + height, raster_height)
+    col_stop = min(col_off + width, raster_width)
+    if row_stop <= row_start or col_stop <= col_start:
+        return None
+    return row_start, col_start, row_stop - row_start, col_stop - col_start
+
+
+def build_label_pixels(
+    geometries:list,
+    transform,
+    raster_height:int,
+    raster_width:int,
+):
+    """
+    geometries are shapely geometries in the crs of the raster.
+    """
+    n_labels = len(geometries)
+    if n_labels == 0:
+        raise ValueError('No geometries to rasterize.')
+
+    geom_windows = [
+        get_pixel_window(bounds=geom.bounds, transform=transform)
+        for geom in geometries
+    ]
+    clipped_geom_windows = [
+        _clip_window(window=window, raster_height=raster_height, raster_width=raster_width)
+        for window in geom_windows
+    ]
+    valid_windows = [window for window in clipped_geom_windows if window is not None]
+    if len(valid_windows) == 0:
+        raise ValueError('None of the geometries overlap the raster.')
+
+    union_row_off = min(window[0] for window in valid_windows)
+    union_col_off = min(window[1] for window in valid_windows)
+    union_height = max(window[0] + window[2] for window in valid_windows) - union_row_off
+    union_width = max(window[1] + window[3] for window in valid_windows) - union_col_off
+
+    pixel_index_list = []
+    labels_list = []
+    centre_index = np.full(n_labels, -1, dtype=np.int64)
+
+    for label, (geom, clipped_geom_window) in enumerate(zip(geometries, clipped_geom_windows)):
+        if clipped_geom_window is None or geom.is_empty:
+            continue
+
+        row_off, col_off, height, width = clipped_geom_window
+        geom_transform = transform * transform.translation(col_off, row_off)
+
+        # same pixel that get_centre_value picks from the crop of the
+        # geometry's envelope, which is NaN when that pixel falls outside the
+        # envelope's mask. rasterio.mask.mask crops to the window clipped to
+        # the raster, so the centre is that of the clipped window.
+        centre_flat = (height * width) // 2
+        is_centre_in_envelope = not rasterio.features.geometry_mask(
+            geometries = [geom.envelope],
+            out_shape = (height, width),
+            transform = geom_transform,
+        ).ravel()[centre_flat]
+        if is_centre_in_envelope:
+            centre_row = row_off + centre_flat // width
+            centre_col = col_off + centre_flat % width
+            centre_index[label] = (centre_row - union_row_off) * union_width \
+                + (centre_col - union_col_off)
+
+        inside = ~rasterio.features.geometry_mask(
+            geometries = [geom],
+            out_shape = (height, width),
+            transform = geom_transform,
+        )
+        rows, cols = np.nonzero(inside)
+        pixel_index_list.append(
+            (rows + row_off - union_row_off) * union_width
+            + (cols + col_off - union_col_off)
+        )
+        labels_list.append(np.full(rows.shape[0], label, dtype=np.int64))
+
+    pixel_index = np.concatenate(pixel_index_list) if len(pixel_index_list) > 0 \
+        else np.zeros(0, dtype=np.int64)
+    labels = np.concatenate(labels_list) if len(labels_list) > 0 \
+        else np.zeros(0, dtype=np.int64)
+
+    return {
+        KEY_WINDOW: np.array([union_row_off, union_col_off, union_height, union_width], dtype=np.int64),
+        KEY_PIXEL_INDEX: pixel_index.astype(np.int64),
+        KEY_LABELS: labels,
+        KEY_CENTRE_INDEX: centre_index,
+        KEY_N_LABELS: np.array(n_labels, dtype=np.int64),
+    }
+
+
+def get_rasterio_window(label_pixels:dict):
+    row_off, col_off, height, width = [int(x) for x in label_pixels[KEY_WINDOW]]
+    return rasterio.windows.Window(col_off, row_off, width, height)
+
+
+def grouped_reduce(
+    window_values:np.ndarray,
+    label_pixels:dict,
+    aggregation:str,
+):
+    """
+    window_values is the raster read for the union window, with nodata already
+    set to NaN. Returns an array with one value per geometry.
+    """
+    n_labels = int(label_pixels[KEY_N_LABELS])
+    flat_values = window_values.ravel()
+
+    if aggregation == 'centre':
+        centre_index = label_pixels[KEY_CENTRE_INDEX]
+        out = np.full(n_labels, np.nan)
+        has_centre = centre_index >= 0
+        out[has_centre] = flat_values[centre_index[has_centre]]
+        return out
+
+    values = flat_values[label_pixels[KEY_PIXEL_INDEX]]
+    labels = label_pixels[KEY_LABELS]
+    is_valid = ~np.isnan(values)
+    values = values[is_valid]
+    labels = labels[is_valid]
+
+    counts = np.bincount(labels, minlength=n_labels)
+
+    if aggregation == 'count':
+        return counts
+
+    if aggregation in ['mean', 'sum']:
+        sums = np.bincount(labels, weights=values, minlength=n_labels)
+        if aggregation == 'sum':
+            return np.where(counts > 0, sums, np.nan)
+        return np.divide(
+            sums, counts, out=np.full(n_labels, np.nan), where=counts > 0,
+        )
+
+    if aggregation == 'median':
+        order = np.lexsort((values, labels))
+        sorted_values = values[order]
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        has_values = counts > 0
+        lower = starts + (counts - 1) // 2
+        upper = starts + counts // 2
+        out = np.full(n_labels, np.nan)
+        out[has_values] = (
+            sorted_values[lower[has_values]] + sorted_values[upper[has_values]]
+        ) / 2
+        return out
+
+    raise ValueError(f'Invalid aggregation={aggregation}. Valid aggregations: {GROUPED_AGGREGATIONS}')
+
+
+def save_label_pixels(label_pixels:dict, folderpath:str):
+    """
+    Saves label_pixels to a content-addressed npz file so that workers can
+    load it once (see load_label_pixels) instead of it being pickled with
+    every task.
+    """
+    sha256 = hashlib.sha256()
+    for key in sorted(label_pixels.keys()):
+        sha256.update(key.encode())
+        sha256.update(np.ascontiguousarray(label_pixels[key]).tobytes())
+    os.makedirs(folderpath, exist_ok=True)
+    filepath = os.path.join(folderpath, f'label_pixels_{sha256.hexdigest()[:16]}.npz')
+    if not os.path.exists(filepath):
+        tmp_filepath = filepath + f'.{os.getpid()}.tmp.npz'
+        np.savez(tmp_filepath, **label_pixels)
+        os.replace(tmp_filepath, filepath)
+    return filepath
+
+
+def load_label_pixels(filepath:str):
+    """
+    Loads filepath once per process and keeps it for the following tasks,
+    whatever the order they come in, so that every cluster of a run is read
+    from disk once per worker. The files of a finished run are removed (see
+    rtcm.read_tifs_get_agg_values_by_geometry), their entries are dropped on
+    the next load.
+    """
+    label_pixels = _loaded_label_pixels.get(filepath)
+    if label_pixels is None:
+        for _filepath in list(_loaded_label_pixels.keys()):
+            if not os.path.exists(_filepath):
+                _loaded_label_pixels.pop(_filepath, None)
+        with np.load(filepath) as npz:
+            label_pixels = {key: npz[key] for key in npz.files}
+        _loaded_label_pixels[filepath] = label_pixels
+    return label_pixels
@@ -0,0 +1,55 @@
+import types
+import importlib
+
+
+"""
+geopandas, rasterio, pandas and tqdm together take seconds to import, which
+is paid by every script invocation (even --help) and by every spawned worker.
+lazy_import returns a placeholder module that only imports the real module on
+first attribute access, so the heavy dependencies are loaded only in the code
+paths that use them.
+
+Modules using this need `from __future__ import annotations` so that type
+hints like gpd.GeoDataFrame are not evaluated at function definition time.
+"""
+
+
+class LazyModule(types.ModuleType):
+    def __init__(self, name:str, submodules:list[str] = None):
+        super().__init__(name)
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_submodules'] = submodules or []
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            name = self.__dict__['_lazy_name']
+            module = importlib.import_module(name)
+            for submodule in self.__dict__['_lazy_submodules']:
+                importlib.import_module(f'{name}.{submodule}')
+            self.__dict__['_lazy_module'] = module
+            # so that subsequent attribute lookups skip __getattr__
+            self.__dict__.update(module.__dict__)
+        return module
+
+    def __getattr__(self, attr:str):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if self.__dict__['_lazy_module'] is None:
+            return f"<lazy module '{self.__dict__['_lazy_name']}' (not loaded)>"
+        return repr(self.__dict__['_lazy_module'])
+
+
+def lazy_import(name:str, submodules:list[str] = None):
+    """
+    Equivalent of `import name` (plus `import name.submodule` for each of
+    submodules) where the import is deferred until an attribute of the
+    returned module is accessed. Dotted names are supported, e.g.
+    lazy_import('rsutils.utils').
+    """
+    return LazyModule(name=name, submodules=submodules)
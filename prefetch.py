@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import os
+import threading
+import collections
+import concurrent.futures
+
+
+"""
+Read-ahead of the files of a catalogue on background threads, so that the
+latency of a shared filesystem (GPFS, NFS) overlaps with the processing of the
+previous files instead of idling the workers. The raw (still compressed)
+bytes of the next max_files files are read into memory, bounded by max_bytes,
+and handed out in catalogue order. The workers then open them from memory
+(see rtcm.read_tif_load_agg_inputs), so results are the same as reading from
+disk.
+
+The bytes handed out stay counted against max_bytes until release() is
+called, which the consumer does as each result comes back (in order), as
+that is when the task and its bytes are dropped. A file whose turn comes
+while the budget is exhausted is handed out without bytes, and read from
+disk by the worker as before, rather than blocking.
+"""
+
+
+DEFAULT_PREFETCH_MAX_BYTES = 512 * 2**20
+DEFAULT_PREFETCH_THREADS = 4
+
+
+def read_file_bytes(filepath:str):
+    with open(filepath, 'rb') as f:
+        return f.read()
+
+
+class Prefetcher:
+    def __init__(
+        self,
+        filepaths:list[str],
+        max_files:int,
+        max_bytes:int = DEFAULT_PREFETCH_MAX_BYTES,
+        n_threads:int = DEFAULT_PREFETCH_THREADS,
+    ):
+        self.filepaths = list(filepaths)
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_threads)
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._reserved_bytes = 0
+        self._estimated_file_bytes = None
+        self._next_schedule_index = 0
+        self._next_yield_index = 0
+        # bytes of the files handed out and not yet released, in order
+        self._handed_out_bytes = collections.deque()
+        self.n_prefetched = 0
+
+    def _read(self, filepath:str, estimated_bytes:int):
+        file_bytes = read_file_bytes(filepath)
+        with self._lock:
+            self._reserved_bytes += len(file_bytes) - estimated_bytes
+            self._estimated_file_bytes = len(file_bytes)
+        return file_bytes
+
+    def _schedule(self):
+        if self._estimated_file_bytes is None and len(self.filepaths) > 0:
+            # until the first read completes
+            try:
+                self._estimated_file_bytes = os.path.getsize(self.filepaths[0])
+            except OSError:
+                self._estimated_file_bytes = 0
+        with self._lock:
+            self._next_schedule_index = max(self._next_schedule_index, self._next_yield_index)
+            while self._next_schedule_index < len(self.filepaths) \
+                and self._next_schedule_index < self._next_yield_index + self.max_files \
+                and self._reserved_bytes < self.max_bytes:
+                index = self._next_schedule_index
+                estimated_bytes = self._estimated_file_bytes
+                self._reserved_bytes += estimated_bytes
+                self._futures[index] = (self._executor.submit(
+                    self._read, self.filepaths[index], estimated_bytes,
+                ), estimated_bytes)
+                self._next_schedule_index += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Returns (filepath, file_bytes) with file_bytes None if the file was
+        not prefetched.
+        """
+        self._schedule()
+        index = self._next_yield_index
+        if index >= len(self.filepaths):
+            raise StopIteration
+        future, estimated_bytes = self._futures.pop(index, (None, 0))
+        file_bytes = None
+        if future is not None:
+            try:
+                file_bytes = future.result()
+            except OSError:
+                # the worker reads it from disk and reports the error there
+                file_bytes = None
+        with self._lock:
+            if future is not None and file_bytes is None:
+                self._reserved_bytes -= estimated_bytes
+            self._handed_out_bytes.append(0 if file_bytes is None else len(file_bytes))
+            self._next_yield_index += 1
+        if file_bytes is not None:
+            self.n_prefetched += 1
+        self._schedule()
+        return self.filepaths[index], file_bytes
+
+    def release(self):
+        """
+        Releases the bytes of the oldest file handed out.
+        """
+        with self._lock:
+            if len(self._handed_out_bytes) > 0:
+                self._reserved_bytes -= self._handed_out_bytes.popleft()
+        self._schedule()
+
+    def close(self):
+        for future, _ in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        self._futures = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
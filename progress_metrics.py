@@ -0,0 +1,313 @@
+from __future__ import annotations
+
+import os
+import json
+import time
+import datetime
+import threading
+
+
+"""
+Running metrics of long runs (fetch, extraction), rewritten every
+interval_seconds to a status file that can be watched while the run is going,
+unlike the tqdm bars on stderr which end up in a scheduler log. The format
+follows the extension of the file:
+
+- .prom: Prometheus text format, for the node_exporter textfile collector,
+- anything else: JSON.
+
+The file is written to a temporary file and renamed, so readers never see a
+partial file. Reported:
+
+- files done (of which done without a read, e.g. cache hits), files expected,
+- source bytes: the whole size of each source file done, including the files
+  still being downloaded. An extraction usually reads only a window of each
+  file, so this is not the amount of data read, and cache or archive hits
+  add nothing,
+- files/s (cache and archive hits included) and source bytes/s over the last
+  interval, and averaged over the run,
+- worker utilization: busy seconds of the tasks / (elapsed seconds *
+  workers), see timed_call,
+- errors, ETA from the average rate, and the seconds since the last file was
+  done, which is what points at stalled reads or downloads.
+
+A single ProgressMetrics can be passed to several calls (e.g. one extraction
+per ROI), which then report into the same file.
+"""
+
+
+DEFAULT_INTERVAL_SECONDS = 15
+
+EXT_PROMETHEUS = '.prom'
+PROMETHEUS_PREFIX = 'chirps_'
+
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+METRIC_HELP = {
+    'elapsed_seconds': 'Seconds since the start of the run.',
+    'files_done': 'Files processed so far.',
+    'files_cached': 'Files done without being read (cache or archive hits).',
+    'files_total': 'Files expected in the run.',
+    'files_in_progress': 'Files being downloaded.',
+    'source_bytes': 'Total size of the source files done or being downloaded, not the bytes read.',
+    'files_per_second': 'Files done (cache and archive hits included) per second over the last interval.',
+    'source_bytes_per_second': 'source_bytes per second over the last interval.',
+    'avg_files_per_second': 'Files done (cache and archive hits included) per second since the start of the run.',
+    'avg_source_bytes_per_second': 'source_bytes per second since the start of the run.',
+    'worker_utilization': 'Busy seconds of the tasks / (elapsed seconds * workers).',
+    'n_workers': 'Number of workers.',
+    'errors': 'Errors so far, including failed download attempts that are retried.',
+    'eta_seconds': 'Estimated seconds until all files are done.',
+    'seconds_since_progress': 'Seconds since a file was last done.',
+    'updated_timestamp_seconds': 'Unix time of this update.',
+}
+
+
+def timed_call(func, arg):
+    """
+    (func(arg), seconds taken), for the busy time of the workers. Used as
+    functools.partial(timed_call, func) in place of func.
+    """
+    start_time = time.perf_counter()
+    result = func(arg)
+    return result, time.perf_counter() - start_time
+
+
+def timed_reduce(func, loaded_seconds:tuple):
+    """
+    Reduction step matching timed_call as the load step of the hybrid
+    backend, adds its own time to the load time.
+    """
+    loaded, seconds = loaded_seconds
+    start_time = time.perf_counter()
+    result = func(loaded)
+    return result, seconds + time.perf_counter() - start_time
+
+
+def get_folder_files_bytes(folderpath:str):
+    """
+    (number of files, total bytes) in folderpath and its subfolders, (0, 0) if
+    it does not exist.
+    """
+    n_files, n_bytes = 0, 0
+    for root, _, filenames in os.walk(folderpath):
+        for filename in filenames:
+            try:
+                n_bytes += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                continue
+            n_files += 1
+    return n_files, n_bytes
+
+
+def _format_prometheus_value(value):
+    if value is None:
+        return 'NaN'
+    return repr(float(value))
+
+
+def _format_prometheus_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class ProgressMetrics:
+    def __init__(
+        self,
+        filepath:str,
+        job:str,
+        total_files:int = None,
+        labels:dict = None,
+        interval_seconds:float = DEFAULT_INTERVAL_SECONDS,
+    ):
+        """
+        If total_files is None the functions the metrics are passed to add
+        the files they expect, see add_expected.
+        """
+        self.filepath = filepath
+        self.job = job
+        self.labels = {} if labels is None else dict(labels)
+        self.interval_seconds = interval_seconds
+
+        self.files_total = 0 if total_files is None else int(total_files)
+        self._is_total_fixed = total_files is not None
+        self.files_done = 0
+        self.files_cached = 0
+        self.source_bytes = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.n_workers = None
+        self.state = STATE_RUNNING
+        # returns (n_files, n_bytes) of the files in progress, see
+        # download_integrity.download_and_verify_files
+        self.in_progress_func = None
+
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._last_progress_time = self._start_time
+        self._last_sample = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self.write()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval_seconds):
+            try:
+                self.write()
+            except OSError as e:
+                print(f'Failed to write metrics to {self.filepath}: {e}')
+
+    def add_expected(self, n_files:int):
+        """
+        Adds n_files to the files expected, unless total_files was given.
+        """
+        with self._lock:
+            if not self._is_total_fixed:
+                self.files_total += int(n_files)
+
+    def set_total_files(self, n_files:int):
+        """
+        Fixes the files expected, add_expected has no effect afterwards.
+        """
+        with self._lock:
+            self.files_total = int(n_files)
+            self._is_total_fixed = True
+
+    def set_n_workers(self, n_workers:int):
+        with self._lock:
+            self.n_workers = n_workers
+
+    def add(
+        self,
+        n_files:int = 1,
+        source_bytes:int = 0,
+        busy_seconds:float = 0.0,
+        is_cached:bool = False,
+    ):
+        """
+        source_bytes is the size of the source file(s), whatever part of
+        them was read.
+        """
+        with self._lock:
+            self.files_done += n_files
+            if is_cached:
+                self.files_cached += n_files
+            self.source_bytes += source_bytes
+            self.busy_seconds += busy_seconds
+            if n_files > 0:
+                self._last_progress_time = time.time()
+
+    def add_errors(self, n_errors:int = 1):
+        with self._lock:
+            self.errors += n_errors
+
+    def get_metrics(self):
+        in_progress_func = self.in_progress_func
+        files_in_progress, bytes_in_progress = 0, 0
+        if in_progress_func is not None:
+            files_in_progress, bytes_in_progress = in_progress_func()
+
+        now = time.time()
+        with self._lock:
+            elapsed_seconds = max(now - self._start_time, 1e-9)
+            files_done = self.files_done
+            source_bytes = self.source_bytes + bytes_in_progress
+
+            files_per_second, source_bytes_per_second = None, None
+            if self._last_sample is not None:
+                sample_time, sample_files, sample_bytes = self._last_sample
+                if now - sample_time > 0:
+                    files_per_second = (files_done - sample_files) / (now - sample_time)
+                    source_bytes_per_second = (source_bytes - sample_bytes) / (now - sample_time)
+            self._last_sample = (now, files_done, source_bytes)
+
+            # files served from a cache take no time, left out of the rate
+            # the remaining files are estimated with
+            avg_files_per_second = files_done / elapsed_seconds
+            read_files_per_second = (files_done - self.files_cached) / elapsed_seconds
+            files_remaining = max(self.files_total - files_done, 0)
+            eta_seconds = None
+            if files_remaining == 0:
+                eta_seconds = 0
+            elif read_files_per_second > 0:
+                eta_seconds = files_remaining / read_files_per_second
+
+            worker_utilization = None
+            if self.n_workers is not None and self.n_workers > 0:
+                worker_utilization = self.busy_seconds / (elapsed_seconds * self.n_workers)
+
+            return {
+                'job': self.job,
+                'labels': self.labels,
+                'state': self.state,
+                'start_time': datetime.datetime.fromtimestamp(self._start_time).isoformat(),
+                'updated_time': datetime.datetime.fromtimestamp(now).isoformat(),
+                'elapsed_seconds': elapsed_seconds,
+                'files_done': files_done,
+                'files_cached': self.files_cached,
+                'files_total': self.files_total,
+                'files_in_progress': files_in_progress,
+                'source_bytes': source_bytes,
+                'files_per_second': files_per_second,
+                'source_bytes_per_second': source_bytes_per_second,
+                'avg_files_per_second': avg_files_per_second,
+                'avg_source_bytes_per_second': source_bytes / elapsed_seconds,
+                'worker_utilization': worker_utilization,
+                'n_workers': self.n_workers,
+                'errors': self.errors,
+                'eta_seconds': eta_seconds,
+                'seconds_since_progress': now - self._last_progress_time,
+                'updated_timestamp_seconds': now,
+            }
+
+    def to_prometheus(self, metrics:dict):
+        labels = {'job': self.job, 'state': metrics['state'], **self.labels}
+        labels_str = ','.join(
+            f'{key}="{_format_prometheus_label_value(value)}"'
+            for key, value in labels.items()
+        )
+        lines = []
+        for key, help_str in METRIC_HELP.items():
+            name = PROMETHEUS_PREFIX + key
+            lines.append(f'# HELP {name} {help_str}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name}{{{labels_str}}} {_format_prometheus_value(metrics[key])}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        metrics = self.get_metrics()
+        if self.filepath.endswith(EXT_PROMETHEUS):
+            content = self.to_prometheus(metrics=metrics)
+        else:
+            content = json.dumps(metrics, indent=4)
+        folderpath = os.path.split(self.filepath)[0]
+        if folderpath != '':
+            os.makedirs(folderpath, exist_ok=True)
+        # the textfile collector only reads *.prom, the temporary file is not
+        # picked up
+        tmp_filepath = f'{self.filepath}.{os.getpid()}.tmp'
+        with open(tmp_filepath, 'w') as f:
+            f.write(content)
+        os.replace(tmp_filepath, self.filepath)
+
+    def close(self, state:str = STATE_DONE):
+        with self._lock:
+            self.state = state
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.write()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(state=STATE_DONE if exc_type is None else STATE_FAILED)
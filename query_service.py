@@ -0,0 +1,623 @@
+from __future__ import annotations
+
+import os
+import io
+import json
+import time
+import hashlib
+import datetime
+import functools
+import threading
+import collections
+import socketserver
+import http.server
+import urllib.parse
+import multiprocessing.pool
+
+import numpy as np
+
+from lazy_imports import lazy_import
+
+pd = lazy_import('pandas')
+gpd = lazy_import('geopandas')
+shapely = lazy_import('shapely')
+rasterio = lazy_import('rasterio')
+pyproj = lazy_import('pyproj', submodules=['exceptions'])
+
+import fetch_missing_chirps_files as fmcf
+import read_tifs_create_met as rtcm
+import temporal_aggregation as ta
+import label_raster as lr
+import roi_planning as rp
+import tif_cache as tc
+import worker_sizing as ws
+
+
+"""
+Long-running local service answering "ROI geometry + date range +
+aggregation" queries, for dashboards and interactive users that would
+otherwise pay the interpreter start up, the catalogue scan and the pool start
+up of a script run for every request. Kept in memory across queries:
+
+- the catalogue of each product (and the merged one), rescanned on /reload,
+- the pixel indices of the queried ROIs on the CHIRPS grid (label rasters,
+  see label_raster.py), least recently used ones dropped above
+  max_cached_indexes. A repeated ROI costs one windowed read per date,
+- a thread pool for the reads (GDAL releases the GIL), started once.
+
+Endpoints (HTTP on host:port, or on a Unix socket):
+
+    GET  /status   catalogues, cached indices, query counts and latencies
+    POST /query    JSON request, returns JSON or Parquet
+    POST /reload   rescans the catalogues, e.g. after a fetch
+
+Request:
+
+    {
+        "geometry": GeoJSON geometry, Feature or FeatureCollection,
+        "crs": "EPSG:4326",              (optional, crs of geometry)
+        "start_date": "2023-01-01",
+        "end_date": "2023-12-31",        (YYYY-MM-DD | today)
+        "aggregation": "mean",           (or a list, one column each)
+        "product": "p05",                (p05 | prelim | merged)
+        "period": null,                  (optional, see temporal_aggregation.py)
+        "reductions": ["sum"],
+        "rainy_day_threshold": 1.0,
+        "if_missing_dates": "raise",
+        "format": "json"                 (json | parquet, or ?format=)
+    }
+
+    curl -s localhost:8642/query -d @query.json
+    curl -s --unix-socket /tmp/chirps.sock http://localhost/query -d @query.json
+
+All the geometries of a request form a single ROI, as in the extract
+subcommand. Pixels are assigned to the ROI if their centre is inside it.
+Per-query latency is returned in the response (the 'stats' of a JSON
+response, the X-Query-Latency-Ms header for both formats) and printed.
+"""
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8642
+DEFAULT_MAX_CACHED_INDEXES = 256
+
+FORMAT_JSON = 'json'
+FORMAT_PARQUET = 'parquet'
+VALID_FORMATS = [FORMAT_JSON, FORMAT_PARQUET]
+
+VALID_AGGREGATIONS = lr.GROUPED_AGGREGATIONS
+
+VAL_COL = 'CHIRPS'
+
+HEADER_LATENCY = 'X-Query-Latency-Ms'
+
+# latencies kept for the percentiles of /status
+N_RECENT_LATENCIES = 1000
+MAX_REQUEST_BYTES = 64 * 2**20
+
+
+def parse_date(date_str:str):
+    if str(date_str).lower() == 'today':
+        return datetime.datetime.today()
+    return datetime.datetime.strptime(str(date_str), '%Y-%m-%d')
+
+
+def parse_crs(crs):
+    if not isinstance(crs, (str, int)) or isinstance(crs, bool):
+        raise ValueError('crs needs to be a string (e.g. EPSG:4326) or an EPSG code.')
+    try:
+        return pyproj.CRS.from_user_input(crs)
+    except pyproj.exceptions.CRSError as e:
+        raise ValueError(f'Invalid crs={crs}: {e}')
+
+
+def parse_geometry(geojson:dict, crs:str = 'EPSG:4326'):
+    """
+    GeoDataFrame of a GeoJSON geometry, Feature or FeatureCollection.
+    """
+    if not isinstance(geojson, dict) or 'type' not in geojson:
+        raise ValueError('geometry needs to be a GeoJSON object.')
+    crs = parse_crs(crs)
+    try:
+        if geojson['type'] == 'FeatureCollection':
+            return gpd.GeoDataFrame.from_features(geojson['features'], crs=crs)
+        if geojson['type'] == 'Feature':
+            return gpd.GeoDataFrame.from_features([geojson], crs=crs)
+        return gpd.GeoDataFrame(geometry=[shapely.geometry.shape(geojson)], crs=crs)
+    except (KeyError, TypeError, AttributeError, IndexError, shapely.errors.GEOSException) as e:
+        raise ValueError(f'Invalid GeoJSON geometry: {e!r}')
+
+
+def read_tif_get_query_values(
+    filepath_filetype_multiplier:tuple[str,str,float],
+    label_pixels:dict,
+    aggregations:list[str],
+    src_transform,
+    tif_cache:tc.TIFCache = None,
+):
+    """
+    One value per aggregation for the single ROI of label_pixels, from a
+    single windowed read of the file.
+    """
+    filepath, filetype, multiplier = filepath_filetype_multiplier
+    window_values = rtcm.read_tif_label_window(
+        filepath = filepath,
+        filetype = filetype,
+        multiplier = multiplier,
+        label_pixels = label_pixels,
+        src_transform = src_transform,
+        tif_cache = tif_cache,
+    )
+    return [
+        float(lr.grouped_reduce(
+            window_values = window_values,
+            label_pixels = label_pixels,
+            aggregation = aggregation,
+        )[0])
+        for aggregation in aggregations
+    ]
+
+
+class QueryService:
+    def __init__(
+        self,
+        download_folderpaths:dict[str,str],
+        njobs:int = ws.DEFAULT_NJOBS,
+        tif_cache_folderpath:str = None,
+        tif_cache_max_bytes:int = tc.DEFAULT_MAX_BYTES,
+        max_cached_indexes:int = DEFAULT_MAX_CACHED_INDEXES,
+    ):
+        """
+        download_folderpaths maps each product (see fmcf.VALID_PRODUCTS) to
+        its download folder. The merged product is available when both are
+        given.
+        """
+        invalid_products = set(download_folderpaths.keys()) - set(fmcf.VALID_PRODUCTS)
+        if len(invalid_products) > 0:
+            raise ValueError(f'Invalid products {invalid_products}. Must be from {fmcf.VALID_PRODUCTS}.')
+
+        self.download_folderpaths = download_folderpaths
+        self.njobs = ws.resolve_njobs(njobs)
+        self.max_cached_indexes = max_cached_indexes
+        self.tif_cache = None
+        if tif_cache_folderpath is not None:
+            self.tif_cache = tc.TIFCache(
+                folderpath = tif_cache_folderpath,
+                max_bytes = tif_cache_max_bytes,
+            )
+
+        self._lock = threading.Lock()
+        self._catalogues = {}
+        self._grid = None
+        self._label_pixels = collections.OrderedDict()
+        self._recent_latencies = collections.deque(maxlen=N_RECENT_LATENCIES)
+        self.n_queries = 0
+        self.n_errors = 0
+        self.n_index_hits = 0
+
+        self._pool = multiprocessing.pool.ThreadPool(self.njobs)
+
+        self.reload()
+
+    def reload(self):
+        """
+        Rescans the download folders. The cached pixel indices are kept unless
+        the grid of the files changed.
+        """
+        catalogues = {}
+        for product, download_folderpath in self.download_folderpaths.items():
+            catalogues[product] = fmcf.generate_chc_chirps_catalogue_df(
+                folderpath = download_folderpath,
+            )
+        if all(product in catalogues for product in fmcf.VALID_PRODUCTS):
+            catalogues[fmcf.PRODUCT_MERGED] = fmcf.merge_catalogues_by_priority(
+                product_catalogue_dfs = {
+                    product: catalogues[product] for product in fmcf.VALID_PRODUCTS
+                },
+            )
+
+        non_empty_catalogue_dfs = [
+            catalogue_df for catalogue_df in catalogues.values()
+            if catalogue_df.shape[0] > 0
+        ]
+        if len(non_empty_catalogue_dfs) == 0:
+            raise ValueError(f'No files present in {list(self.download_folderpaths.values())}.')
+
+        first_row = non_empty_catalogue_dfs[0].iloc[0]
+        with rasterio.open(fmcf.get_gdal_filepath(
+            filepath = first_row[fmcf.COL_TIF_FILEPATH],
+            filetype = first_row[fmcf.COL_FILETYPE],
+        )) as src:
+            grid = (src.crs, src.transform, src.height, src.width)
+
+        with self._lock:
+            self._catalogues = catalogues
+            if grid != self._grid:
+                self._label_pixels.clear()
+            self._grid = grid
+
+        for product, catalogue_df in catalogues.items():
+            print(f'Catalogue {product}: {catalogue_df.shape[0]} files')
+
+    def get_label_pixels(self, shapes_gdf:gpd.GeoDataFrame):
+        """
+        Returns (label_pixels, is_cached) of the ROI formed by all the
+        geometries of shapes_gdf.
+        """
+        with self._lock:
+            crs, transform, height, width = self._grid
+
+        # repaired as in rtcm.read_tifs_get_agg_value, the union of invalid
+        # geometries can fail or differ
+        roi_geometry = shapely.union_all(rp.prepare_geometries(
+            shapes_gdf = shapes_gdf,
+            raster_crs = crs,
+        ).get_geometries())
+        key = hashlib.sha256(roi_geometry.wkb).hexdigest()
+
+        with self._lock:
+            if key in self._label_pixels:
+                self._label_pixels.move_to_end(key)
+                self.n_index_hits += 1
+                return self._label_pixels[key], True
+
+        label_pixels = lr.build_label_pixels(
+            geometries = [roi_geometry],
+            transform = transform,
+            raster_height = height,
+            raster_width = width,
+        )
+
+        with self._lock:
+            self._label_pixels[key] = label_pixels
+            while len(self._label_pixels) > self.max_cached_indexes:
+                self._label_pixels.popitem(last=False)
+
+        return label_pixels, False
+
+    def preload(self, roi_filepath:str):
+        """
+        Builds the pixel index of the ROI of a shapefile ahead of the first
+        query for it.
+        """
+        self.get_label_pixels(shapes_gdf=gpd.read_file(roi_filepath))
+
+    def query(self, request:dict):
+        """
+        Returns (result_df, stats) for a request, see the module docstring.
+        """
+        start_time = time.perf_counter()
+
+        product = str(request.get('product', fmcf.PRODUCT_P05)).lower()
+        with self._lock:
+            catalogues = self._catalogues
+            _, transform, _, _ = self._grid
+        if product not in catalogues:
+            raise ValueError(f'Invalid product={product}. Must be from {list(catalogues.keys())}.')
+
+        aggregation = request.get('aggregation', 'mean')
+        aggregations = list(aggregation) if rtcm.is_multi_aggregation(aggregation) else [aggregation]
+        if len(aggregations) == 0 or not all(isinstance(_aggregation, str) for _aggregation in aggregations):
+            raise ValueError('aggregation needs to be a string or a list of strings.')
+        invalid_aggregations = set(aggregations) - set(VALID_AGGREGATIONS)
+        if len(invalid_aggregations) > 0:
+            raise ValueError(f'Invalid aggregations {invalid_aggregations}. Must be from {VALID_AGGREGATIONS}.')
+        if len(aggregations) > 1:
+            val_cols = rtcm.get_val_cols(aggregation=aggregations, val_col=VAL_COL)
+        else:
+            val_cols = [f'{aggregations[0]} {VAL_COL}']
+
+        period = request.get('period')
+        reductions = request.get('reductions', [ta.TemporalReduction.SUM])
+        if isinstance(reductions, str):
+            reductions = [reductions]
+        if period is not None:
+            if not isinstance(period, str):
+                raise ValueError('period needs to be a string.')
+            if not isinstance(reductions, list) or not all(isinstance(reduction, str) for reduction in reductions):
+                raise ValueError('reductions needs to be a string or a list of strings.')
+            if period not in ta.VALID_PERIODS:
+                raise ValueError(f'Invalid period={period}. Must be from {ta.VALID_PERIODS}.')
+            invalid_reductions = set(reductions) - set(ta.VALID_REDUCTIONS)
+            if len(invalid_reductions) > 0:
+                raise ValueError(f'Invalid reductions {invalid_reductions}. Must be from {ta.VALID_REDUCTIONS}.')
+
+        if 'geometry' not in request:
+            raise ValueError('geometry is missing from the request.')
+        shapes_gdf = parse_geometry(
+            geojson = request['geometry'],
+            crs = request.get('crs', 'EPSG:4326'),
+        )
+
+        catalogue_df = fmcf.filter_catalogue_by_date_range(
+            catalogue_df = catalogues[product],
+            start_date = parse_date(request['start_date']),
+            end_date = parse_date(request['end_date']),
+            if_missing_dates = request.get('if_missing_dates', 'raise'),
+        ).sort_values(by=fmcf.COL_DATE)
+
+        parsed_time = time.perf_counter()
+
+        label_pixels, is_index_cached = self.get_label_pixels(shapes_gdf=shapes_gdf)
+
+        indexed_time = time.perf_counter()
+
+        read_tif_get_query_values_partial = functools.partial(
+            read_tif_get_query_values,
+            label_pixels = label_pixels,
+            aggregations = aggregations,
+            src_transform = transform,
+            tif_cache = self.tif_cache,
+        )
+        filepath_filetype_multiplier_tuples = list(zip(
+            catalogue_df[fmcf.COL_TIF_FILEPATH],
+            catalogue_df[fmcf.COL_FILETYPE],
+            catalogue_df[fmcf.COL_MULTIPLIER],
+        ))
+        values = self._pool.map(
+            read_tif_get_query_values_partial,
+            filepath_filetype_multiplier_tuples,
+            chunksize = ws.get_chunksize(
+                n_tasks = len(filepath_filetype_multiplier_tuples),
+                n_workers = self.njobs,
+            ),
+        )
+
+        read_time = time.perf_counter()
+
+        if period is None:
+            result_df = catalogue_df[[fmcf.COL_DATE, fmcf.COL_YEAR, fmcf.COL_DAY]].reset_index(drop=True)
+            for val_col, _values in zip(val_cols, zip(*values)):
+                result_df[val_col] = list(_values)
+            if product == fmcf.PRODUCT_MERGED:
+                result_df[fmcf.COL_PRODUCT] = catalogue_df[fmcf.COL_PRODUCT].to_numpy()
+        else:
+            temporal_accumulator = ta.TemporalAccumulator(
+                period = period,
+                reductions = reductions,
+                rainy_day_threshold = float(request.get('rainy_day_threshold', ta.DEFAULT_RAINY_DAY_THRESHOLD)),
+            )
+            rows = []
+            for _values, date in zip(values, catalogue_df[fmcf.COL_DATE]):
+                rows += temporal_accumulator.add(date=date, value=list(_values))
+            rows += temporal_accumulator.finalize()
+            result_df = pd.DataFrame(
+                data = [
+                    ta.flatten_row(row=row, reductions=reductions, val_cols=val_cols)
+                    for row in rows
+                ],
+                columns = [ta.COL_PERIOD_START, ta.COL_PERIOD_END, ta.COL_N_DAYS] \
+                    + ta.get_reduction_cols(reductions=reductions, val_cols=val_cols),
+            )
+
+        end_time = time.perf_counter()
+
+        stats = {
+            'n_files': len(filepath_filetype_multiplier_tuples),
+            'n_pixels': int(label_pixels[lr.KEY_PIXEL_INDEX].shape[0]),
+            'index_cached': is_index_cached,
+            'parse_ms': round((parsed_time - start_time) * 1000, 2),
+            'index_ms': round((indexed_time - parsed_time) * 1000, 2),
+            'read_ms': round((read_time - indexed_time) * 1000, 2),
+            'latency_ms': round((end_time - start_time) * 1000, 2),
+        }
+
+        return result_df, stats
+
+    def record_query(self, latency_ms:float, is_error:bool):
+        with self._lock:
+            self.n_queries += 1
+            if is_error:
+                self.n_errors += 1
+            else:
+                self._recent_latencies.append(latency_ms)
+
+    def get_status(self):
+        with self._lock:
+            catalogues = self._catalogues
+            latencies = np.array(self._recent_latencies)
+            status = {
+                'n_queries': self.n_queries,
+                'n_errors': self.n_errors,
+                'n_cached_indexes': len(self._label_pixels),
+                'n_index_hits': self.n_index_hits,
+                'njobs': self.njobs,
+            }
+        status['catalogues'] = {
+            product: {
+                'n_files': catalogue_df.shape[0],
+                'first_date': None if catalogue_df.shape[0] == 0
+                    else catalogue_df[fmcf.COL_DATE].min().strftime('%Y-%m-%d'),
+                'last_date': None if catalogue_df.shape[0] == 0
+                    else catalogue_df[fmcf.COL_DATE].max().strftime('%Y-%m-%d'),
+            }
+            for product, catalogue_df in catalogues.items()
+        }
+        status['latency_ms'] = None if latencies.shape[0] == 0 else {
+            'p50': round(float(np.percentile(latencies, 50)), 2),
+            'p95': round(float(np.percentile(latencies, 95)), 2),
+            'max': round(float(latencies.max()), 2),
+        }
+        return status
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+def result_df_to_json_bytes(result_df:pd.DataFrame, stats:dict):
+    return (
+        '{"stats": ' + json.dumps(stats)
+        + ', "data": ' + result_df.to_json(orient='records', date_format='iso')
+        + '}'
+    ).encode()
+
+
+def result_df_to_parquet_bytes(result_df:pd.DataFrame):
+    buffer = io.BytesIO()
+    try:
+        result_df.to_parquet(buffer, index=False)
+    except ImportError as e:
+        raise NotImplementedError(f'Parquet output is not available: {e}')
+    return buffer.getvalue()
+
+
+class QueryRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    self.server.service is the QueryService.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, code:int, body:bytes, content_type:str, headers:dict = {}):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, code:int, payload:dict, headers:dict = {}):
+        self._send(
+            code = code,
+            body = json.dumps(payload).encode(),
+            content_type = 'application/json',
+            headers = headers,
+        )
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path == '/status':
+            self._send_json(200, self.server.service.get_status())
+        else:
+            self._send_json(404, {'error': f'Unknown path {path}.'})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        content_length = int(self.headers.get('Content-Length', 0))
+        if content_length > MAX_REQUEST_BYTES:
+            self._send_json(413, {'error': f'Request larger than {MAX_REQUEST_BYTES} bytes.'})
+            return
+        body = self.rfile.read(content_length)
+
+        if url.path == '/reload':
+            try:
+                self.server.service.reload()
+            except Exception as e:
+                # e.g. an unreadable file, the previous catalogues are kept
+                print(f'reload failed: {e!r}')
+                self._send_json(500, {'error': f'{type(e).__name__}: {e}'})
+                return
+            self._send_json(200, self.server.service.get_status())
+            return
+
+        if url.path != '/query':
+            self._send_json(404, {'error': f'Unknown path {url.path}.'})
+            return
+
+        start_time = time.perf_counter()
+        try:
+            request = json.loads(body)
+            if not isinstance(request, dict):
+                raise ValueError('Request needs to be a JSON object.')
+            result_format = urllib.parse.parse_qs(url.query).get('format', [None])[0] \
+                or request.get('format', FORMAT_JSON)
+            if result_format not in VALID_FORMATS:
+                raise ValueError(f'Invalid format={result_format}. Must be from {VALID_FORMATS}.')
+            result_df, stats = self.server.service.query(request=request)
+            if result_format == FORMAT_PARQUET:
+                response_body = result_df_to_parquet_bytes(result_df=result_df)
+                content_type = 'application/vnd.apache.parquet'
+            else:
+                response_body = result_df_to_json_bytes(result_df=result_df, stats=stats)
+                content_type = 'application/json'
+        except (ValueError, KeyError, NotImplementedError) as e:
+            code = 501 if isinstance(e, NotImplementedError) else 400
+            message = f'Missing {e} in the request.' if isinstance(e, KeyError) else str(e)
+            self._send_query_error(start_time=start_time, code=code, message=message)
+            return
+        except Exception as e:
+            # not a bad request (e.g. an unreadable file), the client still
+            # gets a response and the query counts as an error
+            self._send_query_error(start_time=start_time, code=500, message=f'{type(e).__name__}: {e}')
+            return
+
+        latency_ms = (time.perf_counter() - start_time) * 1000
+        self.server.service.record_query(latency_ms=latency_ms, is_error=False)
+        print(
+            f"query: {stats['n_files']} files, {stats['n_pixels']} pixels, "
+            f"index {'cached' if stats['index_cached'] else 'built'} ({stats['index_ms']} ms), "
+            f"read {stats['read_ms']} ms, total {latency_ms:.1f} ms"
+        )
+        self._send(
+            code = 200,
+            body = response_body,
+            content_type = content_type,
+            headers = {HEADER_LATENCY: f'{latency_ms:.2f}'},
+        )
+
+    def _send_query_error(self, start_time:float, code:int, message:str):
+        latency_ms = (time.perf_counter() - start_time) * 1000
+        self.server.service.record_query(latency_ms=latency_ms, is_error=True)
+        print(f'query failed ({code}) in {latency_ms:.1f} ms: {message}')
+        self._send_json(code, {'error': message, 'latency_ms': round(latency_ms, 2)})
+
+    def log_message(self, format, *args):
+        # the per-query line is printed by do_POST, and client_address is
+        # empty on a Unix socket
+        pass
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(
+    service:QueryService,
+    host:str = DEFAULT_HOST,
+    port:int = DEFAULT_PORT,
+    unix_socket_filepath:str = None,
+):
+    """
+    Threaded HTTP server for service, on a Unix socket if
+    unix_socket_filepath is given (a leftover socket file is replaced),
+    otherwise on host:port.
+    """
+    if unix_socket_filepath is not None:
+        if os.path.exists(unix_socket_filepath):
+            os.remove(unix_socket_filepath)
+        server = ThreadingUnixHTTPServer(unix_socket_filepath, QueryRequestHandler)
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), QueryRequestHandler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def serve(
+    service:QueryService,
+    host:str = DEFAULT_HOST,
+    port:int = DEFAULT_PORT,
+    unix_socket_filepath:str = None,
+):
+    """
+    Serves until interrupted.
+    """
+    server = make_server(
+        service = service,
+        host = host,
+        port = port,
+        unix_socket_filepath = unix_socket_filepath,
+    )
+    if unix_socket_filepath is not None:
+        print(f'Serving on {unix_socket_filepath}')
+    else:
+        print(f'Serving on http://{host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if unix_socket_filepath is not None and os.path.exists(unix_socket_filepath):
+            os.remove(unix_socket_filepath)
@@ -1,15 +1,33 @@
+from __future__ import annotations
+
 import os
-import pandas as pd
-import geopandas as gpd
-import rasterio
-import rasterio.merge
-import tqdm
 import numpy as np
-import multiprocessing as mp
 import functools
+import itertools
+import contextlib
+
+from lazy_imports import lazy_import
+
+pd = lazy_import('pandas')
+gpd = lazy_import('geopandas')
+rasterio = lazy_import('rasterio', submodules=['merge', 'features', 'io', 'mask'])
+tqdm = lazy_import('tqdm')
 
-import rsutils.utils as utils
+utils = lazy_import('rsutils.utils')
 import fetch_missing_chirps_files as fmcf
+import agg_value_cache as avc
+import temporal_aggregation as ta
+import worker_sizing as ws
+import executors as ex
+import prefetch as pf
+import tif_cache as tc
+import label_raster as lr
+import roi_planning as rp
+import progress_metrics as pm
+
+# regional_archive builds its stacks with read_tifs_create_stack, which
+# imports this module
+ra = lazy_import('regional_archive')
 
 
 COL_METHOD = 'method'
@@ -21,14 +39,44 @@ class LoadTIFMethod:
     COREGISTER_AND_CROP = 'coregister and crop'
     
 
+def crop_tif_with_geometries(
+    src_filepath:str,
+    geometries:rp.PreparedGeometries,
+):
+    """
+    Same crop as utils.crop_tif, with geometries prepared by
+    rp.prepare_geometries instead of a GeoDataFrame, so that the workers do
+    not need GeoPandas.
+    """
+    with rasterio.open(src_filepath) as src:
+        out_image, out_transform = rasterio.mask.mask(
+            src,
+            geometries.get_geometries(crs=src.crs),
+            crop = True,
+            nodata = None,
+            all_touched = False,
+        )
+        out_meta = src.meta.copy()
+    out_meta.update({
+        'height': out_image.shape[1],
+        'width': out_image.shape[2],
+        'transform': out_transform,
+    })
+    return out_image, out_meta
+
+
 def coregister_and_maybe_crop(
     tif_filepath:str,
     reference_tif_filepath:str,
     working_folderpath:str = None,
-    resampling=rasterio.merge.Resampling.nearest,
+    resampling = None,
     nodata=None,
     shapes_gdf:gpd.GeoDataFrame = None,
+    geometries:rp.PreparedGeometries = None,
 ):
+    if resampling is None:
+        resampling = rasterio.merge.Resampling.nearest
+
     os.makedirs(working_folderpath, exist_ok=True)
 
     _filename = os.path.split(tif_filepath)[1]
@@ -57,7 +105,12 @@ def coregister_and_maybe_crop(
         nodata = nodata,
     )
 
-    if shapes_gdf is not None:
+    if geometries is not None:
+        out_image, out_meta = crop_tif_with_geometries(
+            src_filepath = coregistered_tif_filepath,
+            geometries = geometries,
+        )
+    elif shapes_gdf is not None:
         out_image, out_meta = utils.crop_tif(
             src_filepath = coregistered_tif_filepath,
             shapes_gdf = shapes_gdf,
@@ -79,25 +132,36 @@ def load_tif(
     shapes_gdf:gpd.GeoDataFrame = None,
     reference_tif_filepath:str = None,
     method:str = LoadTIFMethod.READ_NO_CROP,
-    resampling = rasterio.merge.Resampling.nearest,
+    resampling = None,
     nodata = None,
+    geometries:rp.PreparedGeometries = None,
 ):
+    """
+    geometries (see rp.prepare_geometries) are used to crop instead of
+    shapes_gdf if given.
+    """
     if method == LoadTIFMethod.READ_NO_CROP:
         with rasterio.open(tif_filepath) as src:
             out_image = src.read()
             out_meta = src.meta.copy()
 
     elif method == LoadTIFMethod.READ_AND_CROP:
-        if shapes_gdf is None:
-            raise ValueError(f'shapes_gdf can not be None for method={method}')
-        out_image, out_meta = utils.crop_tif(
-            src_filepath=tif_filepath,
-            shapes_gdf=shapes_gdf,
-        )
+        if geometries is not None:
+            out_image, out_meta = crop_tif_with_geometries(
+                src_filepath = tif_filepath,
+                geometries = geometries,
+            )
+        elif shapes_gdf is not None:
+            out_image, out_meta = utils.crop_tif(
+                src_filepath=tif_filepath,
+                shapes_gdf=shapes_gdf,
+            )
+        else:
+            raise ValueError(f'shapes_gdf and geometries can not both be None for method={method}')
 
     elif method == LoadTIFMethod.COREGISTER_AND_CROP:
-        if shapes_gdf is None:
-            raise ValueError(f'shapes_gdf can not be None for method={method}')
+        if shapes_gdf is None and geometries is None:
+            raise ValueError(f'shapes_gdf and geometries can not both be None for method={method}')
         if reference_tif_filepath is None:
             raise ValueError(f'reference_tif_filepath can not be None for method={method}')
         out_image, out_meta = coregister_and_maybe_crop(
@@ -106,12 +170,40 @@ def load_tif(
             resampling = resampling,
             nodata = nodata,
             shapes_gdf = shapes_gdf,
+            geometries = geometries,
             working_folderpath = working_folderpath,
         )
 
     return out_image, out_meta
 
 
+# CHIRPS NODATA value = -9999
+CHIRPS_NODATA = -9999
+
+
+def mask_nodata_and_apply_multiplier(
+    image:np.ndarray,
+    multiplier:float,
+    nodata:float = None,
+):
+    """
+    Sets the NODATA pixels of the raw values to NaN and then applies
+    multiplier, so that e.g. a raw -9999 of a file with multiplier 1/100 is
+    not taken for -99.99 mm. NODATA is CHIRPS_NODATA, and nodata (the nodata
+    of the file, which is also what rasterio.mask.mask fills the pixels
+    outside the geometries with) if given. Every loading path goes through
+    this so that they all mask the same pixels.
+    """
+    if not np.issubdtype(image.dtype, np.floating):
+        image = image.astype(float)
+    is_nodata = image == CHIRPS_NODATA
+    if nodata is not None and not np.isnan(nodata):
+        is_nodata |= image == nodata
+    image = image * multiplier
+    image[is_nodata] = np.nan
+    return image
+
+
 def get_centre_value(ndarray:np.ndarray):
     return np.take(ndarray, ndarray.size // 2)
 
@@ -123,7 +215,56 @@ AGGREGATION_DICT = {
 }
 
 
-def read_tif_get_agg_value(
+def is_multi_aggregation(aggregation):
+    return isinstance(aggregation, (list, tuple))
+
+
+def get_aggregation_func(aggregation):
+    """
+    aggregation is either a key of AGGREGATION_DICT or a callable that takes
+    the loaded ndarray (NaN for nodata) and returns a value. Callables need to
+    be picklable, i.e. defined at the top level of a module.
+    """
+    if callable(aggregation):
+        return aggregation
+    if aggregation not in AGGREGATION_DICT.keys():
+        raise ValueError(f'Invalid aggregation={aggregation}. Valid aggregations: {AGGREGATION_DICT.keys()}')
+    return AGGREGATION_DICT[aggregation]
+
+
+def get_aggregation_name(aggregation):
+    if callable(aggregation):
+        return aggregation.__name__
+    return aggregation
+
+
+def get_aggregation_key(aggregation):
+    """
+    Identifies the aggregation(s) in the cache key.
+    """
+    if is_multi_aggregation(aggregation):
+        return '|'.join(get_aggregation_key(_aggregation) for _aggregation in aggregation)
+    if callable(aggregation):
+        return f'{aggregation.__module__}.{aggregation.__qualname__}'
+    return aggregation
+
+
+def get_val_cols(aggregation, val_col):
+    """
+    Column names for the values of read_tifs_get_agg_value. For a list of
+    aggregations val_col can either be a list of the same length, or a suffix
+    in which case the columns are named '{aggregation} {val_col}'.
+    """
+    if not is_multi_aggregation(aggregation):
+        return [val_col]
+    if isinstance(val_col, str):
+        return [f'{get_aggregation_name(_aggregation)} {val_col}' for _aggregation in aggregation]
+    if len(val_col) != len(aggregation):
+        raise ValueError(f'val_col={val_col} and aggregation={aggregation} need to be of the same length.')
+    return list(val_col)
+
+
+def read_tif_load_agg_inputs(
     filepath:str,
     filetype:str,
     method:str,
@@ -132,10 +273,45 @@ def read_tif_get_agg_value(
     shapes_gdf:gpd.GeoDataFrame,
     working_folderpath:str,
     reference_tif_filepath:str=None,
+    file_bytes:bytes=None,
+    tif_cache:tc.TIFCache=None,
+    geometries:rp.PreparedGeometries=None,
 ):
-    aggregation_func = AGGREGATION_DICT[aggregation]
+    """
+    I/O part of read_tif_get_agg_value: returns the loaded array (NaN for
+    nodata) to apply each of the aggregations to, see reduce_agg_inputs.
+
+    file_bytes are the contents of filepath if already read (see
+    prefetch.py), which are then opened from memory instead of from disk for
+    READ_AND_CROP and READ_NO_CROP.
+
+    If tif_cache is given, .tif.gz files are read from their decompressed
+    copy in the cache (see tif_cache.py) instead of being decompressed again.
 
-    if filetype == fmcf.EXT_TIF:
+    geometries are shapes_gdf prepared with rp.prepare_geometries, ideally in
+    the crs of the raster, which iter_tifs_agg_value does once per run so
+    that this function does not touch GeoPandas. shapes_gdf is only used if
+    geometries is None, and is then prepared on each call.
+    """
+    aggregations = list(aggregation) if is_multi_aggregation(aggregation) else [aggregation]
+
+    # 'centre' is taken from the crop of the envelope of the geometries. The
+    # crop of the envelope has the same window as the crop of the geometries,
+    # so when other aggregations are requested along with it the geometries'
+    # mask is applied to a copy instead of reading the file twice.
+    is_centre = [
+        isinstance(_aggregation, str) and _aggregation == 'centre'
+        for _aggregation in aggregations
+    ]
+
+    memory_file = None
+    gzip_file = None
+    if file_bytes is not None and method != LoadTIFMethod.COREGISTER_AND_CROP:
+        memory_file = rasterio.io.MemoryFile(file_bytes, ext=filetype)
+        tif_filepath = fmcf.get_gdal_filepath(filepath=memory_file.name, filetype=filetype)
+    elif tif_cache is not None and filetype == fmcf.EXT_TIF_GZ:
+        tif_filepath = tif_cache.get_tif_filepath(filepath=filepath, filetype=filetype)
+    elif filetype == fmcf.EXT_TIF:
         tif_filepath = filepath
     elif filetype == fmcf.EXT_TIF_GZ:
         gzip_file = utils.GZipTIF(
@@ -145,28 +321,125 @@ def read_tif_get_agg_value(
     else:
         raise NotImplementedError(f'New filetype: {filetype}')
 
+    if geometries is None and shapes_gdf is not None:
+        geometries = prepare_geometries_for_tif(
+            shapes_gdf = shapes_gdf,
+            tif_filepath = reference_tif_filepath
+                if method == LoadTIFMethod.COREGISTER_AND_CROP else tif_filepath,
+        )
+    load_geometries = geometries
+    if any(is_centre) and geometries is not None:
+        load_geometries = geometries.get_envelopes()
+
     out_image, out_meta = load_tif(
         tif_filepath = tif_filepath,
-        shapes_gdf = shapes_gdf,
+        geometries = load_geometries,
         reference_tif_filepath = reference_tif_filepath,
         method = method,
         working_folderpath = working_folderpath,
     )
 
-    out_image = out_image * multiplier
+    out_image = mask_nodata_and_apply_multiplier(
+        image = out_image,
+        multiplier = multiplier,
+        nodata = out_meta.get('nodata'),
+    )
 
-    # CHIRPS NODATA value = -9999
-    out_image[out_image == -9999] = np.nan
+    masked_image = out_image
+    if load_geometries is not geometries and not all(is_centre) \
+        and method != LoadTIFMethod.READ_NO_CROP:
+        outside_mask = rasterio.features.geometry_mask(
+            geometries = geometries.get_geometries(crs=out_meta['crs']),
+            out_shape = out_image.shape[-2:],
+            transform = out_meta['transform'],
+        )
+        masked_image = out_image.copy()
+        masked_image[..., outside_mask] = np.nan
 
-    value = aggregation_func(out_image)
+    images = [
+        out_image if _is_centre else masked_image
+        for _is_centre in is_centre
+    ]
 
-    del out_image, out_meta
+    del out_image, masked_image, out_meta
 
-    if filetype == fmcf.EXT_TIF_GZ:
+    if memory_file is not None:
+        memory_file.close()
+    if gzip_file is not None:
         gzip_file.delete_tif()
         del gzip_file
 
-    return value
+    return images
+
+
+def reduce_agg_inputs(
+    images:list[np.ndarray],
+    aggregation:str,
+):
+    aggregations = list(aggregation) if is_multi_aggregation(aggregation) else [aggregation]
+    values = [
+        get_aggregation_func(_aggregation)(image)
+        for _aggregation, image in zip(aggregations, images)
+    ]
+    if is_multi_aggregation(aggregation):
+        return values
+    return values[0]
+
+
+def read_tif_get_agg_value(
+    filepath:str,
+    filetype:str,
+    method:str,
+    multiplier:float,
+    aggregation:str,
+    shapes_gdf:gpd.GeoDataFrame,
+    working_folderpath:str,
+    reference_tif_filepath:str=None,
+    file_bytes:bytes=None,
+    tif_cache:tc.TIFCache=None,
+    geometries:rp.PreparedGeometries=None,
+):
+    """
+    aggregation can be a single aggregation, in which case a single value is
+    returned, or a list of aggregations which are all computed from the same
+    loaded array, in which case a list of values is returned.
+    """
+    images = read_tif_load_agg_inputs(
+        filepath = filepath,
+        filetype = filetype,
+        method = method,
+        multiplier = multiplier,
+        aggregation = aggregation,
+        shapes_gdf = shapes_gdf,
+        working_folderpath = working_folderpath,
+        reference_tif_filepath = reference_tif_filepath,
+        file_bytes = file_bytes,
+        tif_cache = tif_cache,
+        geometries = geometries,
+    )
+    return reduce_agg_inputs(images=images, aggregation=aggregation)
+
+
+def prepare_geometries_for_tif(
+    shapes_gdf:gpd.GeoDataFrame,
+    tif_filepath:str,
+    simplify_pixels:float = None,
+):
+    """
+    rp.prepare_geometries in the crs of tif_filepath, with a simplification
+    tolerance of simplify_pixels pixels of tif_filepath if given.
+    """
+    with rasterio.open(tif_filepath) as src:
+        raster_crs = src.crs
+        pixel_size = min(abs(src.transform.a), abs(src.transform.e))
+    simplify_tolerance = None
+    if simplify_pixels is not None and simplify_pixels > 0:
+        simplify_tolerance = simplify_pixels * pixel_size
+    return rp.prepare_geometries(
+        shapes_gdf = shapes_gdf,
+        raster_crs = raster_crs,
+        simplify_tolerance = simplify_tolerance,
+    )
 
 
 def read_tif_get_agg_value_by_tuple(
@@ -175,8 +448,13 @@ def read_tif_get_agg_value_by_tuple(
     working_folderpath:str,
     aggregation:str = 'mean',
     reference_tif_filepath:str = None,
+    tif_cache:tc.TIFCache = None,
+    geometries:rp.PreparedGeometries = None,
 ):
-    filepath, filetype, method, multiplier = filepath_filetype_method_multiplier
+    filepath, filetype, method, multiplier = filepath_filetype_method_multiplier[:4]
+    # contents of filepath if prefetched, see iter_tifs_agg_value
+    file_bytes = filepath_filetype_method_multiplier[4] \
+        if len(filepath_filetype_method_multiplier) > 4 else None
     return read_tif_get_agg_value(
         filepath = filepath,
         working_folderpath = working_folderpath,
@@ -186,40 +464,120 @@ def read_tif_get_agg_value_by_tuple(
         aggregation = aggregation,
         shapes_gdf = shapes_gdf,
         reference_tif_filepath = reference_tif_filepath,
+        file_bytes = file_bytes,
+        tif_cache = tif_cache,
+        geometries = geometries,
     )
 
 
-def read_tifs_get_agg_value(
+def read_tif_load_agg_inputs_by_tuple(
+    filepath_filetype_method_multiplier:tuple[str,str,str,float],
+    shapes_gdf:gpd.GeoDataFrame,
+    working_folderpath:str,
+    aggregation:str = 'mean',
+    reference_tif_filepath:str = None,
+    tif_cache:tc.TIFCache = None,
+    geometries:rp.PreparedGeometries = None,
+):
+    filepath, filetype, method, multiplier = filepath_filetype_method_multiplier[:4]
+    # contents of filepath if prefetched, see iter_tifs_agg_value
+    file_bytes = filepath_filetype_method_multiplier[4] \
+        if len(filepath_filetype_method_multiplier) > 4 else None
+    return read_tif_load_agg_inputs(
+        filepath = filepath,
+        working_folderpath = working_folderpath,
+        filetype = filetype,
+        method = method,
+        multiplier = multiplier,
+        aggregation = aggregation,
+        shapes_gdf = shapes_gdf,
+        reference_tif_filepath = reference_tif_filepath,
+        file_bytes = file_bytes,
+        tif_cache = tif_cache,
+        geometries = geometries,
+    )
+
+
+def iter_tifs_agg_value(
     catalogue_df:pd.DataFrame,
-    shapes_gdf:gpd.geopandas,
-    val_col:str,
+    shapes_gdf:gpd.GeoDataFrame,
     working_folderpath:str,
+    date_col:str = fmcf.COL_DATE,
     method_col:str = COL_METHOD,
     tif_filepath_col:str = fmcf.COL_TIF_FILEPATH,
     filetype_col:str = fmcf.COL_FILETYPE,
     multiplier_col:str = fmcf.COL_MULTIPLIER,
     aggregation:str = 'mean',
     reference_tif_filepath:str = None,
-    njobs:int = mp.cpu_count() - 2,
-):  
-    if aggregation not in AGGREGATION_DICT.keys():
-        raise ValueError(f'Invalid aggregation={aggregation}. Valid aggregations: {AGGREGATION_DICT.keys()}')
+    njobs:int = ws.DEFAULT_NJOBS,
+    cache_filepath:str = None,
+    cache_max_bytes:int = avc.DEFAULT_MAX_BYTES,
+    cache_file_identity:str = avc.FILE_IDENTITY_STAT,
+    pool = None,
+    backend:str = ex.DEFAULT_BACKEND,
+    prefetch_files:int = 0,
+    prefetch_max_bytes:int = pf.DEFAULT_PREFETCH_MAX_BYTES,
+    tif_cache_folderpath:str = None,
+    tif_cache_max_bytes:int = tc.DEFAULT_MAX_BYTES,
+    regional_archive_folderpath:str = None,
+    metrics:pm.ProgressMetrics = None,
+    simplify_pixels:float = None,
+):
+    """
+    Yields the aggregated value for each row of catalogue_df, in order, as
+    soon as it is available. Values computed in this run are written to the
+    cache once the generator is exhausted. If pool is provided it is used
+    instead of creating a new mp.Pool(njobs), njobs still caps the number of
+    concurrent tasks (and is the number of I/O threads of hybrid).
 
-    updated_catalogue_df = catalogue_df.copy(deep=True)
+    The number of workers (or of concurrent tasks on pool) is capped by the
+    peak memory of one task, measured on the first pending file, and the
+    available memory, see worker_sizing.py.
 
-    if aggregation == 'centre':
-        """
-        - alter the geometry to a box [DONE]
-        - get the centroid pixel coordinate [TO DO]
-        """
-        shapes_gdf['geometry'] = shapes_gdf.envelope
+    backend selects processes, threads or hybrid (see executors.py). pool is
+    only used by processes, and for the reductions of hybrid.
 
-    read_tif_get_agg_value_by_tuple_partial = functools.partial(
-        read_tif_get_agg_value_by_tuple,
-        shapes_gdf = shapes_gdf,
+    prefetch_files > 0 reads the next prefetch_files files into memory on
+    background threads, up to prefetch_max_bytes, see prefetch.py.
+
+    tif_cache_folderpath is a folder (ideally on a local disk) where the
+    decompressed .tif.gz files are kept across runs, up to
+    tif_cache_max_bytes, see tif_cache.py.
+
+    If regional_archive_folderpath is given and a region in it contains
+    shapes_gdf, the READ_AND_CROP files archived for that region are read from
+    its pre-clipped stacks instead (the month stacks of the dates in date_col),
+    see regional_archive.py.
+
+    metrics (see progress_metrics.py) is updated as each value is yielded,
+    values served from the cache or a regional archive count as cached files.
+
+    shapes_gdf is prepared once (see rp.prepare_geometries): reprojected to
+    the crs of the rasters, with invalid geometries repaired, and simplified
+    with a tolerance of simplify_pixels pixels if given. The tasks receive
+    the geometries as WKB.
+    """
+    for _aggregation in (aggregation if is_multi_aggregation(aggregation) else [aggregation]):
+        get_aggregation_func(_aggregation)
+
+    tif_cache = None
+    if tif_cache_folderpath is not None:
+        if prefetch_files > 0:
+            raise ValueError('Prefetching and tif_cache_folderpath can not be combined, cached files are read locally.')
+        tif_cache = tc.TIFCache(
+            folderpath = tif_cache_folderpath,
+            max_bytes = tif_cache_max_bytes,
+        )
+
+    """
+    'centre':
+    - alter the geometry to a box [DONE] (in read_tif_get_agg_value)
+    - get the centroid pixel coordinate [TO DO]
+    """
+
+    reduce_agg_inputs_partial = functools.partial(
+        reduce_agg_inputs,
         aggregation = aggregation,
-        reference_tif_filepath = reference_tif_filepath,
-        working_folderpath = working_folderpath,
     )
 
     filepath_filetype_method_multiplier_tuples = list(zip(
@@ -229,15 +587,805 @@ def read_tifs_get_agg_value(
         catalogue_df[multiplier_col],
     ))
 
-    with mp.Pool(njobs) as p:
-        values = list(tqdm.tqdm(
-            p.imap(
-                read_tif_get_agg_value_by_tuple_partial, 
-                filepath_filetype_method_multiplier_tuples,
-            ), 
-            total=len(filepath_filetype_method_multiplier_tuples)
-        ))
-        
-    updated_catalogue_df[val_col] = values
+    if metrics is not None:
+        metrics.add_expected(len(filepath_filetype_method_multiplier_tuples))
+
+    cache = None
+    cache_keys = None
+    cached_values = {}
+    if cache_filepath is not None:
+        cache = avc.AggValueCache(
+            cache_filepath = cache_filepath,
+            max_bytes = cache_max_bytes,
+        )
+        geometry_hash = avc.get_geometry_hash(shapes_gdf=shapes_gdf)
+        if simplify_pixels is not None and simplify_pixels > 0:
+            geometry_hash = f'{geometry_hash}+simplify={simplify_pixels:g}'
+        cache_keys = [
+            avc.make_key(
+                filepath = filepath,
+                geometry_hash = geometry_hash,
+                method = method,
+                multiplier = multiplier,
+                aggregation = get_aggregation_key(aggregation),
+                reference_tif_filepath = reference_tif_filepath,
+                file_identity = cache_file_identity,
+            )
+            for filepath, _, method, multiplier
+            in filepath_filetype_method_multiplier_tuples
+        ]
+        cached_values = cache.get_many(keys=cache_keys)
+
+    pending_indexes = [
+        i for i in range(len(filepath_filetype_method_multiplier_tuples))
+        if cache is None or cache_keys[i] not in cached_values
+    ]
+
+    geometries = None
+    if shapes_gdf is not None and len(pending_indexes) > 0:
+        _filepath, _filetype, _method, _ = filepath_filetype_method_multiplier_tuples[pending_indexes[0]]
+        geometries = prepare_geometries_for_tif(
+            shapes_gdf = shapes_gdf,
+            tif_filepath = reference_tif_filepath
+                if _method == LoadTIFMethod.COREGISTER_AND_CROP
+                else fmcf.get_gdal_filepath(filepath=_filepath, filetype=_filetype),
+            simplify_pixels = simplify_pixels,
+        )
+
+    read_tif_get_agg_value_by_tuple_partial = functools.partial(
+        read_tif_get_agg_value_by_tuple,
+        shapes_gdf = None,
+        geometries = geometries,
+        aggregation = aggregation,
+        reference_tif_filepath = reference_tif_filepath,
+        working_folderpath = working_folderpath,
+        tif_cache = tif_cache,
+    )
+    read_tif_load_agg_inputs_by_tuple_partial = functools.partial(
+        read_tif_load_agg_inputs_by_tuple,
+        shapes_gdf = None,
+        geometries = geometries,
+        aggregation = aggregation,
+        reference_tif_filepath = reference_tif_filepath,
+        working_folderpath = working_folderpath,
+        tif_cache = tif_cache,
+    )
+
+    archived_values = {}
+    if regional_archive_folderpath is not None and geometries is not None:
+        archive_indexes = [
+            i for i in pending_indexes
+            if filepath_filetype_method_multiplier_tuples[i][2] == LoadTIFMethod.READ_AND_CROP
+        ]
+        dates = pd.to_datetime(catalogue_df[date_col]).to_list()
+        archived_values = {
+            archive_indexes[position]: value
+            for position, value in ra.get_archived_agg_values(
+                archive_folderpath = regional_archive_folderpath,
+                # the same repaired (and simplified) geometries as the tasks
+                shapes_gdf = geometries.get_gdf(),
+                filepaths = [filepath_filetype_method_multiplier_tuples[i][0] for i in archive_indexes],
+                multipliers = [filepath_filetype_method_multiplier_tuples[i][3] for i in archive_indexes],
+                dates = [dates[i] for i in archive_indexes],
+                aggregation = aggregation,
+            ).items()
+        }
+        pending_indexes = [i for i in pending_indexes if i not in archived_values]
+
+    pending_tuples = [
+        filepath_filetype_method_multiplier_tuples[i]
+        for i in pending_indexes
+    ]
+
+    computed_values = {}
+    prefetcher = None
+    # values of the first pending files computed by the memory probe
+    probed_values = []
+    with contextlib.ExitStack() as stack:
+        pending_values_iter = iter([])
+        if len(pending_tuples) > 0:
+            if metrics is not None:
+                # tasks return (value, busy seconds) for the worker
+                # utilization
+                read_tif_get_agg_value_by_tuple_partial = functools.partial(
+                    pm.timed_call, read_tif_get_agg_value_by_tuple_partial,
+                )
+                read_tif_load_agg_inputs_by_tuple_partial = functools.partial(
+                    pm.timed_call, read_tif_load_agg_inputs_by_tuple_partial,
+                )
+                reduce_agg_inputs_partial = functools.partial(
+                    pm.timed_reduce, reduce_agg_inputs_partial,
+                )
+            njobs = ws.resolve_njobs(njobs)
+            task_bytes = None
+            if njobs > 1 and len(pending_tuples) > 1:
+                _, filetype, method, _ = pending_tuples[0]
+                probe_key = (
+                    'read_tif_get_agg_value', method, filetype, reference_tif_filepath,
+                    tuple(np.round(shapes_gdf.total_bounds, 2)) if shapes_gdf is not None else None,
+                )
+                task_bytes = ws.get_measured_task_bytes(key=probe_key)
+                if task_bytes is None:
+                    probed_value, task_bytes = ws.probe_task(
+                        func = read_tif_get_agg_value_by_tuple_partial,
+                        arg = pending_tuples[0],
+                        key = probe_key,
+                        in_process = backend != ex.ExecutorBackend.PROCESSES,
+                    )
+                    probed_values.append(probed_value)
+            plan = ws.plan_workers(
+                n_tasks = len(pending_tuples),
+                njobs = njobs,
+                task_bytes = task_bytes,
+                label = f'read_tifs_get_agg_value ({backend})',
+            )
+            if metrics is not None:
+                metrics.set_n_workers(plan.n_workers)
+            remaining_tuples = pending_tuples[len(probed_values):]
+            remaining_tuples_iter = remaining_tuples
+            if prefetch_files > 0:
+                if any(method == LoadTIFMethod.COREGISTER_AND_CROP for _, _, method, _ in pending_tuples):
+                    raise NotImplementedError(f'Prefetching is not supported for method={LoadTIFMethod.COREGISTER_AND_CROP}')
+                prefetcher = stack.enter_context(pf.Prefetcher(
+                    filepaths = [filepath for filepath, _, _, _ in remaining_tuples],
+                    max_files = prefetch_files,
+                    max_bytes = prefetch_max_bytes,
+                ))
+                # remaining_tuples first so that zip stops before asking the
+                # prefetcher for one file too many
+                remaining_tuples_iter = (
+                    remaining_tuple + (file_bytes,)
+                    for remaining_tuple, (_, file_bytes) in zip(remaining_tuples, prefetcher)
+                )
+            pending_values_iter = itertools.chain(probed_values, ex.backend_imap(
+                stack = stack,
+                backend = backend,
+                plan = plan,
+                func = read_tif_get_agg_value_by_tuple_partial,
+                iterable = remaining_tuples_iter,
+                pool = pool,
+                load_func = read_tif_load_agg_inputs_by_tuple_partial,
+                reduce_func = reduce_agg_inputs_partial,
+            ))
+
+        n_computed = 0
+        for i in tqdm.tqdm(range(len(filepath_filetype_method_multiplier_tuples))):
+            if cache is not None and cache_keys[i] in cached_values:
+                if metrics is not None:
+                    metrics.add(is_cached=True)
+                yield cached_values[cache_keys[i]]
+                continue
+            if i in archived_values:
+                value = archived_values[i]
+                if metrics is not None:
+                    metrics.add(is_cached=True)
+            else:
+                try:
+                    value = next(pending_values_iter)
+                except Exception:
+                    if metrics is not None:
+                        metrics.add_errors()
+                    raise
+                n_computed += 1
+                # the probed files were not prefetched
+                if prefetcher is not None and n_computed > len(probed_values):
+                    prefetcher.release()
+                if metrics is not None:
+                    value, busy_seconds = value
+                    metrics.add(
+                        source_bytes = os.path.getsize(filepath_filetype_method_multiplier_tuples[i][0]),
+                        busy_seconds = busy_seconds,
+                    )
+            if cache is not None:
+                computed_values[cache_keys[i]] = value
+            yield value
+
+    if cache is not None:
+        cache.put_many(key_value_dict=computed_values)
+
+
+def read_tifs_get_agg_value(
+    catalogue_df:pd.DataFrame,
+    shapes_gdf:gpd.geopandas,
+    val_col:str,
+    working_folderpath:str,
+    date_col:str = fmcf.COL_DATE,
+    method_col:str = COL_METHOD,
+    tif_filepath_col:str = fmcf.COL_TIF_FILEPATH,
+    filetype_col:str = fmcf.COL_FILETYPE,
+    multiplier_col:str = fmcf.COL_MULTIPLIER,
+    aggregation:str = 'mean',
+    reference_tif_filepath:str = None,
+    njobs:int = ws.DEFAULT_NJOBS,
+    cache_filepath:str = None,
+    cache_max_bytes:int = avc.DEFAULT_MAX_BYTES,
+    cache_file_identity:str = avc.FILE_IDENTITY_STAT,
+    pool = None,
+    backend:str = ex.DEFAULT_BACKEND,
+    prefetch_files:int = 0,
+    prefetch_max_bytes:int = pf.DEFAULT_PREFETCH_MAX_BYTES,
+    tif_cache_folderpath:str = None,
+    tif_cache_max_bytes:int = tc.DEFAULT_MAX_BYTES,
+    regional_archive_folderpath:str = None,
+    metrics:pm.ProgressMetrics = None,
+    simplify_pixels:float = None,
+):  
+    """
+    aggregation can be a list of aggregations (keys of AGGREGATION_DICT or
+    callables), all computed from a single read of each file, see
+    get_val_cols for the naming of the resulting columns.
+    """
+    updated_catalogue_df = catalogue_df.copy(deep=True)
+
+    val_cols = get_val_cols(aggregation=aggregation, val_col=val_col)
+
+    values = list(iter_tifs_agg_value(
+        catalogue_df = catalogue_df,
+        shapes_gdf = shapes_gdf,
+        working_folderpath = working_folderpath,
+        date_col = date_col,
+        method_col = method_col,
+        tif_filepath_col = tif_filepath_col,
+        filetype_col = filetype_col,
+        multiplier_col = multiplier_col,
+        aggregation = aggregation,
+        reference_tif_filepath = reference_tif_filepath,
+        njobs = njobs,
+        cache_filepath = cache_filepath,
+        cache_max_bytes = cache_max_bytes,
+        cache_file_identity = cache_file_identity,
+        pool = pool,
+        backend = backend,
+        prefetch_files = prefetch_files,
+        prefetch_max_bytes = prefetch_max_bytes,
+        tif_cache_folderpath = tif_cache_folderpath,
+        tif_cache_max_bytes = tif_cache_max_bytes,
+        regional_archive_folderpath = regional_archive_folderpath,
+        metrics = metrics,
+        simplify_pixels = simplify_pixels,
+    ))
+
+    if is_multi_aggregation(aggregation):
+        for _val_col, _values in zip(val_cols, zip(*values)):
+            updated_catalogue_df[_val_col] = list(_values)
+    else:
+        updated_catalogue_df[val_col] = values
     
     return updated_catalogue_df
+
+
+def read_tifs_get_temporal_agg_values(
+    catalogue_df:pd.DataFrame,
+    shapes_gdf:gpd.GeoDataFrame,
+    val_col:str,
+    working_folderpath:str,
+    period:str = ta.TemporalPeriod.MONTH,
+    reductions:list[str] = [ta.TemporalReduction.SUM],
+    rainy_day_threshold:float = ta.DEFAULT_RAINY_DAY_THRESHOLD,
+    date_col:str = fmcf.COL_DATE,
+    method_col:str = COL_METHOD,
+    tif_filepath_col:str = fmcf.COL_TIF_FILEPATH,
+    filetype_col:str = fmcf.COL_FILETYPE,
+    multiplier_col:str = fmcf.COL_MULTIPLIER,
+    aggregation:str = 'mean',
+    reference_tif_filepath:str = None,
+    njobs:int = ws.DEFAULT_NJOBS,
+    cache_filepath:str = None,
+    cache_max_bytes:int = avc.DEFAULT_MAX_BYTES,
+    cache_file_identity:str = avc.FILE_IDENTITY_STAT,
+    pool = None,
+    backend:str = ex.DEFAULT_BACKEND,
+    prefetch_files:int = 0,
+    prefetch_max_bytes:int = pf.DEFAULT_PREFETCH_MAX_BYTES,
+    tif_cache_folderpath:str = None,
+    tif_cache_max_bytes:int = tc.DEFAULT_MAX_BYTES,
+    regional_archive_folderpath:str = None,
+    metrics:pm.ProgressMetrics = None,
+    simplify_pixels:float = None,
+):
+    """
+    Reduces the per-file aggregated values to dekadal / monthly / seasonal
+    values. The daily values are fed to running accumulators in date order as
+    they come out of the pool, so only the currently open period is held in
+    memory.
+
+    With a list of aggregations each reduction gets one column per aggregation,
+    named '{reduction} {val_col}' with the val_cols of get_val_cols.
+    """
+    val_cols = get_val_cols(aggregation=aggregation, val_col=val_col)
+
+    sorted_catalogue_df = catalogue_df.sort_values(
+        by = date_col,
+    ).reset_index(drop=True)
+
+    temporal_accumulator = ta.TemporalAccumulator(
+        period = period,
+        reductions = reductions,
+        rainy_day_threshold = rainy_day_threshold,
+    )
+
+    values_iter = iter_tifs_agg_value(
+        catalogue_df = sorted_catalogue_df,
+        shapes_gdf = shapes_gdf,
+        working_folderpath = working_folderpath,
+        date_col = date_col,
+        method_col = method_col,
+        tif_filepath_col = tif_filepath_col,
+        filetype_col = filetype_col,
+        multiplier_col = multiplier_col,
+        aggregation = aggregation,
+        reference_tif_filepath = reference_tif_filepath,
+        njobs = njobs,
+        cache_filepath = cache_filepath,
+        cache_max_bytes = cache_max_bytes,
+        cache_file_identity = cache_file_identity,
+        pool = pool,
+        backend = backend,
+        prefetch_files = prefetch_files,
+        prefetch_max_bytes = prefetch_max_bytes,
+        tif_cache_folderpath = tif_cache_folderpath,
+        tif_cache_max_bytes = tif_cache_max_bytes,
+        regional_archive_folderpath = regional_archive_folderpath,
+        metrics = metrics,
+        simplify_pixels = simplify_pixels,
+    )
+
+    rows = []
+    # values_iter comes first in zip so that it is run to exhaustion, which
+    # is when the cache gets written.
+    for value, date in zip(values_iter, sorted_catalogue_df[date_col]):
+        rows += temporal_accumulator.add(date=date, value=value)
+    rows += temporal_accumulator.finalize()
+
+    temporal_agg_df = pd.DataFrame(
+        data = [
+            ta.flatten_row(row=row, reductions=reductions, val_cols=val_cols)
+            for row in rows
+        ],
+        columns = [ta.COL_PERIOD_START, ta.COL_PERIOD_END, ta.COL_N_DAYS] \
+            + ta.get_reduction_cols(reductions=reductions, val_cols=val_cols),
+    )
+
+    return temporal_agg_df
+
+
+def read_tif_load_grouped_agg_inputs(
+    filepath:str,
+    filetype:str,
+    method:str,
+    multiplier:float,
+    label_pixels_filepath:str,
+    src_transform,
+    tif_cache:tc.TIFCache = None,
+):
+    """
+    I/O part of read_tif_get_grouped_agg_values: returns (window_values,
+    label_pixels_filepath), see reduce_grouped_agg_inputs.
+    """
+    if method not in [LoadTIFMethod.READ_AND_CROP, LoadTIFMethod.READ_NO_CROP]:
+        raise ValueError(f'Invalid method={method} for grouped aggregation.')
+
+    window_values = read_tif_label_window(
+        filepath = filepath,
+        filetype = filetype,
+        multiplier = multiplier,
+        label_pixels = lr.load_label_pixels(filepath=label_pixels_filepath),
+        src_transform = src_transform,
+        tif_cache = tif_cache,
+    )
+
+    return window_values, label_pixels_filepath
+
+
+def reduce_grouped_agg_inputs(
+    window_values_labelpath:tuple[np.ndarray,str],
+    aggregation:str,
+):
+    window_values, label_pixels_filepath = window_values_labelpath
+    return lr.grouped_reduce(
+        window_values = window_values,
+        label_pixels = lr.load_label_pixels(filepath=label_pixels_filepath),
+        aggregation = aggregation,
+    )
+
+
+def read_tif_get_grouped_agg_values(
+    filepath:str,
+    filetype:str,
+    method:str,
+    multiplier:float,
+    aggregation:str,
+    label_pixels_filepath:str,
+    src_transform,
+    tif_cache:tc.TIFCache = None,
+):
+    return reduce_grouped_agg_inputs(
+        window_values_labelpath = read_tif_load_grouped_agg_inputs(
+            filepath = filepath,
+            filetype = filetype,
+            method = method,
+            multiplier = multiplier,
+            label_pixels_filepath = label_pixels_filepath,
+            src_transform = src_transform,
+            tif_cache = tif_cache,
+        ),
+        aggregation = aggregation,
+    )
+
+
+def read_tif_label_window(
+    filepath:str,
+    filetype:str,
+    multiplier:float,
+    label_pixels:dict,
+    src_transform,
+    tif_cache:tc.TIFCache = None,
+):
+    """
+    Values of the union window of label_pixels (see label_raster.py), NaN for
+    nodata, to be passed to lr.grouped_reduce.
+    """
+    if tif_cache is not None and filetype == fmcf.EXT_TIF_GZ:
+        tif_filepath = tif_cache.get_tif_filepath(filepath=filepath, filetype=filetype)
+    else:
+        tif_filepath = fmcf.get_gdal_filepath(filepath=filepath, filetype=filetype)
+
+    with rasterio.open(tif_filepath) as src:
+        if src.transform != src_transform:
+            raise ValueError(
+                f'{filepath} is not on the same grid as the first file of the catalogue.'
+            )
+        window_values = src.read(1, window=lr.get_rasterio_window(label_pixels))
+        nodata = src.nodata
+
+    window_values = mask_nodata_and_apply_multiplier(
+        image = window_values.astype(float),
+        multiplier = multiplier,
+        nodata = nodata,
+    )
+
+    return window_values
+
+
+def read_tif_get_grouped_agg_values_by_tuple(
+    filepath_filetype_method_multiplier_labelpath:tuple[str,str,str,float,str],
+    **kwargs,
+):
+    filepath, filetype, method, multiplier, label_pixels_filepath \
+        = filepath_filetype_method_multiplier_labelpath
+    return read_tif_get_grouped_agg_values(
+        filepath = filepath,
+        filetype = filetype,
+        method = method,
+        multiplier = multiplier,
+        label_pixels_filepath = label_pixels_filepath,
+        **kwargs,
+    )
+
+
+def read_tif_load_grouped_agg_inputs_by_tuple(
+    filepath_filetype_method_multiplier_labelpath:tuple[str,str,str,float,str],
+    **kwargs,
+):
+    filepath, filetype, method, multiplier, label_pixels_filepath \
+        = filepath_filetype_method_multiplier_labelpath
+    return read_tif_load_grouped_agg_inputs(
+        filepath = filepath,
+        filetype = filetype,
+        method = method,
+        multiplier = multiplier,
+        label_pixels_filepath = label_pixels_filepath,
+        **kwargs,
+    )
+
+
+def get_geometry_ids(shapes_gdf:gpd.GeoDataFrame, id_col:str = None):
+    """
+    Returns (id_col, ids) of the geometries in shapes_gdf, the index if id_col
+    is None.
+    """
+    if id_col is None:
+        id_col = 'id' if shapes_gdf.index.name is None else shapes_gdf.index.name
+        ids = shapes_gdf.index.to_numpy()
+    else:
+        ids = shapes_gdf[id_col].to_numpy()
+    return id_col, ids
+
+
+def read_tifs_get_agg_values_by_geometry(
+    catalogue_df:pd.DataFrame,
+    shapes_gdf:gpd.GeoDataFrame,
+    val_col:str,
+    working_folderpath:str,
+    id_col:str = None,
+    date_col:str = fmcf.COL_DATE,
+    method_col:str = COL_METHOD,
+    tif_filepath_col:str = fmcf.COL_TIF_FILEPATH,
+    filetype_col:str = fmcf.COL_FILETYPE,
+    multiplier_col:str = fmcf.COL_MULTIPLIER,
+    aggregation:str = 'mean',
+    bounds_gdf:gpd.GeoDataFrame = None,
+    cluster_cell_size:float = rp.DEFAULT_CLUSTER_CELL_SIZE,
+    max_geoms_per_cluster:int = rp.DEFAULT_MAX_GEOMS_PER_CLUSTER,
+    njobs:int = ws.DEFAULT_NJOBS,
+    pool = None,
+    backend:str = ex.DEFAULT_BACKEND,
+    tif_cache_folderpath:str = None,
+    tif_cache_max_bytes:int = tc.DEFAULT_MAX_BYTES,
+    metrics:pm.ProgressMetrics = None,
+    simplify_pixels:float = None,
+):
+    """
+    One value per (catalogue row, geometry) for a shapes_gdf with many
+    geometries. The geometries are prepared as in iter_tifs_agg_value
+    (reprojected, repaired, simplified with a tolerance of simplify_pixels
+    pixels if given) and then planned (see roi_planning.py):
+    the ones outside bounds_gdf (CHIRPS coverage if None) are dropped and get
+    NaN, the rest are grouped into spatially compact clusters. Each cluster is
+    rasterized once into a label raster (see label_raster.py), after which a
+    (file, cluster) task costs one windowed read and a grouped numpy reduction
+    regardless of the number of geometries in it.
+
+    Returns a long dataframe with columns date, year, day, id_col (the index
+    of shapes_gdf if id_col is None) and val_col.
+
+    pool, backend, tif_cache_folderpath, metrics: see iter_tifs_agg_value. With
+    hybrid, the windows are read on threads and the grouped reductions run on
+    processes. A file counts as done in metrics once all of its clusters are.
+    """
+    if aggregation not in lr.GROUPED_AGGREGATIONS:
+        raise ValueError(f'Invalid aggregation={aggregation}. Valid aggregations: {lr.GROUPED_AGGREGATIONS}')
+
+    if catalogue_df.shape[0] == 0:
+        raise ValueError('catalogue_df is empty.')
+
+    first_row = catalogue_df.iloc[0]
+    first_tif_filepath = fmcf.get_gdal_filepath(
+        filepath = first_row[tif_filepath_col],
+        filetype = first_row[filetype_col],
+    )
+    with rasterio.open(first_tif_filepath) as src:
+        src_crs = src.crs
+        src_transform = src.transform
+        raster_height, raster_width = src.height, src.width
+
+    geometries = prepare_geometries_for_tif(
+        shapes_gdf = shapes_gdf,
+        tif_filepath = first_tif_filepath,
+        simplify_pixels = simplify_pixels,
+    )
+
+    # index of planned_gdf is the position of the geometry in shapes_gdf
+    planned_gdf = rp.plan_rois(
+        shapes_gdf = geometries.get_gdf(),
+        raster_crs = src_crs,
+        bounds_gdf = bounds_gdf,
+        cell_size = cluster_cell_size,
+        max_geoms_per_cluster = max_geoms_per_cluster,
+    )
+
+    cluster_positions = []
+    label_pixels_filepaths = []
+    try:
+        for _, cluster_gdf in planned_gdf.groupby(rp.COL_CLUSTER, sort=True):
+            cluster_positions.append(cluster_gdf.index.to_numpy())
+            label_pixels_filepaths.append(lr.save_label_pixels(
+                label_pixels = lr.build_label_pixels(
+                    geometries = list(cluster_gdf['geometry']),
+                    transform = src_transform,
+                    raster_height = raster_height,
+                    raster_width = raster_width,
+                ),
+                folderpath = working_folderpath,
+            ))
+
+        print(f'Geometries: {planned_gdf.shape[0]} / {shapes_gdf.shape[0]} '
+              f'in {len(cluster_positions)} clusters')
+
+        tif_cache = None if tif_cache_folderpath is None else tc.TIFCache(
+            folderpath = tif_cache_folderpath,
+            max_bytes = tif_cache_max_bytes,
+        )
+        read_tif_get_grouped_agg_values_by_tuple_partial = functools.partial(
+            read_tif_get_grouped_agg_values_by_tuple,
+            aggregation = aggregation,
+            src_transform = src_transform,
+            tif_cache = tif_cache,
+        )
+        read_tif_load_grouped_agg_inputs_by_tuple_partial = functools.partial(
+            read_tif_load_grouped_agg_inputs_by_tuple,
+            src_transform = src_transform,
+            tif_cache = tif_cache,
+        )
+        reduce_grouped_agg_inputs_partial = functools.partial(
+            reduce_grouped_agg_inputs,
+            aggregation = aggregation,
+        )
+
+        # file-major order so that consecutive tasks read the same file
+        filepath_filetype_method_multiplier_labelpath_tuples = [
+            (filepath, filetype, method, multiplier, label_pixels_filepath)
+            for filepath, filetype, method, multiplier in zip(
+                catalogue_df[tif_filepath_col],
+                catalogue_df[filetype_col],
+                catalogue_df[method_col],
+                catalogue_df[multiplier_col],
+            )
+            for label_pixels_filepath in label_pixels_filepaths
+        ]
+
+        n_files = catalogue_df.shape[0]
+        n_clusters = len(label_pixels_filepaths)
+        n_geoms = shapes_gdf.shape[0]
+        values = np.full((n_files, n_geoms), np.nan)
+
+        if metrics is not None:
+            metrics.add_expected(n_files)
+            read_tif_get_grouped_agg_values_by_tuple_partial = functools.partial(
+                pm.timed_call, read_tif_get_grouped_agg_values_by_tuple_partial,
+            )
+            read_tif_load_grouped_agg_inputs_by_tuple_partial = functools.partial(
+                pm.timed_call, read_tif_load_grouped_agg_inputs_by_tuple_partial,
+            )
+            reduce_grouped_agg_inputs_partial = functools.partial(
+                pm.timed_reduce, reduce_grouped_agg_inputs_partial,
+            )
+
+        with contextlib.ExitStack() as stack:
+            if n_clusters > 0:
+                plan = ws.plan_workers(
+                    n_tasks = len(filepath_filetype_method_multiplier_labelpath_tuples),
+                    njobs = njobs,
+                    label = f'read_tifs_get_agg_values_by_geometry ({backend})',
+                )
+                if metrics is not None:
+                    metrics.set_n_workers(plan.n_workers)
+                busy_seconds = 0.0
+                try:
+                    for task_index, cluster_values in enumerate(tqdm.tqdm(
+                        ex.backend_imap(
+                            stack = stack,
+                            backend = backend,
+                            plan = plan,
+                            func = read_tif_get_grouped_agg_values_by_tuple_partial,
+                            iterable = filepath_filetype_method_multiplier_labelpath_tuples,
+                            pool = pool,
+                            load_func = read_tif_load_grouped_agg_inputs_by_tuple_partial,
+                            reduce_func = reduce_grouped_agg_inputs_partial,
+                        ),
+                        total = len(filepath_filetype_method_multiplier_labelpath_tuples),
+                    )):
+                        file_index, cluster_index = divmod(task_index, n_clusters)
+                        if metrics is not None:
+                            cluster_values, task_busy_seconds = cluster_values
+                            busy_seconds += task_busy_seconds
+                            if cluster_index == n_clusters - 1:
+                                metrics.add(
+                                    source_bytes = os.path.getsize(catalogue_df[tif_filepath_col].iloc[file_index]),
+                                    busy_seconds = busy_seconds,
+                                )
+                                busy_seconds = 0.0
+                        values[file_index, cluster_positions[cluster_index]] = cluster_values
+                except Exception:
+                    if metrics is not None:
+                        metrics.add_errors()
+                    raise
+            elif metrics is not None:
+                metrics.add(n_files=n_files, is_cached=True)
+    finally:
+        # also on failure, the npz files would otherwise be left in
+        # working_folderpath
+        for label_pixels_filepath in label_pixels_filepaths:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(label_pixels_filepath)
+
+
+    id_col, ids = get_geometry_ids(shapes_gdf=shapes_gdf, id_col=id_col)
+
+    grouped_agg_df = pd.DataFrame({
+        date_col: np.repeat(catalogue_df[date_col].to_numpy(), n_geoms),
+        fmcf.COL_YEAR: np.repeat(catalogue_df[fmcf.COL_YEAR].to_numpy(), n_geoms),
+        fmcf.COL_DAY: np.repeat(catalogue_df[fmcf.COL_DAY].to_numpy(), n_geoms),
+        id_col: np.tile(ids, n_files),
+        val_col: values.ravel(),
+    })
+
+    return grouped_agg_df
+
+
+def read_tifs_get_temporal_agg_values_by_geometry(
+    catalogue_df:pd.DataFrame,
+    shapes_gdf:gpd.GeoDataFrame,
+    val_col:str,
+    working_folderpath:str,
+    id_col:str = None,
+    period:str = ta.TemporalPeriod.MONTH,
+    reductions:list[str] = [ta.TemporalReduction.SUM],
+    rainy_day_threshold:float = ta.DEFAULT_RAINY_DAY_THRESHOLD,
+    date_col:str = fmcf.COL_DATE,
+    method_col:str = COL_METHOD,
+    tif_filepath_col:str = fmcf.COL_TIF_FILEPATH,
+    filetype_col:str = fmcf.COL_FILETYPE,
+    multiplier_col:str = fmcf.COL_MULTIPLIER,
+    aggregation:str = 'mean',
+    bounds_gdf:gpd.GeoDataFrame = None,
+    cluster_cell_size:float = rp.DEFAULT_CLUSTER_CELL_SIZE,
+    max_geoms_per_cluster:int = rp.DEFAULT_MAX_GEOMS_PER_CLUSTER,
+    njobs:int = ws.DEFAULT_NJOBS,
+    pool = None,
+    backend:str = ex.DEFAULT_BACKEND,
+    tif_cache_folderpath:str = None,
+    tif_cache_max_bytes:int = tc.DEFAULT_MAX_BYTES,
+    metrics:pm.ProgressMetrics = None,
+    simplify_pixels:float = None,
+):
+    """
+    read_tifs_get_temporal_agg_values for each geometry of shapes_gdf: the daily
+    values of read_tifs_get_agg_values_by_geometry are fed to the accumulators
+    as one array per date, so the reductions are applied per geometry.
+
+    Returns a long dataframe with columns period_start, period_end, n_days,
+    id_col (see read_tifs_get_agg_values_by_geometry) and '{reduction} {val_col}'
+    for each reduction.
+    """
+    sorted_catalogue_df = catalogue_df.sort_values(
+        by = date_col,
+    ).reset_index(drop=True)
+
+    grouped_agg_df = read_tifs_get_agg_values_by_geometry(
+        catalogue_df = sorted_catalogue_df,
+        shapes_gdf = shapes_gdf,
+        val_col = val_col,
+        working_folderpath = working_folderpath,
+        id_col = id_col,
+        date_col = date_col,
+        method_col = method_col,
+        tif_filepath_col = tif_filepath_col,
+        filetype_col = filetype_col,
+        multiplier_col = multiplier_col,
+        aggregation = aggregation,
+        bounds_gdf = bounds_gdf,
+        cluster_cell_size = cluster_cell_size,
+        max_geoms_per_cluster = max_geoms_per_cluster,
+        njobs = njobs,
+        pool = pool,
+        backend = backend,
+        tif_cache_folderpath = tif_cache_folderpath,
+        tif_cache_max_bytes = tif_cache_max_bytes,
+        metrics = metrics,
+        simplify_pixels = simplify_pixels,
+    )
+
+    id_col, ids = get_geometry_ids(shapes_gdf=shapes_gdf, id_col=id_col)
+    n_files, n_geoms = sorted_catalogue_df.shape[0], ids.shape[0]
+
+    # grouped_agg_df has n_geoms rows per file, in the order of
+    # sorted_catalogue_df and then of shapes_gdf
+    values = grouped_agg_df[val_col].to_numpy().reshape(n_files, n_geoms)
+
+    temporal_accumulator = ta.TemporalAccumulator(
+        period = period,
+        reductions = reductions,
+        rainy_day_threshold = rainy_day_threshold,
+    )
+
+    rows = []
+    for date, _values in zip(sorted_catalogue_df[date_col], values):
+        rows += temporal_accumulator.add(date=date, value=_values)
+    rows += temporal_accumulator.finalize()
+
+    reduction_cols = ta.get_reduction_cols(reductions=reductions, val_cols=[val_col])
+    data = {
+        ta.COL_PERIOD_START: np.repeat([row[ta.COL_PERIOD_START] for row in rows], n_geoms),
+        ta.COL_PERIOD_END: np.repeat([row[ta.COL_PERIOD_END] for row in rows], n_geoms),
+        ta.COL_N_DAYS: np.repeat([row[ta.COL_N_DAYS] for row in rows], n_geoms),
+        id_col: np.tile(ids, len(rows)),
+    }
+    for reduction, reduction_col in zip(reductions, reduction_cols):
+        data[reduction_col] = np.concatenate([
+            np.broadcast_to(row[reduction], (n_geoms,)) for row in rows
+        ]) if len(rows) > 0 else np.array([], dtype=float)
+
+    temporal_agg_df = pd.DataFrame(data)
+
+    return temporal_agg_df
@@ -0,0 +1,273 @@
+from __future__ import annotations
+
+import os
+import numpy as np
+import multiprocessing as mp
+import functools
+import contextlib
+
+from lazy_imports import lazy_import
+
+pd = lazy_import('pandas')
+gpd = lazy_import('geopandas')
+rasterio = lazy_import('rasterio', submodules=['windows', 'features'])
+tqdm = lazy_import('tqdm')
+
+import fetch_missing_chirps_files as fmcf
+import read_tifs_create_met as rtcm
+import worker_sizing as ws
+
+
+"""
+Clips the daily CHIRPS pixels for an ROI and writes them as a single
+time-stacked, multi-band GeoTIFF (one band per date, band description set to
+the date). For READ_AND_CROP and READ_NO_CROP the files are read with a
+window computed once upfront (.tif.gz files are read through /vsigzip/, so
+nothing is decompressed to disk), for COREGISTER_AND_CROP each file goes
+through rtcm.load_tif.
+"""
+
+
+DEFAULT_CHUNK_SIZE = 64
+# memory of the dates held before being written, caps chunk_size for large
+# windows (a READ_NO_CROP global p05 band is 7200 x 2000 float32 = 55 MB)
+DEFAULT_CHUNK_MAX_BYTES = 512 * 2**20
+
+
+def get_roi_window(
+    tif_filepath:str,
+    shapes_gdf:gpd.GeoDataFrame,
+):
+    """
+    Returns the window of the raster grid that covers shapes_gdf along with
+    its transform, crs, and a mask which is True for pixels outside the
+    geometries.
+    """
+    with rasterio.open(tif_filepath) as src:
+        crs = src.crs
+        src_transform = src.transform
+        shapes = shapes_gdf.to_crs(crs)['geometry']
+        window = rasterio.features.geometry_window(
+            dataset = src,
+            shapes = shapes,
+        )
+    window_transform = rasterio.windows.transform(window, src_transform)
+
+    outside_mask = rasterio.features.geometry_mask(
+        geometries = shapes,
+        out_shape = (int(window.height), int(window.width)),
+        transform = window_transform,
+    )
+
+    return window, window_transform, crs, src_transform, outside_mask
+
+
+def read_tif_window(
+    filepath:str,
+    filetype:str,
+    method:str,
+    multiplier:float,
+    window:rasterio.windows.Window,
+    src_transform,
+    outside_mask:np.ndarray,
+    shapes_gdf:gpd.GeoDataFrame,
+    working_folderpath:str,
+    reference_tif_filepath:str = None,
+):
+    if method in [rtcm.LoadTIFMethod.READ_AND_CROP, rtcm.LoadTIFMethod.READ_NO_CROP]:
+        gdal_filepath = fmcf.get_gdal_filepath(filepath=filepath, filetype=filetype)
+        with rasterio.open(gdal_filepath) as src:
+            if src.transform != src_transform:
+                raise ValueError(
+                    f'{filepath} is not on the same grid as the first file '
+                    'of the catalogue. Use method='
+                    f'{rtcm.LoadTIFMethod.COREGISTER_AND_CROP} instead.'
+                )
+            out_image = src.read(1, window=window)
+            nodata = src.nodata
+
+    elif method == rtcm.LoadTIFMethod.COREGISTER_AND_CROP:
+        if filetype == fmcf.EXT_TIF_GZ:
+            gzip_file = rtcm.utils.GZipTIF(gzip_tif_filepath=filepath)
+            tif_filepath = gzip_file.decompress_and_load()
+        else:
+            tif_filepath = filepath
+        out_image, out_meta = rtcm.load_tif(
+            tif_filepath = tif_filepath,
+            shapes_gdf = shapes_gdf,
+            reference_tif_filepath = reference_tif_filepath,
+            method = method,
+            working_folderpath = working_folderpath,
+        )
+        out_image = out_image[0]
+        nodata = out_meta.get('nodata')
+        if filetype == fmcf.EXT_TIF_GZ:
+            gzip_file.delete_tif()
+        if out_image.shape != outside_mask.shape:
+            raise ValueError(
+                f'Coregistered crop of {filepath} has shape {out_image.shape}, '
+                f'expected {outside_mask.shape}.'
+            )
+
+    else:
+        raise ValueError(f'Invalid method={method}')
+
+    out_image = rtcm.mask_nodata_and_apply_multiplier(
+        image = out_image.astype(np.float32),
+        multiplier = multiplier,
+        nodata = nodata,
+    )
+    if method != rtcm.LoadTIFMethod.READ_NO_CROP:
+        out_image[outside_mask] = np.nan
+
+    return out_image
+
+
+def read_tif_window_by_tuple(
+    filepath_filetype_method_multiplier:tuple[str,str,str,float],
+    **kwargs,
+):
+    filepath, filetype, method, multiplier = filepath_filetype_method_multiplier
+    return read_tif_window(
+        filepath = filepath,
+        filetype = filetype,
+        method = method,
+        multiplier = multiplier,
+        **kwargs,
+    )
+
+
+def read_tifs_create_stack(
+    catalogue_df:pd.DataFrame,
+    shapes_gdf:gpd.GeoDataFrame,
+    export_filepath:str,
+    working_folderpath:str,
+    date_col:str = fmcf.COL_DATE,
+    method_col:str = rtcm.COL_METHOD,
+    tif_filepath_col:str = fmcf.COL_TIF_FILEPATH,
+    filetype_col:str = fmcf.COL_FILETYPE,
+    multiplier_col:str = fmcf.COL_MULTIPLIER,
+    reference_tif_filepath:str = None,
+    chunk_size:int = DEFAULT_CHUNK_SIZE,
+    njobs:int = ws.DEFAULT_NJOBS,
+    pool = None,
+    chunk_max_bytes:int = DEFAULT_CHUNK_MAX_BYTES,
+):
+    """
+    Up to chunk_size dates are held in memory before being written, fewer
+    if they would take more than chunk_max_bytes (at least one).
+    """
+    if catalogue_df.shape[0] == 0:
+        raise ValueError('catalogue_df is empty.')
+
+    sorted_catalogue_df = catalogue_df.sort_values(
+        by = date_col,
+    ).reset_index(drop=True)
+
+    methods = set(sorted_catalogue_df[method_col])
+    if len(methods) > 1:
+        raise ValueError(f'All rows need to have the same method. Found: {methods}')
+    method = methods.pop()
+
+    if method == rtcm.LoadTIFMethod.COREGISTER_AND_CROP:
+        if reference_tif_filepath is None:
+            raise ValueError(f'reference_tif_filepath can not be None for method={method}')
+        grid_tif_filepath = reference_tif_filepath
+    else:
+        grid_tif_filepath = fmcf.get_gdal_filepath(
+            filepath = sorted_catalogue_df[tif_filepath_col].iloc[0],
+            filetype = sorted_catalogue_df[filetype_col].iloc[0],
+        )
+
+    if method == rtcm.LoadTIFMethod.READ_NO_CROP:
+        with rasterio.open(grid_tif_filepath) as src:
+            crs = src.crs
+            src_transform = src.transform
+            window = rasterio.windows.Window(0, 0, src.width, src.height)
+        window_transform = src_transform
+        outside_mask = np.zeros((int(window.height), int(window.width)), dtype=bool)
+    else:
+        window, window_transform, crs, src_transform, outside_mask = get_roi_window(
+            tif_filepath = grid_tif_filepath,
+            shapes_gdf = shapes_gdf,
+        )
+
+    height, width = outside_mask.shape
+    n_dates = sorted_catalogue_df.shape[0]
+
+    read_tif_window_by_tuple_partial = functools.partial(
+        read_tif_window_by_tuple,
+        window = window,
+        src_transform = src_transform,
+        outside_mask = outside_mask,
+        shapes_gdf = shapes_gdf,
+        working_folderpath = working_folderpath,
+        reference_tif_filepath = reference_tif_filepath,
+    )
+
+    filepath_filetype_method_multiplier_tuples = list(zip(
+        sorted_catalogue_df[tif_filepath_col],
+        sorted_catalogue_df[filetype_col],
+        sorted_catalogue_df[method_col],
+        sorted_catalogue_df[multiplier_col],
+    ))
+
+    dates = [date.strftime('%Y-%m-%d') for date in sorted_catalogue_df[date_col]]
+
+    export_folderpath = os.path.split(export_filepath)[0]
+    if export_folderpath != '':
+        os.makedirs(export_folderpath, exist_ok=True)
+
+    out_meta = {
+        'driver': 'GTiff',
+        'dtype': 'float32',
+        'nodata': np.nan,
+        'width': width,
+        'height': height,
+        'count': n_dates,
+        'crs': crs,
+        'transform': window_transform,
+        'tiled': True,
+        'blockxsize': 256,
+        'blockysize': 256,
+        'compress': 'deflate',
+        'predictor': 3,
+        'interleave': 'band',
+        'BIGTIFF': 'IF_SAFER',
+    }
+    # blocks can not be larger than the raster for small ROIs
+    if width < 256 or height < 256:
+        out_meta['tiled'] = False
+        del out_meta['blockxsize'], out_meta['blockysize']
+
+    chunk_size = max(1, min(
+        chunk_size, n_dates, chunk_max_bytes // (height * width * np.dtype(np.float32).itemsize),
+    ))
+    chunk = np.empty((chunk_size, height, width), dtype=np.float32)
+
+    with rasterio.open(export_filepath, 'w', **out_meta) as dst, \
+        contextlib.ExitStack() as stack:
+        p = pool if pool is not None else stack.enter_context(mp.Pool(ws.resolve_njobs(njobs)))
+        chunk_start = 0
+        n_filled = 0
+        for out_image in tqdm.tqdm(
+            p.imap(
+                read_tif_window_by_tuple_partial,
+                filepath_filetype_method_multiplier_tuples,
+            ),
+            total = n_dates,
+        ):
+            chunk[n_filled] = out_image
+            n_filled += 1
+            if n_filled == chunk_size:
+                dst.write(chunk, indexes=list(range(chunk_start + 1, chunk_start + n_filled + 1)))
+                chunk_start += n_filled
+                n_filled = 0
+        if n_filled > 0:
+            dst.write(chunk[:n_filled], indexes=list(range(chunk_start + 1, chunk_start + n_filled + 1)))
+
+        for band_index, date in enumerate(dates, start=1):
+            dst.set_band_description(band_index, date)
+        dst.update_tags(dates=','.join(dates))
+
+    return export_filepath
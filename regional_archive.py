@@ -0,0 +1,507 @@
+from __future__ import annotations
+
+import os
+import json
+import datetime
+import types
+import numpy as np
+
+from lazy_imports import lazy_import
+
+pd = lazy_import('pandas')
+gpd = lazy_import('geopandas')
+shapely = lazy_import('shapely')
+rasterio = lazy_import('rasterio', submodules=['features', 'windows'])
+affine = lazy_import('affine')
+
+import fetch_missing_chirps_files as fmcf
+import read_tifs_create_met as rtcm
+import read_tifs_create_stack as rtcs
+import agg_value_cache as avc
+import worker_sizing as ws
+
+
+"""
+Pre-clipped archives of frequently queried regions (e.g. Ukraine, East
+Africa). A region is a named bounding box, snapped outwards to the CHIRPS
+grid, for which the daily files of one product are clipped once into
+per-month time stacks with rtcs.read_tifs_create_stack (one band per date,
+tiled and compressed). Layout:
+
+    ARCHIVE_FOLDERPATH/PRODUCT/REGION/region.json
+    ARCHIVE_FOLDERPATH/PRODUCT/REGION/REGION.YEAR.MONTH.tif
+
+Each stack records, in its 'sources' tag, the source file of every band
+along with its identity (path, size, mtime) and multiplier, and the
+STACK_VERSION it was written with. A month is rebuilt when its sources
+change (new dates, re-downloaded files) or STACK_VERSION does, which is what
+update_regional_archives does after fmcf.fetch_missing_chirps_files. A stack
+is a single GeoTIFF that can not be appended to, so the unit is a month
+rather than a year: a daily update rewrites at most 31 bands per region.
+
+rtcm.iter_tifs_agg_value looks up the files it is asked for in the regions
+that contain the ROI (get_archived_agg_values) and reads all the dates of a
+month with a single windowed read of the stack instead of one read of a
+global raster per date. Files that are not in a region, or whose identity no longer
+matches, are read from the source as before, so a stale archive never gives
+different values.
+"""
+
+
+REGION_METADATA_FILENAME = 'region.json'
+TAG_SOURCES = 'sources'
+TAG_VERSION = 'version'
+# stored with the sources, bumped whenever the values written for the same
+# sources change, so that the stacks of earlier versions are rebuilt and
+# never read
+# 2: NODATA masked before the multiplier is applied
+STACK_VERSION = 2
+EXT_STACK = '.tif'
+
+
+def get_region_folderpath(
+    archive_folderpath:str,
+    product:str,
+    region_name:str,
+):
+    return os.path.join(archive_folderpath, product, region_name)
+
+
+def get_month_stack_filepath(
+    region_folderpath:str,
+    region_name:str,
+    year:int,
+    month:int,
+):
+    return os.path.join(region_folderpath, f'{region_name}.{int(year)}.{int(month):02d}{EXT_STACK}')
+
+
+def snap_bounds_to_grid(
+    bounds:tuple[float,float,float,float],
+    transform,
+):
+    """
+    Expands (minx, miny, maxx, maxy) outwards to the pixel edges of the grid
+    of transform (north up), so that every pixel of the clipped stack is
+    fully inside the region and none is masked.
+    """
+    minx, miny, maxx, maxy = bounds
+    x0, y0 = transform.c, transform.f
+    xres, yres = transform.a, -transform.e
+    return (
+        x0 + np.floor(round((minx - x0) / xres, 6)) * xres,
+        y0 - np.ceil(round((y0 - miny) / yres, 6)) * yres,
+        x0 + np.ceil(round((maxx - x0) / xres, 6)) * xres,
+        y0 - np.floor(round((y0 - maxy) / yres, 6)) * yres,
+    )
+
+
+def read_region_metadata(region_folderpath:str):
+    with open(os.path.join(region_folderpath, REGION_METADATA_FILENAME)) as f:
+        return json.load(f)
+
+
+def list_regions(
+    archive_folderpath:str,
+    product:str = None,
+):
+    """
+    Metadata of the regions in archive_folderpath (of product if given),
+    with their folderpath under 'folderpath'.
+    """
+    regions = []
+    if archive_folderpath is None or not os.path.isdir(archive_folderpath):
+        return regions
+    products = [product] if product is not None else sorted(os.listdir(archive_folderpath))
+    for _product in products:
+        product_folderpath = os.path.join(archive_folderpath, _product)
+        if not os.path.isdir(product_folderpath):
+            continue
+        for region_name in sorted(os.listdir(product_folderpath)):
+            region_folderpath = os.path.join(product_folderpath, region_name)
+            if not os.path.exists(os.path.join(region_folderpath, REGION_METADATA_FILENAME)):
+                continue
+            region = read_region_metadata(region_folderpath=region_folderpath)
+            region['folderpath'] = region_folderpath
+            regions.append(region)
+    return regions
+
+
+def get_sources(
+    catalogue_df:pd.DataFrame,
+    tif_filepath_col:str = fmcf.COL_TIF_FILEPATH,
+    multiplier_col:str = fmcf.COL_MULTIPLIER,
+):
+    """
+    [filename, identity, multiplier] of each row, as stored in the stacks.
+    """
+    return [
+        [os.path.split(filepath)[1], avc.get_file_identity(filepath=filepath), float(multiplier)]
+        for filepath, multiplier in zip(catalogue_df[tif_filepath_col], catalogue_df[multiplier_col])
+    ]
+
+
+def read_stack_sources(stack_filepath:str):
+    """
+    Sources of the stack, None if it does not exist or is of another
+    STACK_VERSION.
+    """
+    if not os.path.exists(stack_filepath):
+        return None
+    with rasterio.open(stack_filepath) as src:
+        tags = src.tags()
+    sources = tags.get(TAG_SOURCES)
+    if sources is None or tags.get(TAG_VERSION) != str(STACK_VERSION):
+        return None
+    return json.loads(sources)
+
+
+def update_region(
+    region_folderpath:str,
+    catalogue_df:pd.DataFrame,
+    working_folderpath:str = None,
+    date_col:str = fmcf.COL_DATE,
+    tif_filepath_col:str = fmcf.COL_TIF_FILEPATH,
+    njobs:int = ws.DEFAULT_NJOBS,
+    pool = None,
+):
+    """
+    (Re)builds the month stacks of the region whose sources differ from the
+    rows of catalogue_df for that month. Months not in catalogue_df are left
+    as they are. Returns the months rebuilt, as 'YYYY-MM'.
+    """
+    region = read_region_metadata(region_folderpath=region_folderpath)
+    region_name = region['name']
+    start_year = region.get('start_year')
+
+    region_gdf = gpd.GeoDataFrame(
+        geometry = [shapely.box(*region['bounds'])],
+        crs = region['crs'],
+    )
+
+    dates = pd.to_datetime(catalogue_df[date_col])
+    updated_months = []
+    for (year, month), month_catalogue_df in catalogue_df.groupby([dates.dt.year, dates.dt.month]):
+        if start_year is not None and year < start_year:
+            continue
+        month_catalogue_df = month_catalogue_df.sort_values(by=date_col, kind='stable').reset_index(drop=True)
+        month_catalogue_df[rtcm.COL_METHOD] = rtcm.LoadTIFMethod.READ_AND_CROP
+
+        stack_filepath = get_month_stack_filepath(
+            region_folderpath = region_folderpath,
+            region_name = region_name,
+            year = year,
+            month = month,
+        )
+        sources = get_sources(
+            catalogue_df = month_catalogue_df,
+            tif_filepath_col = tif_filepath_col,
+        )
+        if read_stack_sources(stack_filepath=stack_filepath) == sources:
+            continue
+
+        print(f'Regional archive {region_name}: building {year}-{month:02d} ({len(sources)} dates)')
+
+        # renamed into place once complete, readers only ever see a full stack
+        tmp_filepath = f'{stack_filepath}.{os.getpid()}.tmp'
+        try:
+            rtcs.read_tifs_create_stack(
+                catalogue_df = month_catalogue_df,
+                shapes_gdf = region_gdf,
+                export_filepath = tmp_filepath,
+                working_folderpath = working_folderpath,
+                date_col = date_col,
+                tif_filepath_col = tif_filepath_col,
+                njobs = njobs,
+                pool = pool,
+            )
+            with rasterio.open(tmp_filepath, 'r+') as dst:
+                dst.update_tags(**{
+                    TAG_SOURCES: json.dumps(sources),
+                    TAG_VERSION: str(STACK_VERSION),
+                })
+            os.replace(tmp_filepath, stack_filepath)
+        finally:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+
+        updated_months.append(f'{year}-{month:02d}')
+
+    return updated_months
+
+
+def build_regional_archive(
+    archive_folderpath:str,
+    region_name:str,
+    bounds:tuple[float,float,float,float],
+    product:str,
+    catalogue_df:pd.DataFrame,
+    working_folderpath:str = None,
+    start_year:int = None,
+    tif_filepath_col:str = fmcf.COL_TIF_FILEPATH,
+    filetype_col:str = fmcf.COL_FILETYPE,
+    njobs:int = ws.DEFAULT_NJOBS,
+    pool = None,
+):
+    """
+    Creates (or updates) the archive of region_name for bounds (minx, miny,
+    maxx, maxy in EPSG:4326) from catalogue_df, the local catalogue of
+    product. Years before start_year are not archived, now or by later
+    updates.
+    """
+    if product not in fmcf.VALID_PRODUCTS:
+        raise ValueError(f'Invalid product={product}. Must be from {fmcf.VALID_PRODUCTS}')
+    if catalogue_df.shape[0] == 0:
+        raise ValueError('catalogue_df is empty.')
+    minx, miny, maxx, maxy = bounds
+    if minx >= maxx or miny >= maxy:
+        raise ValueError(f'Invalid bounds={bounds}. Format: (minx, miny, maxx, maxy)')
+
+    with rasterio.open(fmcf.get_gdal_filepath(
+        filepath = catalogue_df[tif_filepath_col].iloc[0],
+        filetype = catalogue_df[filetype_col].iloc[0],
+    )) as src:
+        crs = src.crs
+        transform = src.transform
+        src_bounds = src.bounds
+        src_height, src_width = src.height, src.width
+
+    bounds = gpd.GeoSeries([shapely.box(*bounds)], crs='EPSG:4326').to_crs(crs).total_bounds
+    snapped_bounds = snap_bounds_to_grid(bounds=bounds, transform=transform)
+    snapped_bounds = (
+        max(snapped_bounds[0], src_bounds.left),
+        max(snapped_bounds[1], src_bounds.bottom),
+        min(snapped_bounds[2], src_bounds.right),
+        min(snapped_bounds[3], src_bounds.top),
+    )
+    if snapped_bounds[0] >= snapped_bounds[2] or snapped_bounds[1] >= snapped_bounds[3]:
+        raise ValueError(f'bounds={bounds} do not overlap the CHIRPS files.')
+
+    region_folderpath = get_region_folderpath(
+        archive_folderpath = archive_folderpath,
+        product = product,
+        region_name = region_name,
+    )
+    os.makedirs(region_folderpath, exist_ok=True)
+
+    metadata_filepath = os.path.join(region_folderpath, REGION_METADATA_FILENAME)
+    if os.path.exists(metadata_filepath):
+        region = read_region_metadata(region_folderpath=region_folderpath)
+        if not np.allclose(region['bounds'], snapped_bounds) \
+            or not np.allclose(region['grid_transform'], list(transform)[:6]):
+            raise ValueError(
+                f'Region {region_name} already exists with bounds={region["bounds"]} '
+                'or on a different grid. '
+                f'Remove {region_folderpath} to change them.'
+            )
+    tmp_filepath = f'{metadata_filepath}.{os.getpid()}.tmp'
+    with open(tmp_filepath, 'w') as f:
+        json.dump({
+            'name': region_name,
+            'product': product,
+            'bounds': [float(x) for x in snapped_bounds],
+            'crs': crs.to_string(),
+            # grid of the source files, the crop windows are computed on it
+            # so that they are the same as when cropping the source files
+            'grid_transform': list(transform)[:6],
+            'grid_shape': [int(src_height), int(src_width)],
+            'start_year': None if start_year is None else int(start_year),
+        }, f, indent=4)
+    os.replace(tmp_filepath, metadata_filepath)
+
+    return update_region(
+        region_folderpath = region_folderpath,
+        catalogue_df = catalogue_df,
+        working_folderpath = working_folderpath,
+        tif_filepath_col = tif_filepath_col,
+        njobs = njobs,
+        pool = pool,
+    )
+
+
+def update_regional_archives(
+    archive_folderpath:str,
+    product:str,
+    catalogue_df:pd.DataFrame,
+    working_folderpath:str = None,
+    tif_filepath_col:str = fmcf.COL_TIF_FILEPATH,
+    njobs:int = ws.DEFAULT_NJOBS,
+    pool = None,
+):
+    """
+    Brings the regions of product up to date with catalogue_df (e.g. the
+    catalogue returned by fmcf.fetch_missing_chirps_files for the years just
+    fetched).
+    """
+    updated_months = {}
+    if catalogue_df.shape[0] == 0:
+        return updated_months
+    for region in list_regions(archive_folderpath=archive_folderpath, product=product):
+        updated_months[region['name']] = update_region(
+            region_folderpath = region['folderpath'],
+            catalogue_df = catalogue_df,
+            working_folderpath = working_folderpath,
+            tif_filepath_col = tif_filepath_col,
+            njobs = njobs,
+            pool = pool,
+        )
+    return updated_months
+
+
+def get_containing_regions(
+    archive_folderpath:str,
+    shapes_gdf:gpd.GeoDataFrame,
+):
+    """
+    Regions whose bounds contain all of shapes_gdf.
+    """
+    containing_regions = []
+    for region in list_regions(archive_folderpath=archive_folderpath):
+        minx, miny, maxx, maxy = shapes_gdf.to_crs(region['crs']).total_bounds
+        region_minx, region_miny, region_maxx, region_maxy = region['bounds']
+        if minx >= region_minx and miny >= region_miny \
+            and maxx <= region_maxx and maxy <= region_maxy:
+            containing_regions.append(region)
+    return containing_regions
+
+
+def read_stack_agg_values(
+    region:dict,
+    stack_filepath:str,
+    band_indexes:list[int],
+    shapes_gdf:gpd.GeoDataFrame,
+    aggregation:str,
+):
+    """
+    Aggregated values of shapes_gdf for the given bands (1-based) of a month
+    stack of region, from a single windowed read, computed the same way as
+    rtcm.read_tif_get_agg_value with LoadTIFMethod.READ_AND_CROP.
+    """
+    aggregations = list(aggregation) if rtcm.is_multi_aggregation(aggregation) else [aggregation]
+    is_centre = [
+        isinstance(_aggregation, str) and _aggregation == 'centre'
+        for _aggregation in aggregations
+    ]
+
+    # the crop windows are computed on the grid of the source files as
+    # rasterio.mask.mask (used by utils.crop_tif) would, computing them on the
+    # stack's own transform can round to a window one pixel wider, which
+    # moves the 'centre' pixel
+    grid_transform = affine.Affine(*region['grid_transform'])
+    grid_height, grid_width = region['grid_shape']
+    grid = types.SimpleNamespace(
+        transform = grid_transform,
+        height = grid_height,
+        width = grid_width,
+    )
+
+    stacked_images = {}
+    with rasterio.open(stack_filepath) as src:
+        stack_col_off = int(round((src.transform.c - grid_transform.c) / grid_transform.a))
+        stack_row_off = int(round((src.transform.f - grid_transform.f) / grid_transform.e))
+        shapes = shapes_gdf.to_crs(src.crs)['geometry']
+        for _is_centre in set(is_centre):
+            _shapes = shapes.envelope if _is_centre else shapes
+            window = rasterio.features.geometry_window(
+                dataset = grid,
+                shapes = _shapes,
+            )
+            stack_window = rasterio.windows.Window(
+                col_off = window.col_off - stack_col_off,
+                row_off = window.row_off - stack_row_off,
+                width = window.width,
+                height = window.height,
+            )
+            is_inside = stack_window.col_off >= 0 and stack_window.row_off >= 0 \
+                and stack_window.col_off + stack_window.width <= src.width \
+                and stack_window.row_off + stack_window.height <= src.height
+            # the stack already has the multiplier applied and NaN as nodata
+            out_image = src.read(
+                band_indexes,
+                window = stack_window,
+                boundless = not is_inside,
+                fill_value = np.nan,
+            )
+            outside_mask = rasterio.features.geometry_mask(
+                geometries = _shapes,
+                out_shape = out_image.shape[-2:],
+                transform = rasterio.windows.transform(window, grid_transform),
+            )
+            out_image[:, outside_mask] = np.nan
+            stacked_images[_is_centre] = out_image
+
+    return [
+        rtcm.reduce_agg_inputs(
+            images = [stacked_images[_is_centre][i:i+1] for _is_centre in is_centre],
+            aggregation = aggregation,
+        )
+        for i in range(len(band_indexes))
+    ]
+
+
+def get_archived_agg_values(
+    archive_folderpath:str,
+    shapes_gdf:gpd.GeoDataFrame,
+    filepaths:list[str],
+    multipliers:list[float],
+    dates:list[datetime.datetime],
+    aggregation:str,
+):
+    """
+    Aggregated values for the files that can be served from a region that
+    contains shapes_gdf, as {position in filepaths: value}. Only the month
+    stacks of the dates of filepaths are opened. A file is only served if its
+    stack band has the same identity and multiplier.
+    """
+    archived_values = {}
+    regions = get_containing_regions(
+        archive_folderpath = archive_folderpath,
+        shapes_gdf = shapes_gdf,
+    )
+    if len(regions) == 0:
+        return archived_values
+
+    filename_positions = {}
+    for position, filepath in enumerate(filepaths):
+        filename_positions.setdefault(os.path.split(filepath)[1], []).append(position)
+    year_months = sorted({(date.year, date.month) for date in dates})
+
+    for region in regions:
+        n_served = 0
+        for year, month in year_months:
+            stack_filepath = get_month_stack_filepath(
+                region_folderpath = region['folderpath'],
+                region_name = region['name'],
+                year = year,
+                month = month,
+            )
+            stack_sources = read_stack_sources(stack_filepath=stack_filepath)
+            if stack_sources is None:
+                continue
+            band_indexes = []
+            band_positions = []
+            for band_index, (filename, identity, multiplier) in enumerate(stack_sources, start=1):
+                for position in filename_positions.get(filename, []):
+                    if position in archived_values or position in band_positions \
+                        or float(multipliers[position]) != multiplier:
+                        continue
+                    if avc.get_file_identity(filepath=filepaths[position]) != identity:
+                        continue
+                    band_indexes.append(band_index)
+                    band_positions.append(position)
+            if len(band_indexes) == 0:
+                continue
+            values = read_stack_agg_values(
+                region = region,
+                stack_filepath = stack_filepath,
+                band_indexes = band_indexes,
+                shapes_gdf = shapes_gdf,
+                aggregation = aggregation,
+            )
+            for position, value in zip(band_positions, values):
+                archived_values[position] = value
+            n_served += len(band_indexes)
+        if n_served > 0:
+            print(f"Regional archive {region['name']} ({region['product']}): {n_served} / {len(filepaths)} files")
+
+    return archived_values
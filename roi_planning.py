@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import numpy as np
+
+from lazy_imports import lazy_import
+
+gpd = lazy_import('geopandas')
+shapely = lazy_import('shapely')
+rasterio = lazy_import('rasterio', submodules=['crs', 'warp'])
+chcfetch_constants = lazy_import('chcfetch.constants')
+
+
+"""
+Planning stage run once before extraction: reproject the ROIs to the raster
+CRS, drop the ones that do not intersect the raster coverage (CHIRPS covers
+50S to 50N, geometries outside would only yield NaN for every date), and
+group the remaining ones into spatially compact clusters so that each task
+reads one shared window per cluster per date.
+
+For the per-file extraction (rtcm.iter_tifs_agg_value) the same stage is
+prepare_geometries: the ROIs are reprojected, repaired and optionally
+simplified once, and sent to the workers as WKB (PreparedGeometries) instead
+of as a GeoDataFrame.
+"""
+
+
+COL_CLUSTER = 'cluster'
+
+# 5 degrees = 100 x 100 CHIRPS pixels at 0.05 degrees
+DEFAULT_CLUSTER_CELL_SIZE = 5.0
+DEFAULT_MAX_GEOMS_PER_CLUSTER = 1000
+
+
+def get_chirps_bounds_gdf():
+    return gpd.read_file(chcfetch_constants.CHIRPS_V2_P50_BOUNDS_GEOJSON_FILEPATH)
+
+
+def get_indexes_within_bounds(
+    geometries:list,
+    bounds_geometry,
+):
+    """
+    Indexes of the geometries that intersect bounds_geometry, found with an
+    STRtree query instead of testing every geometry.
+    """
+    tree = shapely.STRtree(geometries)
+    indexes = tree.query(bounds_geometry, predicate='intersects')
+    return np.sort(indexes)
+
+
+def cluster_geometries(
+    geometries:list,
+    cell_size:float = DEFAULT_CLUSTER_CELL_SIZE,
+    max_geoms_per_cluster:int = DEFAULT_MAX_GEOMS_PER_CLUSTER,
+):
+    """
+    Assigns each geometry to a cluster by bucketing the centre of its
+    bounding box into a grid of cell_size, splitting buckets that exceed
+    max_geoms_per_cluster. Cluster ids are ordered row-major over the grid
+    (north to south, west to east) so that consecutive clusters are close.
+    """
+    n_geoms = len(geometries)
+    if n_geoms == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    bounds = shapely.bounds(np.asarray(geometries, dtype=object))
+    centre_x = (bounds[:, 0] + bounds[:, 2]) / 2
+    centre_y = (bounds[:, 1] + bounds[:, 3]) / 2
+    cell_col = np.floor(centre_x / cell_size).astype(np.int64)
+    cell_row = np.floor(-centre_y / cell_size).astype(np.int64)
+
+    # sort by cell, then by position within the cell so that splits of an
+    # oversized cell are themselves compact
+    order = np.lexsort((centre_x, -centre_y, cell_col, cell_row))
+
+    clusters = np.empty(n_geoms, dtype=np.int64)
+    cluster_id = -1
+    previous_cell = None
+    n_in_cluster = 0
+    for index in order:
+        cell = (cell_row[index], cell_col[index])
+        if cell != previous_cell or n_in_cluster >= max_geoms_per_cluster:
+            cluster_id += 1
+            n_in_cluster = 0
+            previous_cell = cell
+        clusters[index] = cluster_id
+        n_in_cluster += 1
+
+    return clusters
+
+
+def plan_rois(
+    shapes_gdf:gpd.GeoDataFrame,
+    raster_crs = None,
+    bounds_gdf:gpd.GeoDataFrame = None,
+    cell_size:float = DEFAULT_CLUSTER_CELL_SIZE,
+    max_geoms_per_cluster:int = DEFAULT_MAX_GEOMS_PER_CLUSTER,
+    cluster_col:str = COL_CLUSTER,
+):
+    """
+    Returns shapes_gdf reprojected to raster_crs with only the geometries
+    that intersect bounds_gdf (CHIRPS coverage if None), with a cluster_col
+    column. The index of shapes_gdf is preserved so that dropped geometries
+    can be identified by the caller.
+
+    cell_size is in units of raster_crs. raster_crs defaults to the crs of
+    bounds_gdf.
+    """
+    if bounds_gdf is None:
+        bounds_gdf = get_chirps_bounds_gdf()
+    if raster_crs is None:
+        raster_crs = bounds_gdf.crs
+
+    planned_gdf = shapes_gdf.to_crs(raster_crs)
+    bounds_geometry = shapely.union_all(bounds_gdf.to_crs(raster_crs)['geometry'].to_numpy())
+
+    indexes_within_bounds = get_indexes_within_bounds(
+        geometries = planned_gdf['geometry'].to_numpy(),
+        bounds_geometry = bounds_geometry,
+    )
+
+    n_dropped = planned_gdf.shape[0] - indexes_within_bounds.shape[0]
+    if n_dropped > 0:
+        print(f'Dropping {n_dropped} / {planned_gdf.shape[0]} geometries outside raster bounds.')
+
+    planned_gdf = planned_gdf.iloc[indexes_within_bounds].copy()
+    planned_gdf[cluster_col] = cluster_geometries(
+        geometries = planned_gdf['geometry'].to_numpy(),
+        cell_size = cell_size,
+        max_geoms_per_cluster = max_geoms_per_cluster,
+    )
+
+    return planned_gdf
+
+
+class PreparedGeometries:
+    def __init__(
+        self,
+        geometries_wkb:list[bytes],
+        crs_wkt:str,
+        envelopes_wkb:list[bytes] = None,
+    ):
+        """
+        Geometries in crs_wkt as WKB, see prepare_geometries. Only the WKB is
+        pickled, the shapely geometries are decoded once per process on first
+        use.
+        """
+        self.geometries_wkb = geometries_wkb
+        self.crs_wkt = crs_wkt
+        self.envelopes_wkb = envelopes_wkb
+        self._geometries = None
+        self._crs = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_geometries'] = None
+        state['_crs'] = None
+        return state
+
+    def __len__(self):
+        return len(self.geometries_wkb)
+
+    def get_crs(self):
+        if self._crs is None:
+            self._crs = rasterio.crs.CRS.from_wkt(self.crs_wkt)
+        return self._crs
+
+    def get_gdf(self):
+        return gpd.GeoDataFrame(geometry=self.get_geometries(), crs=self.crs_wkt)
+
+    def get_envelopes(self):
+        """
+        PreparedGeometries of the envelopes of the geometries.
+        """
+        if self.envelopes_wkb is None:
+            raise ValueError('envelopes_wkb is None.')
+        return PreparedGeometries(
+            geometries_wkb = self.envelopes_wkb,
+            crs_wkt = self.crs_wkt,
+        )
+
+    def get_geometries(self, crs = None):
+        """
+        shapely geometries, reprojected to crs if it is given and differs,
+        which is only expected if the geometries were prepared for a
+        different raster.
+        """
+        if self._geometries is None:
+            self._geometries = list(shapely.from_wkb(self.geometries_wkb))
+        if crs is None or self.get_crs() == crs:
+            return self._geometries
+        return [
+            shapely.geometry.shape(rasterio.warp.transform_geom(self.get_crs(), crs, geometry))
+            for geometry in self._geometries
+        ]
+
+
+def prepare_geometries(
+    shapes_gdf:gpd.GeoDataFrame,
+    raster_crs = None,
+    simplify_tolerance:float = None,
+):
+    """
+    Run once in the main process: reprojects shapes_gdf to raster_crs (kept
+    in its crs if None), repairs invalid geometries with shapely.make_valid,
+    simplifies them with simplify_tolerance (in units of raster_crs,
+    topology preserving) if given, and returns them with their envelopes as
+    PreparedGeometries.
+
+    Simplification is opt-in: a tolerance of up to about half a pixel keeps
+    the shape at the resolution of the raster, but pixels whose centre is
+    close to the boundary can switch in or out of the mask.
+    """
+    if raster_crs is not None:
+        shapes_gdf = shapes_gdf.to_crs(raster_crs)
+
+    geometries = shapes_gdf['geometry'].to_numpy()
+
+    is_invalid = ~shapely.is_valid(geometries)
+    if is_invalid.any():
+        print(f'Repairing {is_invalid.sum()} / {geometries.shape[0]} invalid geometries.')
+        geometries = geometries.copy()
+        geometries[is_invalid] = shapely.make_valid(geometries[is_invalid])
+
+    if simplify_tolerance is not None and simplify_tolerance > 0:
+        geometries = shapely.simplify(
+            geometries,
+            tolerance = simplify_tolerance,
+            preserve_topology = True,
+        )
+
+    return PreparedGeometries(
+        geometries_wkb = list(shapely.to_wkb(geometries)),
+        envelopes_wkb = list(shapely.to_wkb(shapely.envelope(geometries))),
+        crs_wkt = shapes_gdf.crs.to_wkt(),
+    )
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import os
+import time
+import shutil
+import argparse
+
+import sys
+sys.path.append('..')
+
+import config
+from lazy_imports import lazy_import
+import fetch_missing_chirps_files as fmcf
+import read_tifs_create_met as rtcm
+import worker_sizing as ws
+import executors as ex
+
+gpd = lazy_import('geopandas')
+shapely = lazy_import('shapely')
+
+
+"""
+Times read_tifs_get_agg_value with each executor backend for square ROIs of
+increasing size, to find where processes start beating threads. Pool start up
+is included in the timings as it is paid on every run. The per-task memory
+probe is done once per ROI size before timing so that it does not count
+against whichever backend runs first.
+"""
+
+
+DEFAULT_ROI_SIZES = '0.1,0.5,2,10,40'
+
+
+def get_square_roi_gdf(centre_x:float, centre_y:float, size:float):
+    return gpd.GeoDataFrame(
+        geometry = [shapely.box(
+            centre_x - size / 2, centre_y - size / 2,
+            centre_x + size / 2, centre_y + size / 2,
+        )],
+        crs = 'EPSG:4326',
+    )
+
+
+def time_backend(
+    catalogue_df,
+    shapes_gdf,
+    backend:str,
+    aggregation:str,
+    njobs:int,
+    working_folderpath:str,
+):
+    start_time = time.perf_counter()
+    rtcm.read_tifs_get_agg_value(
+        catalogue_df = catalogue_df,
+        shapes_gdf = shapes_gdf,
+        val_col = 'value',
+        working_folderpath = working_folderpath,
+        aggregation = aggregation,
+        njobs = njobs,
+        backend = backend,
+    )
+    return time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog = 'python benchmark_backends.py',
+        description = (
+            'Script to benchmark the executor backends of read_tifs_get_agg_value '
+            'against the ROI size.'
+        ),
+        epilog = f"--- Send your complaints to {','.join(config.MAINTAINERS)} ---",
+    )
+    parser.add_argument('-d', '--download_folderpath', action='store', required=False, default=config.FOLDERPATH_DOWNLOAD_CHC_CHIRPS_P05, help=f'[default = {config.FOLDERPATH_DOWNLOAD_CHC_CHIRPS_P05}] Folder with the CHIRPS files to read.')
+    parser.add_argument('-n', '--n_files', action='store', default=64, required=False, help='[default = 64] Number of files to read per run.')
+    parser.add_argument('-s', '--roi_sizes', action='store', default=DEFAULT_ROI_SIZES, required=False, help=f'[default = {DEFAULT_ROI_SIZES}] Comma separated side lengths (degrees) of the square ROIs.')
+    parser.add_argument('-x', '--centre_x', action='store', default=30.0, required=False, help='[default = 30.0] Longitude of the centre of the ROIs.')
+    parser.add_argument('-y', '--centre_y', action='store', default=0.0, required=False, help='[default = 0.0] Latitude of the centre of the ROIs.')
+    parser.add_argument('-a', '--aggregation', action='store', default='mean', required=False, help=f'[default = mean] Aggregation. Options: {list(rtcm.AGGREGATION_DICT.keys())}.')
+    parser.add_argument('-j', '--njobs', action='store', default=min(ws.DEFAULT_NJOBS, 16), required=False, help=f'[default = {min(ws.DEFAULT_NJOBS, 16)}] Number of workers.')
+    args = parser.parse_args()
+
+    njobs = ws.resolve_njobs(int(args.njobs))
+    roi_sizes = [float(size) for size in str(args.roi_sizes).split(',')]
+    working_folderpath = os.path.join(config.FOLDERPATH_TEMP, 'benchmark_backends')
+
+    catalogue_df = fmcf.generate_chc_chirps_catalogue_df(
+        folderpath = args.download_folderpath,
+    )
+    if catalogue_df.shape[0] == 0:
+        raise ValueError(f'No files found in {args.download_folderpath}')
+    catalogue_df = catalogue_df.head(int(args.n_files)).reset_index(drop=True)
+    catalogue_df[rtcm.COL_METHOD] = rtcm.LoadTIFMethod.READ_AND_CROP
+
+    print(f'files: {catalogue_df.shape[0]}, njobs: {njobs}, aggregation: {args.aggregation}')
+
+    timings = {}
+    for roi_size in roi_sizes:
+        shapes_gdf = get_square_roi_gdf(
+            centre_x = float(args.centre_x),
+            centre_y = float(args.centre_y),
+            size = roi_size,
+        )
+        # memory probe, cached per ROI
+        rtcm.read_tifs_get_agg_value(
+            catalogue_df = catalogue_df.head(2),
+            shapes_gdf = shapes_gdf,
+            val_col = 'value',
+            working_folderpath = working_folderpath,
+            aggregation = args.aggregation,
+            njobs = njobs,
+        )
+        for backend in ex.VALID_BACKENDS:
+            timings[(roi_size, backend)] = time_backend(
+                catalogue_df = catalogue_df,
+                shapes_gdf = shapes_gdf,
+                backend = backend,
+                aggregation = args.aggregation,
+                njobs = njobs,
+                working_folderpath = working_folderpath,
+            )
+
+    if os.path.exists(working_folderpath):
+        shutil.rmtree(working_folderpath)
+
+    print()
+    print(f"{'roi size (deg)':>14} " + ' '.join(f'{backend + " (s)":>15}' for backend in ex.VALID_BACKENDS) + f" {'fastest':>10}")
+    crossover_roi_size = None
+    for roi_size in roi_sizes:
+        roi_timings = {backend: timings[(roi_size, backend)] for backend in ex.VALID_BACKENDS}
+        fastest_backend = min(roi_timings, key=roi_timings.get)
+        print(f'{roi_size:>14} ' + ' '.join(f'{roi_timings[backend]:>15.2f}' for backend in ex.VALID_BACKENDS) + f' {fastest_backend:>10}')
+        if crossover_roi_size is None and \
+            roi_timings[ex.ExecutorBackend.PROCESSES] < roi_timings[ex.ExecutorBackend.THREADS]:
+            crossover_roi_size = roi_size
+
+    if crossover_roi_size is None:
+        print(f'{ex.ExecutorBackend.THREADS} is faster than {ex.ExecutorBackend.PROCESSES} for all ROI sizes.')
+    else:
+        print(f'{ex.ExecutorBackend.PROCESSES} is faster than {ex.ExecutorBackend.THREADS} from ROI size {crossover_roi_size} degrees.')
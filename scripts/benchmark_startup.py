@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+import config
+
+
+"""
+Measures the wall time of starting the modules / scripts of this repo in a
+fresh interpreter, which is what every cron run and every spawned worker
+pays. The eager import of the heavy dependencies is reported as a reference
+for what the startup used to cost before they were made lazy.
+"""
+
+
+REPO_FOLDERPATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SCRIPTS_FOLDERPATH = os.path.abspath(os.path.dirname(__file__))
+
+
+BENCHMARKS = {
+    'python (baseline)': [sys.executable, '-c', 'pass'],
+    'eager import of heavy dependencies (reference)': [
+        sys.executable, '-c', 'import pandas, geopandas, rasterio, rasterio.merge, tqdm',
+    ],
+    'import fetch_missing_chirps_files': [
+        sys.executable, '-c', 'import fetch_missing_chirps_files',
+    ],
+    'import read_tifs_create_met': [
+        sys.executable, '-c', 'import read_tifs_create_met',
+    ],
+    'generate_chirps_csv.py --help': [
+        sys.executable, 'generate_chirps_csv.py', '--help',
+    ],
+    'download_chirps.py --help': [
+        sys.executable, 'download_chirps.py', '--help',
+    ],
+}
+
+
+def time_command(command:list[str], cwd:str, env:dict):
+    start_time = time.perf_counter()
+    subprocess.run(
+        command, cwd=cwd, env=env, check=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog = 'python benchmark_startup.py',
+        description = (
+            'Script to benchmark the startup time of the modules and scripts.'
+        ),
+        epilog = f"--- Send your complaints to {','.join(config.MAINTAINERS)} ---",
+    )
+    parser.add_argument('-n', '--repeats', action='store', default=5, required=False, help='[default = 5] Number of times each command is run.')
+    args = parser.parse_args()
+
+    repeats = int(args.repeats)
+
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+        [REPO_FOLDERPATH] + [env['PYTHONPATH']] if 'PYTHONPATH' in env else [REPO_FOLDERPATH]
+    )
+
+    print(f"{'command':<50} {'min (s)':>8} {'median (s)':>11}")
+    for name, command in BENCHMARKS.items():
+        try:
+            timings = [
+                time_command(command=command, cwd=SCRIPTS_FOLDERPATH, env=env)
+                for _ in range(repeats)
+            ]
+        except subprocess.CalledProcessError:
+            print(f'{name:<50} {"failed":>8}')
+            continue
+        print(f'{name:<50} {min(timings):>8.3f} {statistics.median(timings):>11.3f}')
@@ -0,0 +1,920 @@
+from __future__ import annotations
+
+import multiprocessing as mp
+import time
+import argparse
+import shlex
+import contextlib
+import subprocess
+import shutil
+import os
+import datetime
+
+import sys
+sys.path.append('..')
+
+import config
+from lazy_imports import lazy_import
+import fetch_missing_chirps_files as fmcf
+import read_tifs_create_met as rtcm
+import temporal_aggregation as ta
+import roi_planning as rp
+import sharding as sh
+import worker_sizing as ws
+import executors as ex
+import prefetch as pf
+import tif_cache as tc
+import regional_archive as ra
+import query_service as qs
+import progress_metrics as pm
+
+pd = lazy_import('pandas')
+gpd = lazy_import('geopandas')
+
+
+"""
+Single entry point for fetching, validating and extracting CHIRPS data.
+
+    python chirps.py fetch 2023 2024 -p prelim -b today
+    python chirps.py validate -p p05
+    python chirps.py extract roi.geojson 2023-01-01 2023-12-31 out.csv -a median
+    python chirps.py update roi.geojson 2024-01-01 2024-10-01 out.csv -p prelim
+    python chirps.py update roi.geojson 2024-01-01 today out.csv -p merged --incremental
+    python chirps.py batch jobs.txt
+    python chirps.py launch 4 extract roi.geojson 2000-01-01 2023-12-31 out.csv -g id
+    python chirps.py extract roi.geojson 2000-01-01 2023-12-31 out.csv --shard 2/4
+    python chirps.py merge out.csv 4
+    python chirps.py archive ukraine 22 44 41 53 -p p05 -s 2010
+    python chirps.py -j 8 serve --port 8642
+
+A batch job file lists one subcommand per line (same arguments as on the
+command line, lines starting with # are ignored). All jobs of a batch run in
+this one process and share the worker pool, the loaded catalogues and the
+loaded geometries.
+
+Sharding (see sharding.py): `extract --shard INDEX/COUNT` runs one of COUNT
+independent shards (e.g. INDEX = $SLURM_ARRAY_TASK_ID of an array job) and
+writes a partial csv, `merge` combines the partial csvs once all shards are
+done, `launch` runs all shards as local processes followed by the merge.
+`fetch --shard INDEX/COUNT` downloads a subset of the years.
+
+Regional archives (see regional_archive.py): `archive` clips the files of a
+named bounding box into per-month stacks under --regional-archive-folderpath.
+fetch keeps them up to date and extract reads from them whenever the ROI is
+inside a region.
+
+Query service (see query_service.py): `serve` keeps the catalogues, the pixel
+indices of the queried ROIs and a thread pool in memory and answers ROI /
+date range / aggregation queries over HTTP or a Unix socket.
+
+Progress metrics (see progress_metrics.py): fetch, extract and update with
+--metrics-filepath rewrite a JSON (or Prometheus .prom) status file with the
+files done, source file bytes, rates, worker utilization, errors and ETA
+while running.
+"""
+
+
+DEFAULT_NJOBS = min(ws.DEFAULT_NJOBS, 16)
+
+VALID_PRODUCTS = fmcf.VALID_PRODUCTS
+VALID_EXTRACT_PRODUCTS = fmcf.VALID_PRODUCTS + [fmcf.PRODUCT_MERGED]
+VALID_AGGREGATION = list(rtcm.AGGREGATION_DICT.keys())
+VALID_IF_MISSING_DATES = ['raise', 'warn', 'ignore']
+
+
+class Session:
+    """
+    State shared between the subcommands run in one process.
+    """
+    def __init__(self, njobs:int):
+        self.njobs = njobs
+        self._pool = None
+        self._reduce_pool = None
+        self._catalogues = {}
+        self._shapes = {}
+
+    def get_backend_pool(self, backend:str):
+        """
+        The shared process pool for processes, a shared pool of
+        ex.get_n_reduce_workers(njobs) processes for the reductions of
+        hybrid, None for threads. Passed along with njobs = self.njobs.
+        """
+        if backend == ex.ExecutorBackend.THREADS:
+            return None
+        if backend == ex.ExecutorBackend.HYBRID:
+            if self._reduce_pool is None:
+                self._reduce_pool = mp.Pool(ex.get_n_reduce_workers(n_workers=self.njobs))
+            return self._reduce_pool
+        return self.get_pool()
+
+    def get_pool(self):
+        if self._pool is None:
+            self._pool = mp.Pool(self.njobs)
+        return self._pool
+
+    def get_catalogue_df(self, folderpath:str):
+        folderpath = os.path.abspath(folderpath)
+        if folderpath not in self._catalogues:
+            self._catalogues[folderpath] = fmcf.generate_chc_chirps_catalogue_df(
+                folderpath = folderpath,
+            )
+        return self._catalogues[folderpath].copy(deep=True)
+
+    def get_merged_catalogue_df(self, p05_folderpath:str, prelim_folderpath:str):
+        return fmcf.merge_catalogues_by_priority(
+            product_catalogue_dfs = {
+                fmcf.PRODUCT_P05: self.get_catalogue_df(folderpath=p05_folderpath),
+                fmcf.PRODUCT_PRELIM: self.get_catalogue_df(folderpath=prelim_folderpath),
+            },
+        )
+
+    def invalidate_catalogue_df(self, folderpath:str):
+        self._catalogues.pop(os.path.abspath(folderpath), None)
+
+    def get_shapes_gdf(self, roi_filepath:str):
+        roi_filepath = os.path.abspath(roi_filepath)
+        if roi_filepath not in self._shapes:
+            self._shapes[roi_filepath] = gpd.read_file(roi_filepath)
+        return self._shapes[roi_filepath].copy(deep=True)
+
+    def close(self):
+        for pool in [self._pool, self._reduce_pool]:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self._pool = None
+        self._reduce_pool = None
+
+
+def parse_date(date_str:str):
+    if str(date_str).lower() == 'today':
+        return datetime.datetime.today()
+    return datetime.datetime.strptime(str(date_str), '%Y-%m-%d')
+
+
+def get_download_folderpath(product:str, download_folderpath:str = None):
+    if download_folderpath is not None:
+        return download_folderpath
+    return {
+        fmcf.PRODUCT_P05: config.FOLDERPATH_DOWNLOAD_CHC_CHIRPS_P05,
+        fmcf.PRODUCT_PRELIM: config.FOLDERPATH_DOWNLOAD_CHC_CHIRPS_PRELIM,
+    }[product]
+
+
+def add_product_args(parser:argparse.ArgumentParser, allow_merged:bool = False):
+    if allow_merged:
+        parser.add_argument('-p', '--product', action='store', default=fmcf.PRODUCT_P05, choices=VALID_EXTRACT_PRODUCTS, required=False, help=f'[default = {fmcf.PRODUCT_P05}] CHIRPS product. Options: {VALID_EXTRACT_PRODUCTS}. {fmcf.PRODUCT_MERGED} uses the {fmcf.PRODUCT_P05} file for each date where available and the {fmcf.PRODUCT_PRELIM} file otherwise, the product used is exported as the {fmcf.COL_PRODUCT} column.')
+        parser.add_argument('-d', '--download_folderpath', action='store', required=False, default=None, help=f"[default = {config.FOLDERPATH_DOWNLOAD_CHC_CHIRPS + 'PRODUCT/'}] Path to the folder where files are downloaded to. Folder of the {fmcf.PRODUCT_P05} files if product is {fmcf.PRODUCT_MERGED}.")
+        parser.add_argument('--prelim-download-folderpath', action='store', required=False, default=None, help=f'[default = {config.FOLDERPATH_DOWNLOAD_CHC_CHIRPS_PRELIM}] Folder of the {fmcf.PRODUCT_PRELIM} files if product is {fmcf.PRODUCT_MERGED}.')
+    else:
+        parser.add_argument('-p', '--product', action='store', default=fmcf.PRODUCT_P05, choices=VALID_PRODUCTS, required=False, help=f'[default = {fmcf.PRODUCT_P05}] CHIRPS product. Options: {VALID_PRODUCTS}.')
+        parser.add_argument('-d', '--download_folderpath', action='store', required=False, default=None, help=f"[default = {config.FOLDERPATH_DOWNLOAD_CHC_CHIRPS + 'PRODUCT/'}] Path to the folder where files are downloaded to.")
+
+
+def get_extract_catalogue_df(args, session:Session):
+    if args.product == fmcf.PRODUCT_MERGED:
+        return session.get_merged_catalogue_df(
+            p05_folderpath = get_download_folderpath(
+                product = fmcf.PRODUCT_P05,
+                download_folderpath = args.download_folderpath,
+            ),
+            prelim_folderpath = get_download_folderpath(
+                product = fmcf.PRODUCT_PRELIM,
+                download_folderpath = args.prelim_download_folderpath,
+            ),
+        )
+    return session.get_catalogue_df(
+        folderpath = get_download_folderpath(
+            product = args.product,
+            download_folderpath = args.download_folderpath,
+        ),
+    )
+
+
+def add_regional_archive_args(parser:argparse.ArgumentParser):
+    parser.add_argument('--regional-archive-folderpath', action='store', required=False, default=config.FOLDERPATH_REGIONAL_ARCHIVE, help=f'[default = {config.FOLDERPATH_REGIONAL_ARCHIVE}] Folder of the regional archives, see the archive subcommand.')
+    parser.add_argument('--no-regional-archive', action='store_true', help='Do not read from or update the regional archives.')
+
+
+def get_regional_archive_folderpath(args):
+    if getattr(args, 'no_regional_archive', False):
+        return None
+    return getattr(args, 'regional_archive_folderpath', config.FOLDERPATH_REGIONAL_ARCHIVE)
+
+
+def add_metrics_args(parser:argparse.ArgumentParser):
+    parser.add_argument('--metrics-filepath', action='store', required=False, default=None, help=f'[default = None] File rewritten every --metrics-interval seconds with the progress of the run (files, source file bytes, files/s, worker utilization, errors, ETA). Prometheus text format if it ends with {pm.EXT_PROMETHEUS} (for the node_exporter textfile collector), JSON otherwise.')
+    parser.add_argument('--metrics-interval', action='store', required=False, default=pm.DEFAULT_INTERVAL_SECONDS, help=f'[default = {pm.DEFAULT_INTERVAL_SECONDS}] Seconds between rewrites of --metrics-filepath.')
+
+
+def open_metrics(args, job:str, stack:contextlib.ExitStack):
+    """
+    ProgressMetrics entered on stack if --metrics-filepath is given, None
+    otherwise.
+    """
+    metrics_filepath = getattr(args, 'metrics_filepath', None)
+    if metrics_filepath is None:
+        return None
+    return stack.enter_context(pm.ProgressMetrics(
+        filepath = metrics_filepath,
+        job = job,
+        labels = {'product': args.product},
+        interval_seconds = float(getattr(args, 'metrics_interval', pm.DEFAULT_INTERVAL_SECONDS)),
+    ))
+
+
+def add_backend_args(parser:argparse.ArgumentParser):
+    parser.add_argument('--backend', action='store', default=ex.DEFAULT_BACKEND, choices=ex.VALID_BACKENDS, required=False, help=f'[default = {ex.DEFAULT_BACKEND}] How files are processed in parallel. {ex.ExecutorBackend.THREADS} is faster for small ROIs, {ex.ExecutorBackend.HYBRID} reads on threads and reduces on processes, see scripts/benchmark_backends.py. Options: {ex.VALID_BACKENDS}.')
+
+
+def add_extract_args(parser:argparse.ArgumentParser):
+    parser.add_argument('roi_filepath', action='store', help='Path to the shapefile.')
+    parser.add_argument('start_date', action='store', help='Start date for querying the CHIRPS data (included). Format: YYYY-MM-DD')
+    parser.add_argument('end_date', action='store', help='End date for querying the CHIRPS data (included). Format: YYYY-MM-DD | today')
+    parser.add_argument('export_filepath', action='store', help='Filepath where the output csv is to be stored. Folderpath if --filename-col is provided.')
+    add_product_args(parser, allow_merged=True)
+    parser.add_argument('-a', '--aggregation', action='store', default='mean', required=False, help=f'[default = mean] Aggregation method to reduce CHIRPS values for a given region to a single value. Options: {VALID_AGGREGATION}. Several comma separated aggregations (e.g. mean,median) are computed from a single read of each file, one column per aggregation.')
+    parser.add_argument('-f', '--filename-col', action='store', default=None, required=False, help='[default = None] If provided, one csv is exported per geometry into export_filepath, named by this column of the shapefile.')
+    parser.add_argument('-g', '--grouped-id-col', action='store', default=None, required=False, help='[default = None] If provided, all geometries are reduced together in one pass per date (label raster) and a single long csv with one row per date and geometry is exported, geometries identified by this column of the shapefile. With --period, one row per period and geometry. Meant for shapefiles with many geometries.')
+    parser.add_argument('-t', '--period', action='store', required=False, default=None, choices=ta.VALID_PERIODS, help=f'[default = None] If provided, daily values are reduced to this period. Options: {ta.VALID_PERIODS}.')
+    parser.add_argument('-r', '--reductions', action='store', required=False, default=ta.TemporalReduction.SUM, help=f'[default = {ta.TemporalReduction.SUM}] Comma separated temporal reductions to compute when --period is provided. Options: {ta.VALID_REDUCTIONS}.')
+    parser.add_argument('--rainy-day-threshold', action='store', required=False, default=ta.DEFAULT_RAINY_DAY_THRESHOLD, help=f'[default = {ta.DEFAULT_RAINY_DAY_THRESHOLD}] Daily value (mm) at or above which a day is considered rainy.')
+    parser.add_argument('-c', '--cache_filepath', action='store', required=False, default=None, help='[default = None] Path to a sqlite file used to cache aggregated values across runs.')
+    add_backend_args(parser)
+    parser.add_argument('--prefetch', action='store', required=False, default=0, help='[default = 0] Number of upcoming files to read into memory on background threads while the current ones are processed. Helps on high latency shared filesystems. 0 disables prefetching.')
+    parser.add_argument('--prefetch-max-mb', action='store', required=False, default=pf.DEFAULT_PREFETCH_MAX_BYTES // 2**20, help=f'[default = {pf.DEFAULT_PREFETCH_MAX_BYTES // 2**20}] Memory budget (MB) for the prefetched files, including the ones being processed.')
+    parser.add_argument('--tif-cache-folderpath', action='store', required=False, default=None, help='[default = None] Folder, ideally on a node-local disk, where the decompressed files are kept across runs so that repeat queries skip decompression. Can not be combined with --prefetch.')
+    parser.add_argument('--tif-cache-max-gb', action='store', required=False, default=tc.DEFAULT_MAX_BYTES / 2**30, help=f'[default = {tc.DEFAULT_MAX_BYTES / 2**30:g}] Size cap (GB) of --tif-cache-folderpath, least recently used files are removed above it.')
+    parser.add_argument('--simplify-pixels', action='store', required=False, default=None, help='[default = None] If provided, the geometries are simplified with a tolerance of this many CHIRPS pixels (e.g. 0.5) before extraction. Speeds up detailed boundaries, values of pixels close to the boundary can change.')
+    add_regional_archive_args(parser)
+    add_metrics_args(parser)
+    parser.add_argument('--incremental', action='store_true', help=f'If export_filepath already exists, only the dates missing from it and the dates whose product has since been upgraded (e.g. {fmcf.PRODUCT_PRELIM} replaced by {fmcf.PRODUCT_P05}) are extracted, the rest is kept. Only for a single daily csv.')
+    parser.add_argument('--shard', action='store', required=False, default=None, help='[default = None] Run only one shard of the extraction, format: INDEX/COUNT with INDEX in [0, COUNT). A partial csv is written next to export_filepath, see the merge subcommand.')
+    parser.add_argument('--shard-by', action='store', required=False, default=sh.SHARD_BY_DATE, choices=sh.VALID_SHARD_BY, help=f'[default = {sh.SHARD_BY_DATE}] Split the shards by contiguous date ranges or by ROI clusters. {sh.SHARD_BY_CLUSTER} needs --filename-col (each shard then writes its csvs directly) or --grouped-id-col.')
+    parser.add_argument('--if-missing-dates', action='store', default='raise', choices=VALID_IF_MISSING_DATES, required=False, help=f'[default = raise] What to do if there are missing dates for requested date range. Options: {VALID_IF_MISSING_DATES}.')
+
+
+def run_fetch(args, session:Session):
+    download_folderpath = get_download_folderpath(
+        product = args.product,
+        download_folderpath = args.download_folderpath,
+    )
+    years = list(range(int(args.start_year), int(args.end_year) + 1))
+    if getattr(args, 'shard', None) is not None:
+        shard_index, n_shards = sh.parse_shard(args.shard)
+        years = sh.shard_years(years=years, shard_index=shard_index, n_shards=n_shards)
+        if len(years) == 0:
+            print(f'No years for shard {args.shard}.')
+            return None
+    before_date = None if args.before is None else parse_date(args.before)
+
+    print(f"--- fetch {args.product} {years[0]}-{years[-1]} -> {download_folderpath} ---")
+
+    with contextlib.ExitStack() as stack:
+        catalogue_df = fmcf.fetch_missing_chirps_files(
+            years = years,
+            product = args.product,
+            chc_chirps_download_folderpath = download_folderpath,
+            njobs = session.njobs,
+            before_date = before_date,
+            regional_archive_folderpath = get_regional_archive_folderpath(args),
+            max_retries = int(getattr(args, 'max_retries', fmcf.DEFAULT_DOWNLOAD_MAX_RETRIES)),
+            backoff_seconds = float(getattr(args, 'retry_backoff', fmcf.DEFAULT_DOWNLOAD_BACKOFF_SECONDS)),
+            metrics = open_metrics(args=args, job='fetch', stack=stack),
+            overwrite = getattr(args, 'overwrite', False),
+        )
+    session.invalidate_catalogue_df(folderpath=download_folderpath)
+
+    return catalogue_df
+
+
+def run_validate(args, session:Session):
+    download_folderpath = get_download_folderpath(
+        product = args.product,
+        download_folderpath = args.download_folderpath,
+    )
+
+    print(f"--- validate {download_folderpath} ---")
+
+    catalogue_df = fmcf.add_tif_corruption_cols(
+        catalogue_df = session.get_catalogue_df(folderpath=download_folderpath),
+        njobs = session.njobs,
+        pool = session.get_backend_pool(backend=args.backend),
+        backend = args.backend,
+    )
+
+    corrupted_df = catalogue_df[catalogue_df[fmcf.COL_IS_CORRUPTED]]
+    print(f'Corrupted files: {corrupted_df.shape[0]} / {catalogue_df.shape[0]}')
+    for _, row in corrupted_df.iterrows():
+        print(f'{row[fmcf.COL_TIF_FILEPATH]}: {row[fmcf.COL_TYPE_OF_CORRUPTION]}')
+
+    if args.export_filepath is not None:
+        export_folderpath = os.path.split(args.export_filepath)[0]
+        if export_folderpath != '':
+            os.makedirs(export_folderpath, exist_ok=True)
+        catalogue_df.to_csv(args.export_filepath, index=False)
+
+    return catalogue_df
+
+
+def run_extract(args, session:Session):
+    with contextlib.ExitStack() as stack:
+        return extract(
+            args = args,
+            session = session,
+            metrics = open_metrics(args=args, job='extract', stack=stack),
+        )
+
+
+def extract(args, session:Session, metrics:pm.ProgressMetrics = None):
+    start_date = parse_date(args.start_date)
+    end_date = parse_date(args.end_date)
+    reductions = [reduction.strip() for reduction in str(args.reductions).lower().split(',')]
+    invalid_reductions = set(reductions) - set(ta.VALID_REDUCTIONS)
+    if len(invalid_reductions) > 0:
+        raise ValueError(f'Invalid reductions {invalid_reductions}. Must be from {ta.VALID_REDUCTIONS}.')
+
+    aggregations = [aggregation.strip() for aggregation in str(args.aggregation).lower().split(',')]
+    invalid_aggregations = set(aggregations) - set(VALID_AGGREGATION)
+    if len(invalid_aggregations) > 0:
+        raise ValueError(f'Invalid aggregations {invalid_aggregations}. Must be from {VALID_AGGREGATION}.')
+    if len(aggregations) > 1:
+        if args.grouped_id_col is not None:
+            raise ValueError('Several aggregations can not be combined with --grouped-id-col.')
+        aggregation = aggregations
+        val_col = 'CHIRPS'
+    else:
+        aggregation = aggregations[0]
+        val_col = f'{aggregation} CHIRPS'
+    val_cols = rtcm.get_val_cols(aggregation=aggregation, val_col=val_col)
+    if args.incremental and (args.filename_col is not None or args.grouped_id_col is not None
+                             or args.period is not None):
+        raise ValueError('--incremental can not be combined with --filename-col, --grouped-id-col or --period.')
+    is_sharded = args.shard is not None
+    if is_sharded:
+        shard_index, n_shards = sh.parse_shard(args.shard)
+        if args.incremental:
+            raise ValueError('--shard can not be combined with --incremental.')
+        if args.shard_by == sh.SHARD_BY_DATE and (args.filename_col is not None or args.period is not None):
+            raise ValueError(f'--shard-by {sh.SHARD_BY_DATE} can not be combined with --filename-col or --period, use --shard-by {sh.SHARD_BY_CLUSTER}.')
+        if args.shard_by == sh.SHARD_BY_CLUSTER and args.filename_col is None and args.grouped_id_col is None:
+            raise ValueError(f'--shard-by {sh.SHARD_BY_CLUSTER} needs --filename-col or --grouped-id-col.')
+    # the product of each date is exported for merged catalogues so that the
+    # dates to recompute can be found on the next incremental run
+    product_cols = [fmcf.COL_PRODUCT] if args.product == fmcf.PRODUCT_MERGED else []
+    working_folderpath = config.FOLDERPATH_TEMP
+    if is_sharded:
+        # shards may run concurrently on the same machine, each needs its
+        # own working folder as it is deleted at the end
+        working_folderpath = os.path.join(working_folderpath, f'shard-{shard_index:04d}-of-{n_shards:04d}')
+
+    print(f"--- extract {args.roi_filepath} {start_date.strftime('%Y-%m-%d')} "
+          f"to {end_date.strftime('%Y-%m-%d')} -> {args.export_filepath} ---")
+
+    shapes_gdf = session.get_shapes_gdf(roi_filepath=args.roi_filepath)
+
+    if not fmcf.check_if_any_geom_within_chirps_bounds(shapes_gdf=shapes_gdf):
+        raise ValueError(f'None of the geometries in {args.roi_filepath} are within CHIRPS bounds.')
+
+    catalogue_df = fmcf.filter_catalogue_by_date_range(
+        catalogue_df = get_extract_catalogue_df(args=args, session=session),
+        start_date = start_date,
+        end_date = end_date,
+        if_missing_dates = args.if_missing_dates,
+    )
+    catalogue_df[rtcm.COL_METHOD] = rtcm.LoadTIFMethod.READ_AND_CROP
+
+    if is_sharded and args.shard_by == sh.SHARD_BY_DATE:
+        catalogue_df = sh.shard_catalogue_df(
+            catalogue_df = catalogue_df,
+            shard_index = shard_index,
+            n_shards = n_shards,
+        )
+        if catalogue_df.shape[0] == 0:
+            raise ValueError(f'Shard {args.shard} has no dates, use fewer shards.')
+
+    simplify_pixels = getattr(args, 'simplify_pixels', None)
+    if simplify_pixels is not None:
+        simplify_pixels = float(simplify_pixels)
+
+    if args.grouped_id_col is not None:
+        if args.filename_col is not None:
+            raise ValueError('--grouped-id-col can not be combined with --filename-col.')
+        if is_sharded and args.shard_by == sh.SHARD_BY_CLUSTER:
+            shapes_gdf = sh.shard_shapes_gdf(
+                shapes_gdf = shapes_gdf,
+                shard_index = shard_index,
+                n_shards = n_shards,
+            )
+        if args.period is None:
+            export_df = rtcm.read_tifs_get_agg_values_by_geometry(
+                shapes_gdf = shapes_gdf,
+                catalogue_df = catalogue_df,
+                val_col = val_col,
+                id_col = args.grouped_id_col,
+                aggregation = aggregation,
+                working_folderpath = working_folderpath,
+                njobs = session.njobs,
+                pool = session.get_backend_pool(backend=args.backend),
+                backend = args.backend,
+                tif_cache_folderpath = args.tif_cache_folderpath,
+                tif_cache_max_bytes = int(float(args.tif_cache_max_gb) * 2**30),
+                metrics = metrics,
+                simplify_pixels = simplify_pixels,
+            )
+        else:
+            export_df = rtcm.read_tifs_get_temporal_agg_values_by_geometry(
+                shapes_gdf = shapes_gdf,
+                catalogue_df = catalogue_df,
+                val_col = val_col,
+                id_col = args.grouped_id_col,
+                aggregation = aggregation,
+                working_folderpath = working_folderpath,
+                njobs = session.njobs,
+                pool = session.get_backend_pool(backend=args.backend),
+                backend = args.backend,
+                tif_cache_folderpath = args.tif_cache_folderpath,
+                tif_cache_max_bytes = int(float(args.tif_cache_max_gb) * 2**30),
+                metrics = metrics,
+                simplify_pixels = simplify_pixels,
+                period = args.period,
+                reductions = reductions,
+                rainy_day_threshold = float(args.rainy_day_threshold),
+            )
+        export_items = []
+        if is_sharded:
+            sh.write_shard_csv(
+                shard_df = export_df,
+                export_filepath = args.export_filepath,
+                shard_index = shard_index,
+                n_shards = n_shards,
+            )
+        else:
+            export_folderpath = os.path.split(args.export_filepath)[0]
+            if export_folderpath != '':
+                os.makedirs(export_folderpath, exist_ok=True)
+            export_df.to_csv(args.export_filepath, index=False)
+    elif args.filename_col is None:
+        export_items = [(args.export_filepath, shapes_gdf)]
+    else:
+        # geometries outside CHIRPS bounds are dropped upfront instead of
+        # producing a csv of NaNs, the rest are ordered by cluster so that
+        # consecutive geometries read nearby windows
+        planned_gdf = rp.plan_rois(
+            shapes_gdf = shapes_gdf,
+        ).sort_values(by=rp.COL_CLUSTER, kind='stable')
+        # each shard writes its own subset of the per-geometry csvs, there is
+        # nothing to merge
+        if is_sharded:
+            planned_gdf = sh.shard_planned_gdf(
+                planned_gdf = planned_gdf,
+                shard_index = shard_index,
+                n_shards = n_shards,
+            )
+        export_items = [
+            (
+                os.path.join(args.export_filepath, f'{row[args.filename_col]}.csv'),
+                gpd.GeoDataFrame(data={'geometry': [row['geometry']]}, crs=planned_gdf.crs),
+            )
+            for _, row in planned_gdf.iterrows()
+        ]
+
+    previous_df = None
+    if args.incremental and os.path.exists(args.export_filepath):
+        previous_df, catalogue_df = get_incremental_dfs(
+            previous_df = pd.read_csv(args.export_filepath, parse_dates=[fmcf.COL_DATE]),
+            catalogue_df = catalogue_df,
+            product = args.product,
+            val_cols = val_cols,
+        )
+        if catalogue_df.shape[0] == 0:
+            print(f'{args.export_filepath} is up to date.')
+            export_items = []
+
+    if metrics is not None and len(export_items) > 0:
+        # known upfront for all the geometries, not only the ones started
+        metrics.set_total_files(len(export_items) * catalogue_df.shape[0])
+
+    for export_filepath, _shapes_gdf in export_items:
+        if args.period is None:
+            updated_catalogue_df = rtcm.read_tifs_get_agg_value(
+                shapes_gdf = _shapes_gdf,
+                catalogue_df = catalogue_df,
+                val_col = val_col,
+                aggregation = aggregation,
+                working_folderpath = working_folderpath,
+                cache_filepath = args.cache_filepath,
+                njobs = session.njobs,
+                pool = session.get_backend_pool(backend=args.backend),
+                backend = args.backend,
+                prefetch_files = int(args.prefetch),
+                prefetch_max_bytes = int(float(args.prefetch_max_mb) * 2**20),
+                tif_cache_folderpath = args.tif_cache_folderpath,
+                tif_cache_max_bytes = int(float(args.tif_cache_max_gb) * 2**30),
+                regional_archive_folderpath = get_regional_archive_folderpath(args),
+                metrics = metrics,
+                simplify_pixels = simplify_pixels,
+            )
+            export_df = updated_catalogue_df[[
+                fmcf.COL_DATE,
+                fmcf.COL_YEAR,
+                fmcf.COL_DAY,
+            ] + val_cols + product_cols]
+            if previous_df is not None:
+                export_df = pd.concat([
+                    previous_df[export_df.columns], export_df,
+                ]).sort_values(by=fmcf.COL_DATE).reset_index(drop=True)
+        else:
+            export_df = rtcm.read_tifs_get_temporal_agg_values(
+                shapes_gdf = _shapes_gdf,
+                catalogue_df = catalogue_df,
+                val_col = val_col,
+                period = args.period,
+                reductions = reductions,
+                rainy_day_threshold = float(args.rainy_day_threshold),
+                aggregation = aggregation,
+                working_folderpath = working_folderpath,
+                cache_filepath = args.cache_filepath,
+                njobs = session.njobs,
+                pool = session.get_backend_pool(backend=args.backend),
+                backend = args.backend,
+                prefetch_files = int(args.prefetch),
+                prefetch_max_bytes = int(float(args.prefetch_max_mb) * 2**20),
+                tif_cache_folderpath = args.tif_cache_folderpath,
+                tif_cache_max_bytes = int(float(args.tif_cache_max_gb) * 2**30),
+                regional_archive_folderpath = get_regional_archive_folderpath(args),
+                metrics = metrics,
+                simplify_pixels = simplify_pixels,
+            )
+
+        if is_sharded and args.filename_col is None:
+            sh.write_shard_csv(
+                shard_df = export_df,
+                export_filepath = export_filepath,
+                shard_index = shard_index,
+                n_shards = n_shards,
+            )
+            continue
+
+        export_folderpath = os.path.split(export_filepath)[0]
+        if export_folderpath != '':
+            os.makedirs(export_folderpath, exist_ok=True)
+        export_df.to_csv(export_filepath, index=False)
+
+    if os.path.exists(working_folderpath):
+        shutil.rmtree(working_folderpath)
+
+
+def get_incremental_dfs(
+    previous_df:pd.DataFrame,
+    catalogue_df:pd.DataFrame,
+    product:str,
+    val_cols:list[str],
+):
+    """
+    Splits an incremental run into the rows of the previous export to keep and
+    the catalogue rows to extract: dates missing from the previous export and
+    dates whose product has since been upgraded.
+    """
+    missing_cols = set(val_cols) - set(previous_df.columns)
+    if len(missing_cols) > 0:
+        raise ValueError(f'Previous export is missing the columns {missing_cols}.')
+
+    if product != fmcf.PRODUCT_MERGED:
+        catalogue_df[fmcf.COL_PRODUCT] = product
+        previous_df[fmcf.COL_PRODUCT] = product
+    elif fmcf.COL_PRODUCT not in previous_df.columns:
+        raise ValueError(f'Previous export has no {fmcf.COL_PRODUCT} column, it can not be updated incrementally.')
+
+    catalogue_df = fmcf.add_recompute_col(
+        catalogue_df = catalogue_df,
+        previous_df = previous_df,
+    )
+    catalogue_df = catalogue_df[catalogue_df[fmcf.COL_RECOMPUTE]]
+    is_upgraded = previous_df[fmcf.COL_DATE].isin(catalogue_df[fmcf.COL_DATE])
+    print(f'Dates to extract: {catalogue_df.shape[0]} '
+          f'({is_upgraded.sum()} of them upgraded to a higher priority product)')
+    previous_df = previous_df[~is_upgraded]
+
+    return previous_df, catalogue_df
+
+
+def run_update(args, session:Session):
+    """
+    Fetches the files missing for the requested date range and then extracts.
+    """
+    start_date = parse_date(args.start_date)
+    end_date = parse_date(args.end_date)
+
+    if args.product != fmcf.PRODUCT_MERGED:
+        fetch_args = argparse.Namespace(
+            product = args.product,
+            download_folderpath = args.download_folderpath,
+            start_year = start_date.year,
+            end_year = end_date.year,
+            before = end_date.strftime('%Y-%m-%d'),
+            regional_archive_folderpath = get_regional_archive_folderpath(args),
+            metrics_filepath = getattr(args, 'metrics_filepath', None),
+            metrics_interval = getattr(args, 'metrics_interval', pm.DEFAULT_INTERVAL_SECONDS),
+            overwrite = getattr(args, 'overwrite', False),
+        )
+        run_fetch(args=fetch_args, session=session)
+        run_extract(args=args, session=session)
+        return
+
+    # p05 first, prelim only for the years with dates that p05 does not cover yet
+    p05_catalogue_df = run_fetch(args=argparse.Namespace(
+        product = fmcf.PRODUCT_P05,
+        download_folderpath = args.download_folderpath,
+        start_year = start_date.year,
+        end_year = end_date.year,
+        before = end_date.strftime('%Y-%m-%d'),
+        regional_archive_folderpath = get_regional_archive_folderpath(args),
+        metrics_filepath = getattr(args, 'metrics_filepath', None),
+        metrics_interval = getattr(args, 'metrics_interval', pm.DEFAULT_INTERVAL_SECONDS),
+        overwrite = getattr(args, 'overwrite', False),
+    ), session=session)
+    missing_dates = fmcf.get_missing_dates(
+        dates = p05_catalogue_df[fmcf.COL_DATE] if p05_catalogue_df.shape[0] > 0 else [],
+        years = list(range(start_date.year, end_date.year + 1)),
+        first_date = max(start_date, fmcf.CHIRPS_PRELIM_FIRST_DATE),
+        before_date = end_date,
+    )
+    if len(missing_dates) > 0:
+        run_fetch(args=argparse.Namespace(
+            product = fmcf.PRODUCT_PRELIM,
+            download_folderpath = args.prelim_download_folderpath,
+            start_year = missing_dates[0].year,
+            end_year = end_date.year,
+            before = end_date.strftime('%Y-%m-%d'),
+            regional_archive_folderpath = get_regional_archive_folderpath(args),
+            metrics_filepath = getattr(args, 'metrics_filepath', None),
+            metrics_interval = getattr(args, 'metrics_interval', pm.DEFAULT_INTERVAL_SECONDS),
+            overwrite = getattr(args, 'overwrite', False),
+        ), session=session)
+    run_extract(args=args, session=session)
+
+
+def run_archive(args, session:Session):
+    download_folderpath = get_download_folderpath(
+        product = args.product,
+        download_folderpath = args.download_folderpath,
+    )
+    bounds = (float(args.minx), float(args.miny), float(args.maxx), float(args.maxy))
+
+    print(f"--- archive {args.region_name} {bounds} {args.product} -> {args.regional_archive_folderpath} ---")
+
+    updated_months = ra.build_regional_archive(
+        archive_folderpath = args.regional_archive_folderpath,
+        region_name = args.region_name,
+        bounds = bounds,
+        product = args.product,
+        catalogue_df = session.get_catalogue_df(folderpath=download_folderpath),
+        start_year = None if args.start_year is None else int(args.start_year),
+        njobs = session.njobs,
+        pool = session.get_pool(),
+    )
+    print(f'Months built: {updated_months}')
+
+    return updated_months
+
+
+def run_serve(args, session:Session):
+    download_folderpaths = {
+        fmcf.PRODUCT_P05: get_download_folderpath(
+            product = fmcf.PRODUCT_P05,
+            download_folderpath = args.download_folderpath,
+        ),
+        fmcf.PRODUCT_PRELIM: get_download_folderpath(
+            product = fmcf.PRODUCT_PRELIM,
+            download_folderpath = args.prelim_download_folderpath,
+        ),
+    }
+    # products that were never downloaded are not served
+    download_folderpaths = {
+        product: download_folderpath
+        for product, download_folderpath in download_folderpaths.items()
+        if os.path.isdir(download_folderpath)
+    }
+
+    print(f"--- serve {download_folderpaths} ---")
+
+    service = qs.QueryService(
+        download_folderpaths = download_folderpaths,
+        njobs = session.njobs,
+        tif_cache_folderpath = args.tif_cache_folderpath,
+        tif_cache_max_bytes = int(float(args.tif_cache_max_gb) * 2**30),
+        max_cached_indexes = int(args.max_cached_indexes),
+    )
+    try:
+        for roi_filepath in args.preload:
+            service.preload(roi_filepath=roi_filepath)
+        qs.serve(
+            service = service,
+            host = args.host,
+            port = int(args.port),
+            unix_socket_filepath = args.unix_socket,
+        )
+    finally:
+        service.close()
+
+
+def run_merge(args, session:Session):
+    key_cols = [col.strip() for col in str(args.key_cols).split(',')]
+    return sh.merge_shard_files(
+        export_filepath = args.export_filepath,
+        n_shards = int(args.n_shards),
+        key_cols = key_cols,
+        remove_shard_files = args.remove_shards,
+    )
+
+
+def run_launch(args, session:Session):
+    """
+    Runs all shards of an extract (or fetch) as local processes, each with a
+    share of the cores, and merges the partial csvs once all succeeded.
+    """
+    n_shards = int(args.n_shards)
+    if n_shards <= 0:
+        raise ValueError(f'Invalid n_shards={n_shards}.')
+
+    parser = get_parser()
+    job_args = parser.parse_args(args.job_args)
+    if job_args.command not in ['extract', 'fetch']:
+        raise ValueError('Only extract and fetch can be sharded.')
+    if job_args.shard is not None:
+        raise ValueError('--shard is set by launch.')
+
+    shard_njobs = max(1, session.njobs // n_shards)
+    processes = []
+    for shard_index in range(n_shards):
+        cmd = [
+            sys.executable, os.path.abspath(__file__), '-j', str(shard_njobs),
+        ] + list(args.job_args) + ['--shard', f'{shard_index}/{n_shards}']
+        print(f'Launching shard {shard_index}/{n_shards}: {shlex.join(cmd)}')
+        processes.append(subprocess.Popen(cmd))
+
+    failed_shards = [
+        shard_index for shard_index, process in enumerate(processes)
+        if process.wait() != 0
+    ]
+    if len(failed_shards) > 0:
+        raise ValueError(f'Shards {failed_shards} failed.')
+
+    if job_args.command == 'fetch':
+        for product in VALID_PRODUCTS:
+            session.invalidate_catalogue_df(folderpath=get_download_folderpath(
+                product = product,
+                download_folderpath = job_args.download_folderpath,
+            ))
+        return None
+
+    # --filename-col shards write their final csvs directly
+    if job_args.filename_col is not None:
+        return None
+
+    # --period exports have one row per period instead of per date
+    date_col = fmcf.COL_DATE if job_args.period is None else ta.COL_PERIOD_START
+    key_cols = [date_col]
+    if job_args.grouped_id_col is not None:
+        key_cols.append(job_args.grouped_id_col)
+    return sh.merge_shard_files(
+        export_filepath = job_args.export_filepath,
+        n_shards = n_shards,
+        key_cols = key_cols,
+        date_col = date_col,
+        remove_shard_files = True,
+    )
+
+
+def run_batch(args, session:Session):
+    with open(args.job_filepath) as f:
+        job_lines = [
+            line.strip() for line in f.readlines()
+            if line.strip() != '' and not line.strip().startswith('#')
+        ]
+
+    parser = get_parser()
+    failed_jobs = []
+    for i, job_line in enumerate(job_lines):
+        print(f'=== job [{i + 1} / {len(job_lines)}]: {job_line}')
+        job_args = parser.parse_args(shlex.split(job_line))
+        if job_args.command == 'batch':
+            raise ValueError('Nested batch jobs are not supported.')
+        try:
+            job_args.func(args=job_args, session=session)
+        except Exception as e:
+            if not args.continue_on_error:
+                raise e
+            print(f'Job failed: {e}')
+            failed_jobs.append(job_line)
+
+    if len(failed_jobs) > 0:
+        print(f'{len(failed_jobs)} / {len(job_lines)} jobs failed:')
+        for job_line in failed_jobs:
+            print(job_line)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog = 'python chirps.py',
+        description = (
+            'Fetch, validate and extract CHIRPS data. Steps run in one process '
+            'share the worker pool, catalogues and geometries.'
+        ),
+        epilog = f"--- Send your complaints to {','.join(config.MAINTAINERS)} ---",
+    )
+    parser.add_argument('-j', '--njobs', action='store', default=DEFAULT_NJOBS, required=False, help=f'[default = {DEFAULT_NJOBS}] Number of cores to use for parallel downloads and computation.')
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fetch_parser = subparsers.add_parser('fetch', help='Download missing CHIRPS files.')
+    fetch_parser.add_argument('start_year', action='store', help='Start year for fetching the CHIRPS data. Format: YYYY')
+    fetch_parser.add_argument('end_year', action='store', help='End year for fetching the CHIRPS data. Format: YYYY')
+    add_product_args(fetch_parser)
+    fetch_parser.add_argument('-b', '--before', metavar='DATE_BEFORE', action='store', default=None, required=False, help='[default = today] Date upto which to query the files for. Options: [YYYY-MM-DD | today]')
+    fetch_parser.add_argument('--shard', action='store', required=False, default=None, help='[default = None] Fetch only one shard of the years, format: INDEX/COUNT with INDEX in [0, COUNT).')
+    fetch_parser.add_argument('--max-retries', action='store', required=False, default=fmcf.DEFAULT_DOWNLOAD_MAX_RETRIES, help=f'[default = {fmcf.DEFAULT_DOWNLOAD_MAX_RETRIES}] Number of times a download that fails verification (truncated, bad gzip, unopenable, invalid transform) is retried.')
+    fetch_parser.add_argument('--retry-backoff', action='store', required=False, default=fmcf.DEFAULT_DOWNLOAD_BACKOFF_SECONDS, help=f'[default = {fmcf.DEFAULT_DOWNLOAD_BACKOFF_SECONDS}] Seconds to wait before the first retry, doubled for every further retry.')
+    fetch_parser.add_argument('--overwrite', action='store_true', help='Download every date of the years again, including the ones that already have a file. An existing file is only replaced once its new download is verified.')
+    add_regional_archive_args(fetch_parser)
+    add_metrics_args(fetch_parser)
+    fetch_parser.set_defaults(func=run_fetch)
+
+    validate_parser = subparsers.add_parser('validate', help='Check downloaded CHIRPS files for corruption.')
+    add_product_args(validate_parser)
+    add_backend_args(validate_parser)
+    validate_parser.add_argument('-e', '--export_filepath', action='store', default=None, required=False, help='[default = None] Filepath where the catalogue with corruption columns is to be stored as csv.')
+    validate_parser.set_defaults(func=run_validate)
+
+    extract_parser = subparsers.add_parser('extract', help='Generate CHIRPS csv for a shapefile from downloaded files.')
+    add_extract_args(extract_parser)
+    extract_parser.set_defaults(func=run_extract)
+
+    update_parser = subparsers.add_parser('update', help='fetch followed by extract for the requested date range.')
+    add_extract_args(update_parser)
+    update_parser.add_argument('--overwrite', action='store_true', help='Download every date of the years of the date range again before extracting, see fetch --overwrite.')
+    update_parser.set_defaults(func=run_update)
+
+    merge_parser = subparsers.add_parser('merge', help='Combine and validate the partial csvs of a sharded extract.')
+    merge_parser.add_argument('export_filepath', action='store', help='export_filepath of the sharded extract.')
+    merge_parser.add_argument('n_shards', action='store', help='Number of shards (COUNT of --shard).')
+    merge_parser.add_argument('-k', '--key-cols', action='store', required=False, default=fmcf.COL_DATE, help=f'[default = {fmcf.COL_DATE}] Comma separated columns that identify a row, checked for duplicates across shards. e.g. {fmcf.COL_DATE},ID_COL for --grouped-id-col.')
+    merge_parser.add_argument('--remove-shards', action='store_true', help='Delete the partial csvs after merging.')
+    merge_parser.set_defaults(func=run_merge)
+
+    archive_parser = subparsers.add_parser('archive', help='Build or update the pre-clipped archive of a region from the downloaded files.')
+    archive_parser.add_argument('region_name', action='store', help='Name of the region, e.g. ukraine.')
+    archive_parser.add_argument('minx', action='store', help='Western bound (EPSG:4326).')
+    archive_parser.add_argument('miny', action='store', help='Southern bound (EPSG:4326).')
+    archive_parser.add_argument('maxx', action='store', help='Eastern bound (EPSG:4326).')
+    archive_parser.add_argument('maxy', action='store', help='Northern bound (EPSG:4326).')
+    add_product_args(archive_parser)
+    archive_parser.add_argument('-s', '--start-year', action='store', required=False, default=None, help='[default = None] First year to archive, all downloaded years if not provided.')
+    archive_parser.add_argument('--regional-archive-folderpath', action='store', required=False, default=config.FOLDERPATH_REGIONAL_ARCHIVE, help=f'[default = {config.FOLDERPATH_REGIONAL_ARCHIVE}] Folder of the regional archives.')
+    archive_parser.set_defaults(func=run_archive)
+
+    serve_parser = subparsers.add_parser('serve', help='Answer ROI time series queries over HTTP or a Unix socket from a long-running process.')
+    serve_parser.add_argument('--host', action='store', required=False, default=qs.DEFAULT_HOST, help=f'[default = {qs.DEFAULT_HOST}] Address to listen on.')
+    serve_parser.add_argument('--port', action='store', required=False, default=qs.DEFAULT_PORT, help=f'[default = {qs.DEFAULT_PORT}] Port to listen on, 0 picks a free one.')
+    serve_parser.add_argument('--unix-socket', action='store', required=False, default=None, help='[default = None] Path of a Unix socket to listen on instead of --host / --port.')
+    serve_parser.add_argument('-d', '--download_folderpath', action='store', required=False, default=None, help=f'[default = {config.FOLDERPATH_DOWNLOAD_CHC_CHIRPS_P05}] Folder of the {fmcf.PRODUCT_P05} files.')
+    serve_parser.add_argument('--prelim-download-folderpath', action='store', required=False, default=None, help=f'[default = {config.FOLDERPATH_DOWNLOAD_CHC_CHIRPS_PRELIM}] Folder of the {fmcf.PRODUCT_PRELIM} files.')
+    serve_parser.add_argument('--tif-cache-folderpath', action='store', required=False, default=None, help='[default = None] Folder, ideally on a node-local disk, where the decompressed files are kept so that queries skip decompression.')
+    serve_parser.add_argument('--tif-cache-max-gb', action='store', required=False, default=tc.DEFAULT_MAX_BYTES / 2**30, help=f'[default = {tc.DEFAULT_MAX_BYTES / 2**30:g}] Size cap (GB) of --tif-cache-folderpath.')
+    serve_parser.add_argument('--max-cached-indexes', action='store', required=False, default=qs.DEFAULT_MAX_CACHED_INDEXES, help=f'[default = {qs.DEFAULT_MAX_CACHED_INDEXES}] Number of ROI pixel indices kept in memory.')
+    serve_parser.add_argument('--preload', action='store', nargs='*', required=False, default=[], help='[default = None] Shapefiles whose ROI pixel index is built at start up.')
+    serve_parser.set_defaults(func=run_serve)
+
+    launch_parser = subparsers.add_parser('launch', help='Run a sharded extract or fetch as local processes, followed by the merge.')
+    launch_parser.add_argument('n_shards', action='store', help='Number of shard processes. The -j cores are split between them.')
+    launch_parser.add_argument('job_args', nargs=argparse.REMAINDER, help='extract / fetch subcommand with its arguments, without --shard.')
+    launch_parser.set_defaults(func=run_launch)
+
+    batch_parser = subparsers.add_parser('batch', help='Run the subcommands listed in a job file in this process.')
+    batch_parser.add_argument('job_filepath', action='store', help='Path to the job file, one subcommand with its arguments per line.')
+    batch_parser.add_argument('--continue-on-error', action='store_true', help='Continue with the remaining jobs if a job fails.')
+    batch_parser.set_defaults(func=run_batch)
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    njobs = int(args.njobs)
+    if njobs <= 0:
+        njobs = DEFAULT_NJOBS
+
+    session = Session(njobs=njobs)
+    try:
+        args.func(args=args, session=session)
+    finally:
+        session.close()
+
+    end_time = time.time()
+
+    print(f"--- {round(end_time - start_time, 2)} seconds ---")
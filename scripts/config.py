@@ -14,4 +14,5 @@ FOLDERPATH_GEOGLAM_CHIRPS_GLOBAL = '/gpfs/data1/cmongp1/GEOGLAM/Input/intermed/c
 FOLDERPATH_DOWNLOAD_CHC_CHIRPS = '../data/chc/chirps-v2.0/'
 FOLDERPATH_DOWNLOAD_CHC_CHIRPS_P05 = os.path.join(FOLDERPATH_DOWNLOAD_CHC_CHIRPS, 'p05')
 FOLDERPATH_DOWNLOAD_CHC_CHIRPS_PRELIM = os.path.join(FOLDERPATH_DOWNLOAD_CHC_CHIRPS, 'prelim')
+FOLDERPATH_REGIONAL_ARCHIVE = os.path.join(FOLDERPATH_DOWNLOAD_CHC_CHIRPS, 'regional')
 FOLDERPATH_TEMP = '../data/temp/'
\ No newline at end of file
@@ -1,5 +1,3 @@
-import geopandas as gpd
-import multiprocessing as mp
 import time
 import argparse
 import shutil
@@ -10,25 +8,9 @@ import sys
 sys.path.append('..')
 
 import config
-import chcfetch.constants
 import fetch_missing_chirps_files as fmcf
 import read_tifs_create_met as rtcm
-
-
-def check_if_any_geom_within_chirps_bounds(
-    shapes_gdf:gpd.GeoDataFrame
-):
-    chirps_bounds_gdf = gpd.read_file(
-        chcfetch.constants.CHIRPS_V2_P50_BOUNDS_GEOJSON_FILEPATH
-    )
-
-    chirps_bounds_epsg_4326 = chirps_bounds_gdf['geometry'].iloc[0]
-    
-    any_roi_within_chirps_bounds = shapes_gdf.to_crs(
-        chirps_bounds_gdf.crs
-    ).within(chirps_bounds_epsg_4326).any()
-
-    return any_roi_within_chirps_bounds
+import worker_sizing as ws
 
 
 if __name__ == '__main__':
@@ -41,14 +23,13 @@ if __name__ == '__main__':
         epilog = f"--- Send your complaints to {','.join(config.MAINTAINERS)} ---",
     )
 
-    DEFAULT_NJOBS = min(mp.cpu_count() - 2, 16)
+    DEFAULT_NJOBS = min(ws.DEFAULT_NJOBS, 16)
 
     # last available files as of 2024-10-09
     DEFAULT_BEFORE_DATE_PRELIM = '2024-10-05'
     DEFAULT_BEFORE_DATE_P05 = '2024-08-31'
     
-    VALID_PRODUCTS = [fmcf.chcfetch.Products.CHIRPS.P05, 
-                      fmcf.chcfetch.Products.CHIRPS.PRELIM]
+    VALID_PRODUCTS = fmcf.VALID_PRODUCTS
     VALID_AGGREGATION = list(rtcm.AGGREGATION_DICT.keys())
 
     parser.add_argument('start_year', action='store', help=f'Start year for fetching the CHIRPS data. Format: YYYY')
@@ -88,7 +69,7 @@ if __name__ == '__main__':
     
     njobs = int(args.njobs)
     if njobs <= 0:
-        njobs = mp.cpu_count() - 2
+        njobs = ws.DEFAULT_NJOBS
 
     working_folderpath = config.FOLDERPATH_TEMP
 
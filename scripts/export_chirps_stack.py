@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import time
+import argparse
+import shutil
+import os
+import datetime
+
+import sys
+sys.path.append('..')
+
+import config
+from lazy_imports import lazy_import
+import fetch_missing_chirps_files as fmcf
+import read_tifs_create_met as rtcm
+import read_tifs_create_stack as rtcs
+import worker_sizing as ws
+
+gpd = lazy_import('geopandas')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog = 'python export_chirps_stack.py',
+        description = (
+            'Script to export the daily CHIRPS pixels clipped to a given shapefile '
+            'as a single multi-band tif, one band per date, for start_date to end_date. '
+            'start_date and end_date both are included in the query.'
+        ),
+        epilog = f"--- Send your complaints to {','.join(config.MAINTAINERS)} ---",
+    )
+
+    DEFAULT_NJOBS = min(ws.DEFAULT_NJOBS, 16)
+    
+    VALID_PRODUCTS = fmcf.VALID_PRODUCTS
+
+    parser.add_argument('roi_filepath', action='store', help='Path to the shapefile.')
+    parser.add_argument('start_date', action='store', help=f'Start date for querying the CHIRPS data. Format: YYYY-MM-DD')
+    parser.add_argument('end_date', action='store', help=f'End date for querying the CHIRPS data. Format: YYYY-MM-DD')
+    parser.add_argument('export_filepath', action='store', help='Filepath where the output tif is to be stored.')
+    parser.add_argument('-p', '--product', action='store', default='p05', required=False, help=f'[default = p05] CHIRPS product to be fetched. Options: {VALID_PRODUCTS}.')
+    parser.add_argument('-d', '--download_folderpath', action='store', required=False, default=None, help=f"[default = {config.FOLDERPATH_DOWNLOAD_CHC_CHIRPS + 'PRODUCT/'}] Path to the folder where files will be downloaded to.")
+    parser.add_argument('-j', '--njobs', action='store', default=DEFAULT_NJOBS, required=False, help=f'[default = {DEFAULT_NJOBS}] Number of cores to use for parallel reads.')
+    parser.add_argument('--chunk-size', action='store', default=rtcs.DEFAULT_CHUNK_SIZE, required=False, help=f'[default = {rtcs.DEFAULT_CHUNK_SIZE}] Number of dates held in memory before being written to the output tif.')
+    parser.add_argument('--chunk-max-mb', action='store', default=rtcs.DEFAULT_CHUNK_MAX_BYTES // 2**20, required=False, help=f'[default = {rtcs.DEFAULT_CHUNK_MAX_BYTES // 2**20}] Memory budget (MB) of the dates held in memory, caps --chunk-size for large ROIs.')
+    parser.add_argument('--ignore-missing-dates', action='store_true', help=f'If there are missing dates for requested date range, this option ignores the error and proceeds, except when there are no files present.')
+    parser.add_argument('--warn-missing-dates', action='store_true', help=f'If there are missing dates for requested date range, this option raises a warning and proceeds, except when there are no files present.')
+    
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    roi_filepath = args.roi_filepath
+    start_date = datetime.datetime.strptime(str(args.start_date), '%Y-%m-%d')
+    end_date = datetime.datetime.strptime(str(args.end_date), '%Y-%m-%d')
+    export_filepath = args.export_filepath
+    product = str(args.product).lower()
+    
+    if product not in VALID_PRODUCTS:
+        raise ValueError(f'Invalid product. Must be from {VALID_PRODUCTS}.')
+    
+    chirps_download_folderpath = args.download_folderpath
+    if chirps_download_folderpath is None:
+        chirps_download_folderpath = {
+            'p05': config.FOLDERPATH_DOWNLOAD_CHC_CHIRPS_P05,
+            'prelim': config.FOLDERPATH_DOWNLOAD_CHC_CHIRPS_PRELIM,
+        }[product]
+
+    njobs = int(args.njobs)
+    if njobs <= 0:
+        njobs = ws.DEFAULT_NJOBS
+
+    chunk_size = int(args.chunk_size)
+    chunk_max_bytes = int(float(args.chunk_max_mb) * 2**20)
+
+    if_missing_dates = 'raise'
+    if args.ignore_missing_dates:
+        if_missing_dates = 'ignore'
+    if args.warn_missing_dates:
+        if_missing_dates = 'warn'
+
+    working_folderpath = config.FOLDERPATH_TEMP
+
+    shapes_gdf = gpd.read_file(roi_filepath)
+
+    print("--- inputs ---")
+    print(f"roi_filepath: {roi_filepath}")
+    print(f"start_date: {start_date.strftime('%Y-%m-%d')}")
+    print(f"end_date: {end_date.strftime('%Y-%m-%d')}")
+    print(f"export_filepath: {export_filepath}")
+    print(f"product: {product}")
+    print(f"download_folderpath: {chirps_download_folderpath}")
+    print(f"njobs: {njobs}")
+    print(f"chunk_size: {chunk_size}")
+    print(f"chunk_max_bytes: {chunk_max_bytes}")
+    print(f"if_missing_dates: {if_missing_dates}")
+    
+    print("--- run ---")
+
+    catalogue_df = fmcf.generate_chc_chirps_catalogue_df(
+        folderpath = chirps_download_folderpath,
+    )
+
+    catalogue_df = fmcf.filter_catalogue_by_date_range(
+        catalogue_df = catalogue_df,
+        start_date = start_date,
+        end_date = end_date,
+        if_missing_dates = if_missing_dates,
+    )
+
+    if not fmcf.check_if_any_geom_within_chirps_bounds(shapes_gdf=shapes_gdf):
+        raise ValueError(f'None of the geometries in {roi_filepath} are within CHIRPS bounds.')
+    
+    catalogue_df[rtcm.COL_METHOD] = rtcm.LoadTIFMethod.READ_AND_CROP
+
+    print('Reading tifs and creating stack')
+    rtcs.read_tifs_create_stack(
+        catalogue_df = catalogue_df,
+        shapes_gdf = shapes_gdf,
+        export_filepath = export_filepath,
+        working_folderpath = working_folderpath,
+        chunk_size = chunk_size,
+        chunk_max_bytes = chunk_max_bytes,
+        njobs = njobs,
+    )
+
+    if os.path.exists(working_folderpath):
+        shutil.rmtree(working_folderpath)
+
+    end_time = time.time()
+
+    print(f"--- {round(end_time - start_time, 2)} seconds ---")
@@ -1,35 +1,22 @@
-import geopandas as gpd
-import multiprocessing as mp
+from __future__ import annotations
+
 import time
 import argparse
 import shutil
 import os
 import datetime
-import warnings
 
 import sys
 sys.path.append('..')
 
 import config
-import chcfetch.constants
+from lazy_imports import lazy_import
 import fetch_missing_chirps_files as fmcf
 import read_tifs_create_met as rtcm
+import temporal_aggregation as ta
+import worker_sizing as ws
 
-
-def check_if_any_geom_within_chirps_bounds(
-    shapes_gdf:gpd.GeoDataFrame
-):
-    chirps_bounds_gdf = gpd.read_file(
-        chcfetch.constants.CHIRPS_V2_P50_BOUNDS_GEOJSON_FILEPATH
-    )
-
-    chirps_bounds_epsg_4326 = chirps_bounds_gdf['geometry'].iloc[0]
-    
-    any_roi_within_chirps_bounds = shapes_gdf.to_crs(
-        chirps_bounds_gdf.crs
-    ).within(chirps_bounds_epsg_4326).any()
-
-    return any_roi_within_chirps_bounds
+gpd = lazy_import('geopandas')
 
 
 if __name__ == '__main__':
@@ -43,11 +30,12 @@ if __name__ == '__main__':
         epilog = f"--- Send your complaints to {','.join(config.MAINTAINERS)} ---",
     )
 
-    DEFAULT_NJOBS = min(mp.cpu_count() - 2, 16)
+    DEFAULT_NJOBS = min(ws.DEFAULT_NJOBS, 16)
     
-    VALID_PRODUCTS = [fmcf.chcfetch.Products.CHIRPS.P05, 
-                      fmcf.chcfetch.Products.CHIRPS.PRELIM]
+    VALID_PRODUCTS = fmcf.VALID_PRODUCTS
     VALID_AGGREGATION = list(rtcm.AGGREGATION_DICT.keys())
+    VALID_PERIODS = ta.VALID_PERIODS
+    VALID_REDUCTIONS = ta.VALID_REDUCTIONS
 
     parser.add_argument('roi_filepath', action='store', help='Path to the shapefile.')
     parser.add_argument('start_date', action='store', help=f'Start date for querying the CHIRPS data. Format: YYYY-MM-DD')
@@ -55,10 +43,14 @@ if __name__ == '__main__':
     parser.add_argument('export_filepath', action='store', help='Filepath where the output csv is to be stored.')
     parser.add_argument('-p', '--product', action='store', default='p05', required=False, help=f'[default = p05] CHIRPS product to be fetched. Options: {VALID_PRODUCTS}.')
     parser.add_argument('-d', '--download_folderpath', action='store', required=False, default=None, help=f"[default = {config.FOLDERPATH_DOWNLOAD_CHC_CHIRPS + 'PRODUCT/'}] Path to the folder where files will be downloaded to.")
-    parser.add_argument('-a', '--aggregation', action='store', default='mean', required=False, help=f'[default = mean] Aggregation method to reduce CHIRPS values for a given region to a single value. Options: {VALID_AGGREGATION}.')
+    parser.add_argument('-a', '--aggregation', action='store', default='mean', required=False, help=f'[default = mean] Aggregation method to reduce CHIRPS values for a given region to a single value. Options: {VALID_AGGREGATION}. Several comma separated aggregations (e.g. mean,median) are computed from a single read of each file, one column per aggregation.')
     parser.add_argument('-j', '--njobs', action='store', default=DEFAULT_NJOBS, required=False, help=f'[default = {DEFAULT_NJOBS}] Number of cores to use for parallel downloads and computation.')
     parser.add_argument('--ignore-missing-dates', action='store_true', help=f'If there are missing dates for requested date range, this option ignores the error and proceeds, except when there are no files present.')
     parser.add_argument('--warn-missing-dates', action='store_true', help=f'If there are missing dates for requested date range, this option raises a warning and proceeds, except when there are no files present.')
+    parser.add_argument('-t', '--period', action='store', required=False, default=None, help=f'[default = None] If provided, daily values are reduced to this period and the csv contains one row per period. Options: {VALID_PERIODS}.')
+    parser.add_argument('-r', '--reductions', action='store', required=False, default=ta.TemporalReduction.SUM, help=f'[default = {ta.TemporalReduction.SUM}] Comma separated temporal reductions to compute when --period is provided. Options: {VALID_REDUCTIONS}.')
+    parser.add_argument('--rainy-day-threshold', action='store', required=False, default=ta.DEFAULT_RAINY_DAY_THRESHOLD, help=f'[default = {ta.DEFAULT_RAINY_DAY_THRESHOLD}] Daily value (mm) at or above which a day is considered rainy, used by the rainy_days and max_consecutive_dry_days reductions.')
+    parser.add_argument('-c', '--cache_filepath', action='store', required=False, default=None, help='[default = None] Path to a sqlite file used to cache aggregated values across runs. Caching is disabled if not provided.')
     
     args = parser.parse_args()
 
@@ -79,13 +71,30 @@ if __name__ == '__main__':
             'prelim': config.FOLDERPATH_DOWNLOAD_CHC_CHIRPS_PRELIM,
         }[product]
 
-    aggregation = str(args.aggregation).lower()
-    if aggregation not in VALID_AGGREGATION:
-        raise ValueError(f'Invalid aggregation. Must be from {VALID_AGGREGATION}.')
+    aggregations = [aggregation.strip() for aggregation in str(args.aggregation).lower().split(',')]
+    invalid_aggregations = set(aggregations) - set(VALID_AGGREGATION)
+    if len(invalid_aggregations) > 0:
+        raise ValueError(f'Invalid aggregations {invalid_aggregations}. Must be from {VALID_AGGREGATION}.')
+    aggregation = aggregations if len(aggregations) > 1 else aggregations[0]
     
+    period = args.period
+    if period is not None:
+        period = str(period).lower()
+        if period not in VALID_PERIODS:
+            raise ValueError(f'Invalid period. Must be from {VALID_PERIODS}.')
+        if len(aggregations) > 1:
+            raise ValueError('Only a single aggregation is supported with --period.')
+
+    reductions = [reduction.strip() for reduction in str(args.reductions).lower().split(',')]
+    invalid_reductions = set(reductions) - set(VALID_REDUCTIONS)
+    if len(invalid_reductions) > 0:
+        raise ValueError(f'Invalid reductions {invalid_reductions}. Must be from {VALID_REDUCTIONS}.')
+
+    rainy_day_threshold = float(args.rainy_day_threshold)
+
     njobs = int(args.njobs)
     if njobs <= 0:
-        njobs = mp.cpu_count() - 2
+        njobs = ws.DEFAULT_NJOBS
 
 
     if_missing_dates = 'raise'
@@ -96,9 +105,15 @@ if __name__ == '__main__':
 
     working_folderpath = config.FOLDERPATH_TEMP
 
+    cache_filepath = args.cache_filepath
+
     shapes_gdf = gpd.read_file(roi_filepath)
 
-    VAL_COL = f'{aggregation} CHIRPS'
+    if len(aggregations) > 1:
+        VAL_COL = 'CHIRPS'
+    else:
+        VAL_COL = f'{aggregation} CHIRPS'
+    VAL_COLS = rtcm.get_val_cols(aggregation=aggregation, val_col=VAL_COL)
 
     print("--- inputs ---")
     print(f"roi_filepath: {roi_filepath}")
@@ -108,8 +123,13 @@ if __name__ == '__main__':
     print(f"product: {product}")
     print(f"download_folderpath: {chirps_download_folderpath}")
     print(f"aggregation: {aggregation}")
+    print(f"period: {period}")
+    if period is not None:
+        print(f"reductions: {reductions}")
+        print(f"rainy_day_threshold: {rainy_day_threshold}")
     print(f"njobs: {njobs}")
     print(f"if_missing_dates: {if_missing_dates}")
+    print(f"cache_filepath: {cache_filepath}")
     
     print("--- run ---")
 
@@ -117,42 +137,53 @@ if __name__ == '__main__':
         folderpath = chirps_download_folderpath,
     )
 
-    catalogue_df = catalogue_df[
-        (catalogue_df[fmcf.COL_DATE] >= start_date) &
-        (catalogue_df[fmcf.COL_DATE] <= end_date)
-    ]
-
-    total_days_expected = (end_date - start_date).days
-    missing_dates_count = total_days_expected - catalogue_df.shape[0]
-    if missing_dates_count > 0:
-        if if_missing_dates == 'raise':
-            raise ValueError(f'{missing_dates_count} dates missing.')
-        if if_missing_dates == 'warn':
-            warnings.warn(message = f'{missing_dates_count} dates missing.',
-                          category = RuntimeWarning)
+    catalogue_df = fmcf.filter_catalogue_by_date_range(
+        catalogue_df = catalogue_df,
+        start_date = start_date,
+        end_date = end_date,
+        if_missing_dates = if_missing_dates,
+    )
+
+    if not fmcf.check_if_any_geom_within_chirps_bounds(shapes_gdf=shapes_gdf):
+        raise ValueError(f'None of the geometries in {roi_filepath} are within CHIRPS bounds.')
     
     catalogue_df[rtcm.COL_METHOD] = rtcm.LoadTIFMethod.READ_AND_CROP
 
     print('Reading tifs and generating csv')
-    updated_catalogue_df = rtcm.read_tifs_get_agg_value(
-        shapes_gdf = shapes_gdf,
-        catalogue_df = catalogue_df,
-        val_col = VAL_COL,
-        aggregation = aggregation,
-        njobs = njobs,
-        working_folderpath = working_folderpath,
-    )
+    if period is None:
+        updated_catalogue_df = rtcm.read_tifs_get_agg_value(
+            shapes_gdf = shapes_gdf,
+            catalogue_df = catalogue_df,
+            val_col = VAL_COL,
+            aggregation = aggregation,
+            njobs = njobs,
+            working_folderpath = working_folderpath,
+            cache_filepath = cache_filepath,
+        )
+        export_df = updated_catalogue_df[[
+            fmcf.COL_DATE,
+            fmcf.COL_YEAR,
+            fmcf.COL_DAY,
+        ] + VAL_COLS]
+    else:
+        export_df = rtcm.read_tifs_get_temporal_agg_values(
+            shapes_gdf = shapes_gdf,
+            catalogue_df = catalogue_df,
+            val_col = VAL_COL,
+            period = period,
+            reductions = reductions,
+            rainy_day_threshold = rainy_day_threshold,
+            aggregation = aggregation,
+            njobs = njobs,
+            working_folderpath = working_folderpath,
+            cache_filepath = cache_filepath,
+        )
 
     if os.path.exists(working_folderpath):
         shutil.rmtree(working_folderpath)
 
     os.makedirs(os.path.split(export_filepath)[0], exist_ok=True)
-    updated_catalogue_df[[
-        fmcf.COL_DATE,
-        fmcf.COL_YEAR,
-        fmcf.COL_DAY,
-        VAL_COL,
-    ]].to_csv(export_filepath, index=False)
+    export_df.to_csv(export_filepath, index=False)
 
     end_time = time.time()
 
@@ -1,35 +1,21 @@
-import geopandas as gpd
-import multiprocessing as mp
+from __future__ import annotations
+
 import time
 import argparse
 import shutil
 import os
 import datetime
-import warnings
 
 import sys
 sys.path.append('..')
 
 import config
-import chcfetch.constants
+from lazy_imports import lazy_import
 import fetch_missing_chirps_files as fmcf
 import read_tifs_create_met as rtcm
+import worker_sizing as ws
 
-
-def check_if_any_geom_within_chirps_bounds(
-    shapes_gdf:gpd.GeoDataFrame
-):
-    chirps_bounds_gdf = gpd.read_file(
-        chcfetch.constants.CHIRPS_V2_P50_BOUNDS_GEOJSON_FILEPATH
-    )
-
-    chirps_bounds_epsg_4326 = chirps_bounds_gdf['geometry'].iloc[0]
-    
-    any_roi_within_chirps_bounds = shapes_gdf.to_crs(
-        chirps_bounds_gdf.crs
-    ).within(chirps_bounds_epsg_4326).any()
-
-    return any_roi_within_chirps_bounds
+gpd = lazy_import('geopandas')
 
 
 if __name__ == '__main__':
@@ -41,10 +27,9 @@ if __name__ == '__main__':
         epilog = f"--- Send your complaints to {','.join(config.MAINTAINERS)} ---",
     )
 
-    DEFAULT_NJOBS = min(mp.cpu_count() - 2, 16)
+    DEFAULT_NJOBS = min(ws.DEFAULT_NJOBS, 16)
     
-    VALID_PRODUCTS = [fmcf.chcfetch.Products.CHIRPS.P05, 
-                      fmcf.chcfetch.Products.CHIRPS.PRELIM]
+    VALID_PRODUCTS = fmcf.VALID_PRODUCTS
     VALID_AGGREGATION = list(rtcm.AGGREGATION_DICT.keys())
 
     parser.add_argument('roi_filepath', action='store', help='Path to the shapefile.')
@@ -58,6 +43,7 @@ if __name__ == '__main__':
     parser.add_argument('-j', '--njobs', action='store', default=DEFAULT_NJOBS, required=False, help=f'[default = {DEFAULT_NJOBS}] Number of cores to use for parallel downloads and computation.')
     parser.add_argument('--ignore-missing-dates', action='store_true', help=f'If there are missing dates for requested date range, this option ignores the error and proceeds, except when there are no files present.')
     parser.add_argument('--warn-missing-dates', action='store_true', help=f'If there are missing dates for requested date range, this option raises a warning and proceeds, except when there are no files present.')
+    parser.add_argument('-c', '--cache_filepath', action='store', required=False, default=None, help='[default = None] Path to a sqlite file used to cache aggregated values across runs. Caching is disabled if not provided.')
     
     args = parser.parse_args()
 
@@ -85,7 +71,7 @@ if __name__ == '__main__':
     
     njobs = int(args.njobs)
     if njobs <= 0:
-        njobs = mp.cpu_count() - 2
+        njobs = ws.DEFAULT_NJOBS
 
 
     if_missing_dates = 'raise'
@@ -96,6 +82,8 @@ if __name__ == '__main__':
 
     working_folderpath = config.FOLDERPATH_TEMP
 
+    cache_filepath = args.cache_filepath
+
     shapes_gdf = gpd.read_file(roi_filepath)
 
     VAL_COL = f'{aggregation} CHIRPS'
@@ -110,6 +98,7 @@ if __name__ == '__main__':
     print(f"aggregation: {aggregation}")
     print(f"njobs: {njobs}")
     print(f"if_missing_dates: {if_missing_dates}")
+    print(f"cache_filepath: {cache_filepath}")
     
     print("--- run ---")
 
@@ -117,19 +106,15 @@ if __name__ == '__main__':
         folderpath = chirps_download_folderpath,
     )
 
-    catalogue_df = catalogue_df[
-        (catalogue_df[fmcf.COL_DATE] >= start_date) &
-        (catalogue_df[fmcf.COL_DATE] <= end_date)
-    ]
-
-    total_days_expected = (end_date - start_date).days
-    missing_dates_count = total_days_expected - catalogue_df.shape[0]
-    if missing_dates_count > 0:
-        if if_missing_dates == 'raise':
-            raise ValueError(f'{missing_dates_count} dates missing.')
-        if if_missing_dates == 'warn':
-            warnings.warn(message = f'{missing_dates_count} dates missing.',
-                          category = RuntimeWarning)
+    catalogue_df = fmcf.filter_catalogue_by_date_range(
+        catalogue_df = catalogue_df,
+        start_date = start_date,
+        end_date = end_date,
+        if_missing_dates = if_missing_dates,
+    )
+
+    if not fmcf.check_if_any_geom_within_chirps_bounds(shapes_gdf=shapes_gdf):
+        raise ValueError(f'None of the geometries in {roi_filepath} are within CHIRPS bounds.')
     
     catalogue_df[rtcm.COL_METHOD] = rtcm.LoadTIFMethod.READ_AND_CROP
 
@@ -147,6 +132,7 @@ if __name__ == '__main__':
             aggregation = aggregation,
             njobs = njobs,
             working_folderpath = working_folderpath,
+            cache_filepath = cache_filepath,
         )
 
         if os.path.exists(working_folderpath):
@@ -0,0 +1,239 @@
+from __future__ import annotations
+
+import os
+import numpy as np
+
+from lazy_imports import lazy_import
+
+pd = lazy_import('pandas')
+gpd = lazy_import('geopandas')
+
+import fetch_missing_chirps_files as fmcf
+import roi_planning as rp
+
+
+"""
+Splitting one extraction into independent shard jobs that can run as separate
+processes, on separate nodes or as scheduler array tasks. Work is partitioned
+either by date (contiguous date ranges of the catalogue) or by ROI cluster
+(contiguous runs of the clusters from rp.plan_rois, balanced by number of
+geometries). Each shard writes its partial result next to the final export
+(see get_shard_filepath), written atomically so that a partial file only
+exists once its shard is complete. merge_shard_files then checks that every
+shard is present and consistent and combines them into the final output.
+"""
+
+
+SHARD_BY_DATE = 'date'
+SHARD_BY_CLUSTER = 'cluster'
+VALID_SHARD_BY = [SHARD_BY_DATE, SHARD_BY_CLUSTER]
+
+
+def parse_shard(shard:str):
+    """
+    'INDEX/COUNT' -> (index, count) with 0 <= index < count.
+    """
+    try:
+        shard_index, n_shards = [int(x) for x in str(shard).split('/')]
+    except ValueError:
+        raise ValueError(f'Invalid shard={shard}. Format: INDEX/COUNT, e.g. 0/4')
+    if n_shards <= 0 or not 0 <= shard_index < n_shards:
+        raise ValueError(f'Invalid shard={shard}. INDEX must be in [0, COUNT).')
+    return shard_index, n_shards
+
+
+def get_shard_bounds(
+    n_items:int,
+    shard_index:int,
+    n_shards:int,
+):
+    """
+    [start, stop) of the contiguous block of n_items assigned to shard_index,
+    with block sizes differing by at most one.
+    """
+    start = (n_items * shard_index) // n_shards
+    stop = (n_items * (shard_index + 1)) // n_shards
+    return start, stop
+
+
+def shard_years(
+    years:list[int],
+    shard_index:int,
+    n_shards:int,
+):
+    years = sorted(years)
+    start, stop = get_shard_bounds(
+        n_items = len(years),
+        shard_index = shard_index,
+        n_shards = n_shards,
+    )
+    return years[start:stop]
+
+
+def shard_catalogue_df(
+    catalogue_df:pd.DataFrame,
+    shard_index:int,
+    n_shards:int,
+    date_col:str = fmcf.COL_DATE,
+):
+    """
+    Rows of catalogue_df in the contiguous date range assigned to shard_index.
+    """
+    sorted_catalogue_df = catalogue_df.sort_values(by=date_col).reset_index(drop=True)
+    start, stop = get_shard_bounds(
+        n_items = sorted_catalogue_df.shape[0],
+        shard_index = shard_index,
+        n_shards = n_shards,
+    )
+    return sorted_catalogue_df.iloc[start:stop]
+
+
+def shard_planned_gdf(
+    planned_gdf:gpd.GeoDataFrame,
+    shard_index:int,
+    n_shards:int,
+    cluster_col:str = rp.COL_CLUSTER,
+):
+    """
+    Geometries of planned_gdf (output of rp.plan_rois) whose clusters are
+    assigned to shard_index. Clusters are never split across shards and are
+    assigned as contiguous runs of cluster ids so that each shard covers a
+    compact area, cut where the cumulative number of geometries crosses the
+    shard boundaries.
+    """
+    cluster_ids, cluster_sizes = np.unique(planned_gdf[cluster_col], return_counts=True)
+    n_geoms = int(cluster_sizes.sum())
+    # shard of each cluster = shard boundary its midpoint (in geometries) falls in
+    cluster_midpoints = np.cumsum(cluster_sizes) - cluster_sizes / 2
+    cluster_shards = np.floor(cluster_midpoints * n_shards / max(n_geoms, 1)).astype(int)
+    shard_cluster_ids = cluster_ids[cluster_shards == shard_index]
+    return planned_gdf[planned_gdf[cluster_col].isin(shard_cluster_ids)]
+
+
+def shard_shapes_gdf(
+    shapes_gdf:gpd.GeoDataFrame,
+    shard_index:int,
+    n_shards:int,
+    bounds_gdf:gpd.GeoDataFrame = None,
+):
+    """
+    Rows of shapes_gdf (unchanged, in its own crs) assigned to shard_index
+    when sharding by cluster. Geometries that rp.plan_rois drops for being
+    outside the raster bounds go to the first shard so that they still show
+    up once in the merged output.
+    """
+    planned_gdf = rp.plan_rois(
+        shapes_gdf = shapes_gdf.reset_index(drop=True),
+        bounds_gdf = bounds_gdf,
+    )
+    shard_positions = shard_planned_gdf(
+        planned_gdf = planned_gdf,
+        shard_index = shard_index,
+        n_shards = n_shards,
+    ).index.to_numpy()
+    if shard_index == 0:
+        dropped_positions = np.setdiff1d(np.arange(shapes_gdf.shape[0]), planned_gdf.index.to_numpy())
+        shard_positions = np.concatenate([dropped_positions, shard_positions])
+    return shapes_gdf.iloc[np.sort(shard_positions)]
+
+
+def get_shard_filepath(
+    export_filepath:str,
+    shard_index:int,
+    n_shards:int,
+):
+    root, ext = os.path.splitext(export_filepath)
+    return f'{root}.shard-{shard_index:04d}-of-{n_shards:04d}{ext}'
+
+
+def write_shard_csv(
+    shard_df:pd.DataFrame,
+    export_filepath:str,
+    shard_index:int,
+    n_shards:int,
+):
+    shard_filepath = get_shard_filepath(
+        export_filepath = export_filepath,
+        shard_index = shard_index,
+        n_shards = n_shards,
+    )
+    shard_folderpath = os.path.split(shard_filepath)[0]
+    if shard_folderpath != '':
+        os.makedirs(shard_folderpath, exist_ok=True)
+    tmp_filepath = shard_filepath + f'.{os.getpid()}.tmp'
+    shard_df.to_csv(tmp_filepath, index=False)
+    os.replace(tmp_filepath, shard_filepath)
+    return shard_filepath
+
+
+def merge_shard_files(
+    export_filepath:str,
+    n_shards:int,
+    key_cols:list[str] = [fmcf.COL_DATE],
+    date_col:str = fmcf.COL_DATE,
+    remove_shard_files:bool = False,
+):
+    """
+    Combines the n_shards partial csvs of export_filepath into
+    export_filepath. Raises an error if a shard is missing, if the shards do
+    not have the same columns, or if a key (e.g. date, or date and geometry
+    id) appears more than once.
+    """
+    shard_filepaths = [
+        get_shard_filepath(
+            export_filepath = export_filepath,
+            shard_index = shard_index,
+            n_shards = n_shards,
+        )
+        for shard_index in range(n_shards)
+    ]
+
+    missing_shard_filepaths = [
+        shard_filepath for shard_filepath in shard_filepaths
+        if not os.path.exists(shard_filepath)
+    ]
+    if len(missing_shard_filepaths) > 0:
+        raise ValueError(
+            f'{len(missing_shard_filepaths)} / {n_shards} shards missing: '
+            f'{missing_shard_filepaths}'
+        )
+
+    shard_dfs = [
+        pd.read_csv(shard_filepath, parse_dates=[date_col])
+        for shard_filepath in shard_filepaths
+    ]
+
+    columns = list(shard_dfs[0].columns)
+    for shard_filepath, shard_df in zip(shard_filepaths, shard_dfs):
+        if list(shard_df.columns) != columns:
+            raise ValueError(
+                f'{shard_filepath} has columns {list(shard_df.columns)}, '
+                f'expected {columns}.'
+            )
+        missing_key_cols = set(key_cols) - set(columns)
+        if len(missing_key_cols) > 0:
+            raise ValueError(f'{shard_filepath} is missing the key columns {missing_key_cols}.')
+
+    merged_df = pd.concat(shard_dfs, ignore_index=True)
+
+    is_duplicated = merged_df.duplicated(subset=key_cols, keep=False)
+    if is_duplicated.any():
+        raise ValueError(
+            f'{int(is_duplicated.sum())} rows with duplicated {key_cols} across shards, '
+            'shards are probably from different runs.'
+        )
+
+    merged_df = merged_df.sort_values(by=key_cols).reset_index(drop=True)
+
+    export_folderpath = os.path.split(export_filepath)[0]
+    if export_folderpath != '':
+        os.makedirs(export_folderpath, exist_ok=True)
+    merged_df.to_csv(export_filepath, index=False)
+
+    print(f'Merged {n_shards} shards, {merged_df.shape[0]} rows -> {export_filepath}')
+
+    if remove_shard_files:
+        for shard_filepath in shard_filepaths:
+            os.remove(shard_filepath)
+
+    return merged_df
@@ -0,0 +1,226 @@
+import datetime
+import calendar
+import numpy as np
+
+
+"""
+Running accumulators to reduce daily values to dekadal, monthly or seasonal
+values without materialising the daily series. Values can be scalars or numpy
+arrays (e.g. one value per geometry), reductions are applied element-wise.
+"""
+
+
+COL_PERIOD_START = 'period_start'
+COL_PERIOD_END = 'period_end'
+COL_N_DAYS = 'n_days'
+
+# CHIRPS values are in mm/day
+DEFAULT_RAINY_DAY_THRESHOLD = 1.0
+
+
+class TemporalPeriod:
+    DEKAD = 'dekad'
+    MONTH = 'month'
+    SEASON = 'season' # DJF, MAM, JJA, SON
+
+
+class TemporalReduction:
+    SUM = 'sum'
+    MEAN = 'mean'
+    RAINY_DAYS = 'rainy_days'
+    MAX_CONSECUTIVE_DRY_DAYS = 'max_consecutive_dry_days'
+
+
+VALID_PERIODS = [
+    TemporalPeriod.DEKAD,
+    TemporalPeriod.MONTH,
+    TemporalPeriod.SEASON,
+]
+
+VALID_REDUCTIONS = [
+    TemporalReduction.SUM,
+    TemporalReduction.MEAN,
+    TemporalReduction.RAINY_DAYS,
+    TemporalReduction.MAX_CONSECUTIVE_DRY_DAYS,
+]
+
+
+def _get_month_end(year:int, month:int):
+    return calendar.monthrange(year, month)[1]
+
+
+def get_period_bounds(date:datetime.datetime, period:str):
+    year, month, day = date.year, date.month, date.day
+
+    if period == TemporalPeriod.DEKAD:
+        if day <= 10:
+            start_day, end_day = 1, 10
+        elif day <= 20:
+            start_day, end_day = 11, 20
+        else:
+            start_day, end_day = 21, _get_month_end(year=year, month=month)
+        period_start = datetime.datetime(year, month, start_day)
+        period_end = datetime.datetime(year, month, end_day)
+
+    elif period == TemporalPeriod.MONTH:
+        period_start = datetime.datetime(year, month, 1)
+        period_end = datetime.datetime(
+            year, month, _get_month_end(year=year, month=month),
+        )
+
+    elif period == TemporalPeriod.SEASON:
+        # December belongs to the DJF season of the following year's Jan/Feb
+        start_year, start_month = year, month - month % 3
+        if start_month == 0:
+            start_year, start_month = year - 1, 12
+        end_year, end_month = start_year, start_month + 2
+        if end_month > 12:
+            end_year, end_month = end_year + 1, end_month - 12
+        period_start = datetime.datetime(start_year, start_month, 1)
+        period_end = datetime.datetime(
+            end_year, end_month, _get_month_end(year=end_year, month=end_month),
+        )
+
+    else:
+        raise ValueError(f'Invalid period={period}. Valid periods: {VALID_PERIODS}')
+
+    return period_start, period_end
+
+
+class PeriodAccumulator:
+    def __init__(
+        self,
+        period_start:datetime.datetime,
+        period_end:datetime.datetime,
+        rainy_day_threshold:float = DEFAULT_RAINY_DAY_THRESHOLD,
+    ):
+        self.period_start = period_start
+        self.period_end = period_end
+        self.rainy_day_threshold = rainy_day_threshold
+        self.n_days = 0
+        self.last_date = None
+        self.total = 0.0
+        self.count = 0
+        self.rainy_days = 0
+        self.current_dry_days = 0
+        self.max_dry_days = 0
+
+    def add(self, date:datetime.datetime, value):
+        value = np.asarray(value, dtype=float)
+        is_valid = ~np.isnan(value)
+        is_dry = is_valid & (value < self.rainy_day_threshold)
+
+        # a gap in the dates breaks the dry spell, as does a NaN value
+        if self.last_date is not None and (date - self.last_date).days > 1:
+            self.current_dry_days = 0
+
+        self.n_days += 1
+        self.last_date = date
+        self.total = self.total + np.where(is_valid, value, 0.0)
+        self.count = self.count + is_valid
+        self.rainy_days = self.rainy_days + (is_valid & ~is_dry)
+        self.current_dry_days = np.where(is_dry, self.current_dry_days + 1, 0)
+        self.max_dry_days = np.maximum(self.max_dry_days, self.current_dry_days)
+
+    def result(self, reductions:list[str]):
+        count = np.asarray(self.count)
+        total = np.asarray(self.total, dtype=float)
+        row = {
+            COL_PERIOD_START: self.period_start,
+            COL_PERIOD_END: self.period_end,
+            COL_N_DAYS: self.n_days,
+        }
+        for reduction in reductions:
+            if reduction == TemporalReduction.SUM:
+                value = np.where(count > 0, total, np.nan)
+            elif reduction == TemporalReduction.MEAN:
+                value = np.divide(
+                    total, count, out=np.full(total.shape, np.nan), where=count > 0,
+                )
+            elif reduction == TemporalReduction.RAINY_DAYS:
+                value = np.asarray(self.rainy_days)
+            elif reduction == TemporalReduction.MAX_CONSECUTIVE_DRY_DAYS:
+                value = np.asarray(self.max_dry_days)
+            else:
+                raise ValueError(f'Invalid reduction={reduction}. Valid reductions: {VALID_REDUCTIONS}')
+            row[reduction] = value[()]
+        return row
+
+
+class TemporalAccumulator:
+    """
+    Expects values to be added in ascending order of date. Returns the rows of
+    the periods that got closed with each add.
+    """
+    def __init__(
+        self,
+        period:str = TemporalPeriod.MONTH,
+        reductions:list[str] = [TemporalReduction.SUM],
+        rainy_day_threshold:float = DEFAULT_RAINY_DAY_THRESHOLD,
+    ):
+        if period not in VALID_PERIODS:
+            raise ValueError(f'Invalid period={period}. Valid periods: {VALID_PERIODS}')
+        invalid_reductions = set(reductions) - set(VALID_REDUCTIONS)
+        if len(invalid_reductions) > 0:
+            raise ValueError(f'Invalid reductions={invalid_reductions}. Valid reductions: {VALID_REDUCTIONS}')
+        self.period = period
+        self.reductions = reductions
+        self.rainy_day_threshold = rainy_day_threshold
+        self.period_accumulator = None
+        self.last_date = None
+
+    def add(self, date:datetime.datetime, value):
+        if self.last_date is not None and date < self.last_date:
+            raise ValueError(f'Dates must be added in ascending order. {date} < {self.last_date}')
+        self.last_date = date
+
+        rows = []
+        if self.period_accumulator is not None \
+            and date > self.period_accumulator.period_end:
+            rows = self.finalize()
+
+        if self.period_accumulator is None:
+            period_start, period_end = get_period_bounds(
+                date = date, period = self.period,
+            )
+            self.period_accumulator = PeriodAccumulator(
+                period_start = period_start,
+                period_end = period_end,
+                rainy_day_threshold = self.rainy_day_threshold,
+            )
+
+        self.period_accumulator.add(date=date, value=value)
+
+        return rows
+
+    def finalize(self):
+        rows = []
+        if self.period_accumulator is not None:
+            rows.append(self.period_accumulator.result(reductions=self.reductions))
+            self.period_accumulator = None
+        return rows
+
+
+def get_reduction_cols(reductions:list[str], val_cols:list[str]):
+    return [f'{reduction} {val_col}' for reduction in reductions for val_col in val_cols]
+
+
+def flatten_row(row:dict, reductions:list[str], val_cols:list[str]):
+    """
+    Splits the values of a row of TemporalAccumulator into one column per
+    (reduction, val_col), named '{reduction} {val_col}'. The values added to the
+    accumulator need to have been arrays of len(val_cols), or scalars if there
+    is a single val_col.
+    """
+    flat_row = {
+        COL_PERIOD_START: row[COL_PERIOD_START],
+        COL_PERIOD_END: row[COL_PERIOD_END],
+        COL_N_DAYS: row[COL_N_DAYS],
+    }
+    for reduction in reductions:
+        values = np.atleast_1d(row[reduction])
+        if values.shape[0] != len(val_cols):
+            raise ValueError(f'Expected {len(val_cols)} values for {reduction}, got {values.shape[0]}.')
+        for val_col, value in zip(val_cols, values):
+            flat_row[f'{reduction} {val_col}'] = value
+    return flat_row
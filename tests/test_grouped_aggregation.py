@@ -0,0 +1,203 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+rasterio = pytest.importorskip('rasterio')
+gpd = pytest.importorskip('geopandas')
+shapely = pytest.importorskip('shapely')
+
+import fetch_missing_chirps_files as fmcf
+import read_tifs_create_met as rtcm
+import label_raster as lr
+
+
+HEIGHT, WIDTH = 20, 30
+TRANSFORM = rasterio.transform.from_origin(30.0, 50.0, 0.1, 0.1)
+CRS = 'EPSG:4326'
+NODATA = -9999
+N_DATES = 3
+
+
+def write_tif(filepath, values):
+    profile = {
+        'driver': 'GTiff', 'dtype': 'float32', 'count': 1,
+        'height': HEIGHT, 'width': WIDTH, 'crs': CRS,
+        'transform': TRANSFORM, 'nodata': NODATA,
+    }
+    with rasterio.open(filepath, 'w', **profile) as dst:
+        dst.write(values.astype(np.float32), 1)
+
+
+@pytest.fixture
+def catalogue_df(tmp_path):
+    rng = np.random.default_rng(0)
+    rows = []
+    for i in range(N_DATES):
+        values = rng.uniform(0, 50, (HEIGHT, WIDTH)).round(2)
+        values[rng.uniform(size=(HEIGHT, WIDTH)) < 0.15] = NODATA
+        # a whole nodata block, so that some geometries only have nodata
+        values[2:5, 2:5] = NODATA
+        filepath = str(tmp_path / f'chirps-v2.0.2020.01.{i + 1:02d}.tif')
+        write_tif(filepath=filepath, values=values)
+        date = datetime.datetime(2020, 1, i + 1)
+        rows.append({
+            fmcf.COL_TIF_FILEPATH: filepath,
+            fmcf.COL_FILETYPE: fmcf.EXT_TIF,
+            fmcf.COL_MULTIPLIER: 1,
+            fmcf.COL_DATE: date,
+            fmcf.COL_YEAR: date.year,
+            fmcf.COL_DAY: date.timetuple().tm_yday,
+            rtcm.COL_METHOD: rtcm.LoadTIFMethod.READ_AND_CROP,
+        })
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture
+def shapes_gdf():
+    geometries = [
+        # inside the raster
+        shapely.box(30.52, 48.61, 31.13, 49.28),
+        # overlaps the previous one
+        shapely.Point(30.95, 48.85).buffer(0.27),
+        # clipped at the left and top edges of the raster
+        shapely.box(29.83, 49.61, 30.34, 50.22),
+        # clipped at the right and bottom edges of the raster
+        shapely.Point(32.96, 48.04).buffer(0.21),
+        # only nodata pixels
+        shapely.box(30.21, 49.51, 30.49, 49.79),
+        # a single pixel
+        shapely.box(31.52, 48.52, 31.58, 48.58),
+        # a ring, whose envelope centre is outside of it
+        shapely.Point(31.9, 49.1).buffer(0.45).difference(shapely.Point(31.9, 49.1).buffer(0.3)),
+    ]
+    return gpd.GeoDataFrame(
+        data = {'id': np.arange(len(geometries)) + 10},
+        geometry = geometries,
+        crs = CRS,
+    )
+
+
+def get_bounds_gdf():
+    return gpd.GeoDataFrame(
+        geometry = [shapely.box(*rasterio.transform.array_bounds(HEIGHT, WIDTH, TRANSFORM))],
+        crs = CRS,
+    )
+
+
+@pytest.mark.parametrize('aggregation', ['mean', 'median', 'centre'])
+def test_grouped_matches_per_geometry(catalogue_df, shapes_gdf, tmp_path, aggregation):
+    grouped_df = rtcm.read_tifs_get_agg_values_by_geometry(
+        catalogue_df = catalogue_df,
+        shapes_gdf = shapes_gdf,
+        val_col = 'value',
+        working_folderpath = str(tmp_path / 'working'),
+        id_col = 'id',
+        aggregation = aggregation,
+        bounds_gdf = get_bounds_gdf(),
+        njobs = 1,
+        backend = 'threads',
+    )
+    assert grouped_df.shape[0] == N_DATES * shapes_gdf.shape[0]
+
+    for position, geometry_id in enumerate(shapes_gdf['id']):
+        expected_df = rtcm.read_tifs_get_agg_value(
+            catalogue_df = catalogue_df,
+            shapes_gdf = shapes_gdf.iloc[[position]],
+            val_col = 'value',
+            working_folderpath = str(tmp_path / 'working'),
+            aggregation = aggregation,
+            njobs = 1,
+            backend = 'threads',
+        )
+        values = grouped_df[grouped_df['id'] == geometry_id].sort_values(by=fmcf.COL_DATE)['value']
+        np.testing.assert_allclose(
+            values.to_numpy(),
+            expected_df.sort_values(by=fmcf.COL_DATE)['value'].to_numpy(dtype=float),
+            rtol = 1e-6,
+            err_msg = f'id={geometry_id}',
+        )
+
+
+def test_grouped_median_matches_nanmedian():
+    rng = np.random.default_rng(1)
+    n_labels = 6
+    window_values = rng.uniform(0, 10, (8, 9))
+    window_values[rng.uniform(size=window_values.shape) < 0.2] = np.nan
+    # odd and even numbers of pixels per label, overlapping labels, one label
+    # without pixels and one with a single pixel
+    pixel_index = []
+    labels = []
+    for label, size in enumerate([7, 10, 0, 1, 2, 30]):
+        pixel_index.append(rng.choice(window_values.size, size=size, replace=False))
+        labels.append(np.full(size, label))
+    label_pixels = {
+        lr.KEY_PIXEL_INDEX: np.concatenate(pixel_index).astype(np.int64),
+        lr.KEY_LABELS: np.concatenate(labels).astype(np.int64),
+        lr.KEY_N_LABELS: np.array(n_labels),
+    }
+
+    medians = lr.grouped_reduce(
+        window_values = window_values,
+        label_pixels = label_pixels,
+        aggregation = 'median',
+    )
+
+    flat_values = window_values.ravel()
+    for label in range(n_labels):
+        values = flat_values[pixel_index[label]]
+        if np.isnan(values).all():
+            assert np.isnan(medians[label])
+        else:
+            assert medians[label] == pytest.approx(np.nanmedian(values))
+
+
+def test_centre_index_matches_get_centre_value():
+    values = np.arange(HEIGHT * WIDTH, dtype=float).reshape(HEIGHT, WIDTH)
+    geometries = [
+        shapely.box(30.52, 48.61, 31.13, 49.28),
+        shapely.box(30.5, 48.6, 30.9, 49.0),
+        shapely.box(29.83, 49.61, 30.34, 50.22),
+        shapely.Point(32.96, 48.04).buffer(0.21),
+        shapely.box(31.52, 48.52, 31.58, 48.58),
+    ]
+    label_pixels = lr.build_label_pixels(
+        geometries = geometries,
+        transform = TRANSFORM,
+        raster_height = HEIGHT,
+        raster_width = WIDTH,
+    )
+    row_off, col_off, height, width = label_pixels[lr.KEY_WINDOW]
+    window_values = values[row_off:row_off + height, col_off:col_off + width]
+    centres = lr.grouped_reduce(
+        window_values = window_values,
+        label_pixels = label_pixels,
+        aggregation = 'centre',
+    )
+
+    for label, geometry in enumerate(geometries):
+        window = rasterio.features.geometry_window(
+            dataset = _DatasetLike(),
+            shapes = [geometry],
+        )
+        crop = values[
+            window.row_off:window.row_off + window.height,
+            window.col_off:window.col_off + window.width,
+        ]
+        mask = rasterio.features.geometry_mask(
+            geometries = [geometry.envelope],
+            out_shape = crop.shape,
+            transform = rasterio.windows.transform(window, TRANSFORM),
+        )
+        expected = rtcm.get_centre_value(np.where(mask, np.nan, crop))
+        if np.isnan(expected):
+            assert np.isnan(centres[label])
+        else:
+            assert centres[label] == expected
+
+
+class _DatasetLike:
+    height = HEIGHT
+    width = WIDTH
+    transform = TRANSFORM
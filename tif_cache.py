@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import os
+import time
+import fcntl
+import hashlib
+import threading
+
+from lazy_imports import lazy_import
+
+rasterio = lazy_import('rasterio')
+
+import agg_value_cache as avc
+import fetch_missing_chirps_files as fmcf
+
+
+"""
+Bounded on-disk cache of decompressed CHIRPS files, meant for a node-local
+SSD. Every run otherwise gunzips the same .tif.gz files from the archive and
+throws the result away. A cached file is stored internally tiled and lightly
+compressed (deflate level 1 with the floating point predictor, lossless), so
+that windowed reads of small ROIs only touch the tiles they need.
+
+Entries are keyed by the identity of the source file (path, size, mtime, see
+avc.get_file_identity), so a re-downloaded or upgraded file gets a new entry
+and the stale one ages out. The modification time of a cached file is its
+last access time and files are evicted in least-recently-used order once the
+folder exceeds max_bytes.
+
+Concurrent access from several workers or processes:
+- an entry is written to a temporary file in the cache folder and renamed
+  into place, so readers never see a partial file. Two workers building the
+  same entry at once both write it and the last rename wins, the contents
+  being identical.
+- eviction is done by one process at a time (non-blocking flock on a lock
+  file, the others skip it), and never removes files accessed in the last
+  MIN_EVICT_AGE_SECONDS so that a file handed out is not removed before it is
+  opened. Once opened, removing it does not affect the reader.
+"""
+
+
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024 * 1024 # 20 GiB
+
+# files accessed more recently than this are never evicted
+MIN_EVICT_AGE_SECONDS = 60
+# temporary files older than this are left over from killed workers
+STALE_TMP_AGE_SECONDS = 3600
+
+BLOCK_SIZE = 256
+ZLEVEL = 1
+
+EXT_CACHED_TIF = '.tif'
+EXT_TMP = '.tmp'
+_LOCK_FILENAME = '.evict.lock'
+
+
+def get_cache_filename(filepath:str):
+    """
+    <name of the decompressed file>.<hash of the source identity>.tif
+    """
+    filename = os.path.split(filepath)[1]
+    for ext in ['.gz', EXT_CACHED_TIF]:
+        if filename.endswith(ext):
+            filename = filename[:-len(ext)]
+    identity_hash = hashlib.sha256(
+        avc.get_file_identity(filepath=filepath).encode()
+    ).hexdigest()[:16]
+    return f'{filename}.{identity_hash}{EXT_CACHED_TIF}'
+
+
+def write_cached_tif(
+    src_filepath:str,
+    dst_filepath:str,
+):
+    """
+    Rewrites src_filepath (any path rasterio can open) as a tiled,
+    deflate compressed GeoTIFF at dst_filepath, with the same values.
+    """
+    with rasterio.open(src_filepath) as src:
+        profile = src.profile.copy()
+        profile.update(
+            driver = 'GTiff',
+            tiled = True,
+            blockxsize = BLOCK_SIZE,
+            blockysize = BLOCK_SIZE,
+            compress = 'deflate',
+            zlevel = ZLEVEL,
+            # floating point predictor for float data, horizontal otherwise
+            predictor = 3 if src.dtypes[0].startswith('float') else 2,
+        )
+        with rasterio.open(dst_filepath, 'w', **profile) as dst:
+            for _, window in dst.block_windows(1):
+                dst.write(src.read(window=window), window=window)
+
+
+class TIFCache:
+    def __init__(
+        self,
+        folderpath:str,
+        max_bytes:int = DEFAULT_MAX_BYTES,
+    ):
+        os.makedirs(folderpath, exist_ok=True)
+        self.folderpath = folderpath
+        self.max_bytes = max_bytes
+
+    def get_tif_filepath(self, filepath:str, filetype:str):
+        """
+        Path of the cached, decompressed copy of filepath, created if not
+        cached yet.
+        """
+        cache_filepath = os.path.join(self.folderpath, get_cache_filename(filepath=filepath))
+        try:
+            # marks the entry as recently used
+            os.utime(cache_filepath)
+            return cache_filepath
+        except FileNotFoundError:
+            pass
+
+        tmp_filepath = f'{cache_filepath}.{os.getpid()}.{threading.get_ident()}{EXT_TMP}'
+        try:
+            write_cached_tif(
+                src_filepath = fmcf.get_gdal_filepath(filepath=filepath, filetype=filetype),
+                dst_filepath = tmp_filepath,
+            )
+            os.replace(tmp_filepath, cache_filepath)
+        finally:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+
+        self.evict()
+
+        return cache_filepath
+
+    def _list_entries(self):
+        """
+        (filepath, nbytes, last_accessed) of the cached files, and the paths
+        of stale temporary files.
+        """
+        entries = []
+        stale_tmp_filepaths = []
+        now = time.time()
+        with os.scandir(self.folderpath) as it:
+            for entry in it:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith(EXT_TMP):
+                    if now - stat.st_mtime > STALE_TMP_AGE_SECONDS:
+                        stale_tmp_filepaths.append(entry.path)
+                elif entry.name.endswith(EXT_CACHED_TIF):
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries, stale_tmp_filepaths
+
+    def get_total_bytes(self):
+        entries, _ = self._list_entries()
+        return sum(nbytes for _, nbytes, _ in entries)
+
+    def evict(self):
+        """
+        Removes least recently used files until the folder is within
+        max_bytes. Returns the number of files removed, 0 if another process
+        is already evicting.
+        """
+        lock_filepath = os.path.join(self.folderpath, _LOCK_FILENAME)
+        with open(lock_filepath, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            try:
+                entries, stale_tmp_filepaths = self._list_entries()
+                for tmp_filepath in stale_tmp_filepaths:
+                    try:
+                        os.remove(tmp_filepath)
+                    except FileNotFoundError:
+                        pass
+
+                excess_bytes = sum(nbytes for _, nbytes, _ in entries) - self.max_bytes
+                if excess_bytes <= 0:
+                    return 0
+
+                n_removed = 0
+                now = time.time()
+                for filepath, nbytes, last_accessed in sorted(entries, key=lambda entry: entry[2]):
+                    if excess_bytes <= 0 or now - last_accessed < MIN_EVICT_AGE_SECONDS:
+                        break
+                    try:
+                        os.remove(filepath)
+                    except FileNotFoundError:
+                        pass
+                    excess_bytes -= nbytes
+                    n_removed += 1
+                return n_removed
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
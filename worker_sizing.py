@@ -0,0 +1,346 @@
+from __future__ import annotations
+
+import sys
+import math
+import types
+import resource
+import functools
+import itertools
+import collections
+import multiprocessing as mp
+
+import lazy_imports
+
+
+"""
+Sizing of the worker pools from memory instead of core count alone. A worker
+reading a global CHIRPS array (READ_NO_CROP, COREGISTER_AND_CROP) holds a few
+hundred MB at its peak, so cpu_count() - 2 workers can exceed the RAM of a
+node with many cores. plan_workers caps the number of workers with the
+measured peak memory of one task (probe_task, which runs the first task
+and hands its result back so that it is not computed twice) and the memory
+currently available (including cgroup limits), and
+picks an imap chunksize from the number of tasks. adaptive_imap then keeps at
+most that many chunks in flight and backs off while available memory is low.
+"""
+
+
+DEFAULT_NJOBS = max(1, mp.cpu_count() - 2)
+
+# fraction of the available memory the workers may use together
+DEFAULT_MEMORY_FRACTION = 0.8
+# fewer tasks are kept in flight while available memory is below this
+# fraction of total memory
+LOW_MEMORY_FRACTION = 0.1
+MAX_CHUNKSIZE = 64
+
+_measured_task_bytes = {}
+
+
+def resolve_njobs(njobs:int = None):
+    """
+    njobs <= 0 (e.g. cpu_count() - 2 on a 2 core machine) or None falls back
+    to DEFAULT_NJOBS.
+    """
+    if njobs is None or int(njobs) <= 0:
+        return DEFAULT_NJOBS
+    return int(njobs)
+
+
+def _read_int_file(filepath:str):
+    try:
+        with open(filepath) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    if not value.isdigit():
+        # 'max' for cgroup v2 without a limit
+        return None
+    return int(value)
+
+
+def get_memory_info():
+    """
+    Returns (available_bytes, total_bytes), None where unknown. Takes the
+    cgroup (v2 or v1) memory limit into account, as set by schedulers like
+    SLURM.
+    """
+    available_bytes, total_bytes = None, None
+    try:
+        meminfo = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0]) * 1024
+        available_bytes = meminfo.get('MemAvailable')
+        total_bytes = meminfo.get('MemTotal')
+    except (OSError, ValueError):
+        pass
+
+    for limit_filepath, usage_filepath in [
+        ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+        ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes'),
+    ]:
+        limit_bytes = _read_int_file(limit_filepath)
+        usage_bytes = _read_int_file(usage_filepath)
+        if limit_bytes is None or usage_bytes is None:
+            continue
+        # cgroup v1 reports a huge number when there is no limit
+        if total_bytes is not None and limit_bytes >= total_bytes:
+            continue
+        cgroup_available_bytes = max(limit_bytes - usage_bytes, 0)
+        available_bytes = cgroup_available_bytes if available_bytes is None \
+            else min(available_bytes, cgroup_available_bytes)
+        total_bytes = limit_bytes if total_bytes is None else min(total_bytes, limit_bytes)
+        break
+
+    return available_bytes, total_bytes
+
+
+def _read_proc_status_bytes(key:str):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """
+    Resets VmHWM of this process (Linux >= 4.0). Returns False if not
+    supported.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _get_wrapped_funcs(func):
+    """
+    func and the functions it wraps through functools.partial, including
+    the ones passed as positional arguments (e.g. pm.timed_call).
+    """
+    if not isinstance(func, functools.partial):
+        return [func]
+    funcs = _get_wrapped_funcs(func.func)
+    for arg in func.args:
+        if callable(arg):
+            funcs += _get_wrapped_funcs(arg)
+    return funcs
+
+
+def _load_lazy_modules(func):
+    """
+    Imports the lazy modules (see lazy_imports.py) of the modules of func
+    and of the modules they import, which a worker pays once and not per
+    task, so that they are not counted in the task's peak memory.
+    """
+    modules = []
+    for _func in _get_wrapped_funcs(func):
+        module = sys.modules.get(getattr(_func, '__module__', None))
+        if module is None:
+            continue
+        modules += [module] + [
+            value for value in vars(module).values()
+            if isinstance(value, types.ModuleType)
+            and not isinstance(value, lazy_imports.LazyModule)
+        ]
+    for _module in modules:
+        for value in list(vars(_module).values()):
+            if isinstance(value, lazy_imports.LazyModule):
+                try:
+                    value._load()
+                except ImportError:
+                    pass
+
+
+def _measure_task(func_arg:tuple):
+    """
+    Returns (func(arg), peak memory increase in bytes).
+    """
+    func, arg = func_arg
+    _load_lazy_modules(func)
+    rss_before = _read_proc_status_bytes('VmRSS')
+    if _reset_peak_rss() and rss_before is not None:
+        result = func(arg)
+        peak_rss = _read_proc_status_bytes('VmHWM')
+    else:
+        # ru_maxrss is in KB on Linux and includes the peak before the task,
+        # so this overestimates at worst
+        rss_before = rss_before or 0
+        result = func(arg)
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return result, max(peak_rss - rss_before, 0)
+
+
+def get_measured_task_bytes(key):
+    """
+    Peak memory of a task measured by probe_task under key earlier in the
+    lifetime of the process, None if not measured yet.
+    """
+    return _measured_task_bytes.get(key)
+
+
+def probe_task(func, arg, key = None, in_process:bool = False):
+    """
+    Runs func(arg) once and returns (func(arg), its peak memory increase in
+    bytes). The caller uses the result for arg instead of running it again.
+
+    in_process runs it in this process, for the threads backend whose tasks
+    run here as well, without starting a process. The increase is then
+    lower if the task reuses memory this process freed before, which is
+    also what the threads will do. Otherwise it runs in a new process, as a
+    worker of a process pool would. The measurement is kept under key (if given), see
+    get_measured_task_bytes, so that the following runs of the same kind of
+    task skip the probe.
+    """
+    if in_process:
+        result, task_bytes = _measure_task((func, arg))
+    else:
+        with mp.Pool(1) as p:
+            result, task_bytes = p.apply(_measure_task, ((func, arg),))
+    if key is not None:
+        _measured_task_bytes[key] = task_bytes
+    return result, task_bytes
+
+
+def get_chunksize(n_tasks:int, n_workers:int):
+    """
+    About 4 chunks per worker, same as Pool.map's default, capped so that
+    results still come back regularly for long runs.
+    """
+    return max(1, min(MAX_CHUNKSIZE, math.ceil(n_tasks / (n_workers * 4))))
+
+
+class WorkerPlan:
+    def __init__(
+        self,
+        n_workers:int,
+        chunksize:int,
+        njobs:int,
+        task_bytes:int = None,
+        available_bytes:int = None,
+        low_memory_bytes:int = None,
+    ):
+        self.n_workers = n_workers
+        self.chunksize = chunksize
+        self.njobs = njobs
+        self.task_bytes = task_bytes
+        self.available_bytes = available_bytes
+        self.low_memory_bytes = low_memory_bytes
+
+    def __str__(self):
+        def to_mb(n_bytes):
+            return 'unknown' if n_bytes is None else f'{n_bytes / 2**20:.0f} MB'
+        return (
+            f'workers={self.n_workers} (njobs={self.njobs}), '
+            f'chunksize={self.chunksize}, '
+            f'task peak memory={to_mb(self.task_bytes)}, '
+            f'available memory={to_mb(self.available_bytes)}'
+        )
+
+
+def plan_workers(
+    n_tasks:int,
+    njobs:int = None,
+    task_bytes:int = None,
+    memory_fraction:float = DEFAULT_MEMORY_FRACTION,
+    label:str = None,
+):
+    """
+    Number of workers (at most njobs, at least 1) such that n_workers *
+    task_bytes fits in memory_fraction of the available memory, and the
+    imap chunksize for n_tasks. Prints the chosen settings if label is
+    given.
+    """
+    njobs = resolve_njobs(njobs)
+    available_bytes, total_bytes = get_memory_info()
+
+    n_workers = njobs
+    if task_bytes is not None and task_bytes > 0 and available_bytes is not None:
+        n_workers = min(n_workers, int(available_bytes * memory_fraction // task_bytes))
+    if n_tasks > 0:
+        n_workers = min(n_workers, n_tasks)
+    n_workers = max(n_workers, 1)
+
+    low_memory_bytes = None
+    if total_bytes is not None:
+        low_memory_bytes = int(total_bytes * LOW_MEMORY_FRACTION)
+        if task_bytes is not None:
+            low_memory_bytes = max(low_memory_bytes, 2 * task_bytes)
+
+    plan = WorkerPlan(
+        n_workers = n_workers,
+        chunksize = get_chunksize(n_tasks=n_tasks, n_workers=n_workers),
+        njobs = njobs,
+        task_bytes = task_bytes,
+        available_bytes = available_bytes,
+        low_memory_bytes = low_memory_bytes,
+    )
+
+    if label is not None:
+        print(f'{label}: {plan}')
+
+    return plan
+
+
+def _run_chunk(func_chunk:tuple):
+    func, chunk = func_chunk
+    return [func(arg) for arg in chunk]
+
+
+def adaptive_imap(
+    pool,
+    func,
+    iterable,
+    plan:WorkerPlan,
+):
+    """
+    Same results, in the same order, as pool.imap(func, iterable,
+    chunksize=plan.chunksize), but with at most plan.n_workers chunks in
+    flight, which also limits a larger shared pool to plan.n_workers
+    concurrent tasks. While available memory is below plan.low_memory_bytes
+    the number of chunks in flight is halved after every returned chunk (down
+    to 1), and grows back by one at a time once memory has recovered.
+
+    iterable is consumed lazily, only as chunks are submitted.
+    """
+    args_iter = iter(iterable)
+    is_exhausted = False
+
+    max_in_flight = plan.n_workers
+    pending_results = collections.deque()
+
+    while True:
+        while not is_exhausted and len(pending_results) < max_in_flight:
+            chunk = list(itertools.islice(args_iter, plan.chunksize))
+            if len(chunk) == 0:
+                is_exhausted = True
+                break
+            pending_results.append(pool.apply_async(_run_chunk, ((func, chunk),)))
+
+        if len(pending_results) == 0:
+            break
+
+        for result in pending_results.popleft().get():
+            yield result
+
+        if plan.low_memory_bytes is None:
+            continue
+        available_bytes, _ = get_memory_info()
+        if available_bytes is None:
+            continue
+        if available_bytes < plan.low_memory_bytes and max_in_flight > 1:
+            max_in_flight = max(max_in_flight // 2, 1)
+            print(
+                f'Low memory ({available_bytes / 2**20:.0f} MB available), '
+                f'reducing tasks in flight to {max_in_flight}.'
+            )
+        elif available_bytes > 2 * plan.low_memory_bytes and max_in_flight < plan.n_workers:
+            max_in_flight += 1